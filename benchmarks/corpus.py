@@ -0,0 +1,108 @@
+# Synthetic corpus of N studies x M series x K instances, packaged as .dcm objects and archives
+# Usage: python benchmarks/corpus.py --studies 2 --series 3 --instances 20 --output /tmp/corpus
+import os
+import sys
+import random
+import tarfile
+import zipfile
+import argparse
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from generate_dcm import create_dataset, random_color  # noqa: E402
+
+FORMATS = ['dcm', 'zip', 'tar.gz', 'tar.bz2', 'tar.xz']
+STUDY_DATES = ['20211103', '19990101', '19870403']
+
+
+def noise(size):
+    # Seeded, unlike os.urandom
+    return random.getrandbits(8 * size).to_bytes(size, 'little')
+
+
+def enrich(ds, study_uid, series_uid, instance_number):
+    # Tags the sample file lacks: sequences, multi-valued PN and DA, private tags
+    ds.OtherPatientNames = ['Doe^John', 'Roe^Jane^^Dr']
+    ds.PerformingPhysicianName = ['Smith^Anna', 'Jones^Bob']
+    ds.CalibrationDate = ['20200101', '20210615']
+    ds.DateOfLastCalibration = ['20210101', '20210701', '20211001']
+    reference = Dataset()
+    reference.ReferencedSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+    reference.ReferencedSOPInstanceUID = generate_uid()
+    code = Dataset()
+    code.CodeValue = f'BENCH{instance_number % 7}'
+    code.CodingSchemeDesignator = 'DCM'
+    code.CodeMeaning = 'Synthetic benchmark procedure'
+    ds.ReferencedImageSequence = Sequence([reference])
+    ds.ProcedureCodeSequence = Sequence([code])
+    request = Dataset()
+    request.RequestedProcedureID = f'{study_uid[-8:]}'
+    request.ScheduledProcedureStepID = f'{series_uid[-8:]}'
+    request.RequestedProcedureCodeSequence = Sequence([code])
+    ds.RequestAttributesSequence = Sequence([request])
+    block = ds.private_block(0x0009, 'BENCHMARK', create=True)
+    block.add_new(0x01, 'LO', 'private value')
+    block.add_new(0x02, 'DS', ['1.5', '2.5'])
+    block.add_new(0x03, 'OB', noise(256))
+    return ds
+
+
+def generate(directory, studies, series, instances, pixels=256, seed=0):
+    # Writes directory/files/<study>/<series>/<instance>.dcm, returns the relative paths
+    random.seed(seed)
+    paths = []
+    for study in range(studies):
+        study_uid = generate_uid()
+        study_date = STUDY_DATES[study % len(STUDY_DATES)]
+        color = random_color()
+        for serie in range(series):
+            series_uid = generate_uid()
+            for instance in range(instances):
+                ds = create_dataset(color, study_date, study_uid=study_uid, series_uid=series_uid,
+                                    series_number=serie + 1, instance_number=instance + 1, pixels=pixels)
+                enrich(ds, study_uid, series_uid, instance + 1)
+                # Solid colors compress to nothing, half noise keeps archives near the 2:1 ratio of real images
+                size = len(ds.PixelData)
+                ds.PixelData = noise(size // 2) + bytes(size - size // 2)
+                path = os.path.join(f'study-{study}', f'series-{serie}', f'instance-{instance}.dcm')
+                os.makedirs(os.path.join(directory, 'files', os.path.dirname(path)), exist_ok=True)
+                ds.save_as(os.path.join(directory, 'files', path), write_like_original=False)
+                paths.append(path)
+    return paths
+
+
+def package(directory, paths, fmt):
+    # One object per file for dcm, a single archive of all files otherwise
+    files = os.path.join(directory, 'files')
+    if fmt == 'dcm':
+        return [os.path.join(files, path) for path in paths]
+    archive = os.path.join(directory, f'corpus.{fmt}')
+    if fmt == 'zip':
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as z:
+            for path in paths:
+                z.write(os.path.join(files, path), path)
+    else:
+        with tarfile.open(archive, f'w:{fmt.split(".")[1]}') as t:
+            for path in paths:
+                t.add(os.path.join(files, path), path)
+    return [archive]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--studies', type=int, default=2)
+    parser.add_argument('--series', type=int, default=3)
+    parser.add_argument('--instances', type=int, default=20)
+    parser.add_argument('--pixels', type=int, default=256)
+    parser.add_argument('--output', default='/tmp/dicom-corpus')
+    args = parser.parse_args()
+    paths = generate(args.output, args.studies, args.series, args.instances, args.pixels)
+    for fmt in FORMATS:
+        objects = package(args.output, paths, fmt)
+        print(f'{fmt}: {len(objects)} objects, {sum(os.path.getsize(o) for o in objects) / 1e6:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# Flattens every DICOM file of the given paths with fastparse.dcmread and with pydicom, and fails on any difference
+# Usage: python benchmarks/differential.py sample_dcm /tmp/dicom-corpus/files
+import io
+import os
+import sys
+import time
+import tarfile
+import zipfile
+import argparse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+os.environ.setdefault('LOGLEVEL', 'WARNING')
+
+import utils.utils as utils  # noqa: E402
+import utils.selection as selection  # noqa: E402
+import utils.fastparse as fastparse  # noqa: E402
+from dicomwrapper import dcmfile  # noqa: E402
+
+
+def members(path):
+    # Name and bytes of the DICOM files of path, archives are read like s3file does
+    if os.path.isdir(path):
+        for directory, _, names in os.walk(path):
+            for name in sorted(names):
+                yield from members(os.path.join(directory, name))
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for f in utils.unzip(archive):
+                yield f'{path}/{f.name}', f.read()
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path) as archive:
+            for f in utils.tar(archive):
+                yield f'{path}/{f.tarname}', f.read()
+    else:
+        with open(path, 'rb') as f:
+            if utils.check_dcm(f):
+                f.seek(0)
+                yield path, f.read()
+
+
+def pydicom_read(data):
+    image = selection.dcmread(io.BytesIO(data))
+    selection.remove_private_tags(image)
+    return image
+
+
+def fast_read(data):
+    image = fastparse.dcmread(io.BytesIO(data))
+    if image is not None:
+        selection.remove_private_tags(image)
+    return image
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*', default=[os.path.join(ROOT, 'sample_dcm')])
+    args = parser.parse_args()
+
+    dcm = dcmfile(source_s3_bucket='differential', source_s3_bucket_region='us-east-1', source_s3_key='differential')
+    files = [member for path in args.paths for member in members(path)]
+    # Imports and lookup tables are loaded before the timed runs
+    if files:
+        fast_read(files[0][1])
+        dcm.transform(files[0][0], pydicom_read(files[0][1]))
+    timings = {'pydicom': 0.0, 'fastparse': 0.0}
+    fallbacks = 0
+    differences = 0
+    unreadable = []
+    for name, data in files:
+        start = time.perf_counter()
+        try:
+            expected = dcm.transform(name, pydicom_read(data))
+        except Exception as e:
+            # Files the pydicom path can not extract are not compared
+            unreadable.append(name)
+            print(f'{name}: pydicom path can not extract it, {e!r}')
+            continue
+        timings['pydicom'] += time.perf_counter() - start
+        start = time.perf_counter()
+        image = fast_read(data)
+        if image is None:
+            fallbacks += 1
+            timings['fastparse'] += time.perf_counter() - start
+            continue
+        actual = dcm.transform(name, image)
+        timings['fastparse'] += time.perf_counter() - start
+        for key in sorted(set(expected) | set(actual)):
+            if expected.get(key, '<missing>') != actual.get(key, '<missing>'):
+                differences += 1
+                print(f'{name} {key}: pydicom {expected.get(key, "<missing>")!r} '
+                      f'fastparse {actual.get(key, "<missing>")!r}')
+    print(f'{len(files)} files, {len(unreadable)} not extracted by pydicom, {fallbacks} read by pydicom, '
+          f'{differences} differences')
+    for path, seconds in timings.items():
+        print(f'{path:10} {seconds:8.3f} s {len(files) / seconds if seconds else 0:9.1f} files/s')
+    sys.exit(1 if differences or not files else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# Import time of the Lambda handler module, measured with python -X importtime
+# Usage: python benchmarks/importtime.py [--module app] [--runs 5] [--budget-ms 500]
+import os
+import re
+import sys
+import argparse
+import platform
+import statistics
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+# Loaded on the extraction path only, a module level import of any of them slows every cold start
+DEFERRED_MODULES = ['pydicom', 'pyarrow', 'numpy', 'pandas', 'awswrangler']
+# Loaded at module load on purpose, every invocation calls AWS. Reported so results of other machines compare
+REPORTED_MODULES = ['boto3', 'structlog']
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def measure(module):
+    env = dict(os.environ, PYTHONPATH=SRC, S3_OUTPUT_BUCKET='bucket', AWS_DEFAULT_REGION='us-east-1',
+               LOGLEVEL='ERROR')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=SRC, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+    imports = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            imports.append((match.group(4), int(match.group(2)), len(match.group(3)) // 2))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=None)
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(args.runs)]
+    totals = [next(cumulative for name, cumulative, _ in imports if name == args.module) / 1000 for imports in runs]
+    imports = runs[-1]
+    print(f'Python {platform.python_version()} on {platform.platform()}, {os.cpu_count()} CPUs')
+    print(f'{args.module}: median {statistics.median(totals):.1f} ms, min {min(totals):.1f} ms over {args.runs} runs')
+    for module in REPORTED_MODULES:
+        cumulative = [cumulative for name, cumulative, _ in imports if name == module]
+        if cumulative:
+            print(f'  of which {module} {cumulative[0] / 1000:.1f} ms')
+    print(f'Slowest direct imports of {args.module}:')
+    direct = [(name, cumulative) for name, cumulative, depth in imports if depth == 1]
+    for name, cumulative in sorted(direct, key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f'  {cumulative / 1000:8.1f} ms  {name}')
+
+    failed = False
+    loaded = sorted({name.split('.')[0] for name, _, _ in imports} & set(DEFERRED_MODULES))
+    if loaded:
+        print(f'FAIL: {", ".join(loaded)} imported at module load')
+        failed = True
+    if args.budget_ms is not None and statistics.median(totals) > args.budget_ms:
+        print(f'FAIL: median import time above budget of {args.budget_ms} ms')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
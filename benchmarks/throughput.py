@@ -0,0 +1,198 @@
+# Files/s, MB/s and peak RSS per extraction stage over a synthetic corpus, against moto as local S3
+# Usage: python benchmarks/throughput.py --studies 2 --series 3 --instances 20 --output results.json
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+os.environ.update(S3_OUTPUT_BUCKET='benchmark-output', S3_OUTPUT_BUCKET_REGION='us-east-1',
+                  AWS_DEFAULT_REGION='us-east-1', AWS_ACCESS_KEY_ID='benchmark', AWS_SECRET_ACCESS_KEY='benchmark')
+os.environ.setdefault('LOGLEVEL', 'WARNING')
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+import corpus  # noqa: E402
+
+INPUT_BUCKET = 'benchmark-input'
+REGION = 'us-east-1'
+SAMPLE_INTERVAL = 0.005
+
+
+def rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # No procfs, peak of the whole process so far
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class stage():
+    # Wall time and peak RSS, sampled from a background thread while the stage runs
+    def __init__(self, fmt, name, results):
+        self.fmt = fmt
+        self.name = name
+        self.results = results
+        self.files = 0
+        self.bytes = 0
+
+    def sample(self):
+        while not self.done.wait(SAMPLE_INTERVAL):
+            self.peak = max(self.peak, rss())
+
+    def __enter__(self):
+        self.done = threading.Event()
+        self.peak = rss()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.done.set()
+        self.sampler.join()
+        self.peak = max(self.peak, rss())
+        self.results.append({
+            'format': self.fmt,
+            'stage': self.name,
+            'files': self.files,
+            'seconds': round(elapsed, 4),
+            'files_per_second': round(self.files / elapsed, 1) if elapsed else None,
+            'megabytes': round(self.bytes / 1e6, 2),
+            'megabytes_per_second': round(self.bytes / 1e6 / elapsed, 1) if elapsed else None,
+            'peak_rss_megabytes': round(self.peak / 1e6, 1),
+        })
+        print(f'{self.fmt:8} {self.name:10} {self.files:6} files {self.files / elapsed:9.1f} files/s '
+              f'{self.bytes / 1e6:8.1f} MB {self.bytes / 1e6 / elapsed:8.1f} MB/s '
+              f'peak RSS {self.peak / 1e6:7.1f} MB')
+
+
+def run_format(fmt, keys, instances, results):
+    import app
+    import utils.selection as selection
+    import utils.fastparse as fastparse
+    from s3wrapper import s3file
+    from dicomwrapper import dcmfile
+
+    sizes = {key: size for key, size in keys}
+    with stage(fmt, 'fetch', results) as s:
+        for key, size in keys:
+            s.bytes += len(s3file(INPUT_BUCKET, key, REGION, size).open_stream().read())
+        s.files = instances
+
+    members = []
+    with stage(fmt, 'enumerate', results) as s:
+        for key, size in keys:
+            ds = s3file(INPUT_BUCKET, key, REGION, size)
+            ds.eval_ext()
+            ds.get()
+            for img in ds.file_list:
+                data = img.read()
+                img.close()
+                members.append((key, app.getname(img), data))
+                s.bytes += len(data)
+        s.files = len(members)
+
+    datasets = []
+    with stage(fmt, 'dcmread', results) as s:
+        for key, name, data in members:
+            image = fastparse.dcmread(io.BytesIO(data)) if fastparse.FAST_PARSE else None
+            if image is None:
+                image = selection.dcmread(io.BytesIO(data))
+            selection.remove_private_tags(image)
+            datasets.append((key, name, image))
+            s.bytes += len(data)
+        s.files = len(datasets)
+
+    rows = []
+    with stage(fmt, 'transform', results) as s:
+        for key, name, image in datasets:
+            dcm = dcmfile(source_s3_bucket=INPUT_BUCKET, source_s3_bucket_region=REGION, source_s3_key=key)
+            rows.append(dcm.transform(name, image))
+        s.files = len(rows)
+        s.bytes = sum(len(data) for _, _, data in members)
+
+    with stage(fmt, 'parquet', results) as s:
+        dcm = dcmfile(source_s3_bucket=INPUT_BUCKET, source_s3_bucket_region=REGION,
+                      source_s3_key=os.path.commonprefix(list(sizes)), sink=app.output)
+        for flat in rows:
+            dcm.add(flat)
+        dcm.flush()
+        s.files = len(rows)
+        s.bytes = sum(len(data) for _, _, data in members)
+
+    with stage(fmt, 'end-to-end', results) as s:
+        records = [{'awsRegion': REGION, 's3': {'bucket': {'name': INPUT_BUCKET},
+                                                'object': {'key': key, 'size': size}}} for key, size in keys]
+        result = app.lambda_handler({'Records': records}, None)
+        if result['batchItemFailures']:
+            raise Exception(f'Failed records {result["batchItemFailures"]}')
+        s.files = instances
+        s.bytes = sum(sizes.values())
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--studies', type=int, default=2)
+    parser.add_argument('--series', type=int, default=3)
+    parser.add_argument('--instances', type=int, default=20)
+    parser.add_argument('--pixels', type=int, default=256)
+    parser.add_argument('--formats', default=','.join(corpus.FORMATS))
+    parser.add_argument('--corpus', default=None, help='Directory of the generated corpus, temporary by default')
+    parser.add_argument('--output', default=None, help='Write the results as JSON')
+    args = parser.parse_args()
+
+    directory = args.corpus or tempfile.mkdtemp(prefix='dicom-corpus-')
+    paths = corpus.generate(directory, args.studies, args.series, args.instances, args.pixels)
+    results = []
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=REGION)
+        s3.create_bucket(Bucket=INPUT_BUCKET)
+        s3.create_bucket(Bucket=os.environ['S3_OUTPUT_BUCKET'])
+        # Extract one file first, so the first format does not pay for imports and lookup tables
+        import app
+        s3.upload_file(os.path.join(directory, 'files', paths[0]), INPUT_BUCKET, 'warmup.dcm')
+        app.lambda_handler({'Records': [{'awsRegion': REGION, 's3': {'bucket': {'name': INPUT_BUCKET}, 'object': {
+            'key': 'warmup.dcm', 'size': os.path.getsize(os.path.join(directory, 'files', paths[0]))}}}]}, None)
+        for fmt in args.formats.split(','):
+            keys = []
+            for path in corpus.package(directory, paths, fmt):
+                key = f'{fmt}/{os.path.relpath(path, directory)}'
+                s3.upload_file(path, INPUT_BUCKET, key)
+                keys.append((key, os.path.getsize(path)))
+            run_format(fmt, keys, len(paths), results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'revision': git_revision(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'python': platform.python_version(),
+                'corpus': {'studies': args.studies, 'series': args.series, 'instances': args.instances,
+                           'pixels': args.pixels, 'files': len(paths)},
+                'results': results,
+            }, f, indent=2)
+        print(f'Saved results to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
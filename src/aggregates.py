@@ -0,0 +1,194 @@
+# Study and series level tables rolled up from the instance rows of each write, merged by compaction.
+# Until then a study or series has one partial row per write, the views of view_sql merge them at query time
+import os
+import uuid
+import datetime
+import utils.aws as aws
+from utils.utils import str2bool
+from logger import get_logger
+
+S3_OUTPUT_BUCKET = os.environ.get('S3_OUTPUT_BUCKET', None)
+S3_OUTPUT_BUCKET_REGION = os.environ.get(
+    'S3_OUTPUT_BUCKET_REGION', 'us-east-1')
+AGGREGATES = str2bool(os.environ.get('AGGREGATES', True))
+# Prefixes starting with _ are ignored by the instance table, the aggregate tables point at study/ and series/
+AGGREGATE_PREFIX = os.environ.get('AGGREGATE_PREFIX', '_aggregates/')
+# Columns with min_ and max_ columns, numbers are compared as numbers
+AGGREGATE_MINMAX = os.environ.get(
+    'AGGREGATE_MINMAX', 'instance_number,acquisition_date,acquisition_time,acquisition_date_time,content_time')
+# Columns with a distinct_ list of their values
+AGGREGATE_DISTINCT = os.environ.get(
+    'AGGREGATE_DISTINCT', 'patient_id,modality,study_date,study_description,series_description,'
+                          'body_part_examined,manufacturer,source_s3_key')
+LEVELS = {
+    'study': ['study_instance_uid'],
+    'series': ['study_instance_uid', 'series_instance_uid'],
+}
+# Listed per study, the series table has one row each
+LEVEL_DISTINCT = {
+    'study': ['series_instance_uid'],
+    'series': [],
+}
+# Athena tables over the partial rows of each level, and the views merging them
+AGGREGATE_TABLES = {
+    'study': os.environ.get('AGGREGATE_STUDY_TABLE', 'dicom_studies'),
+    'series': os.environ.get('AGGREGATE_SERIES_TABLE', 'dicom_series'),
+}
+
+log = get_logger(__name__)
+
+
+def columns(names):
+    return [name.strip() for name in names.split(',') if name.strip()]
+
+
+def order(value):
+    # IS and DS values are strings, 10 sorts after 9
+    try:
+        return (0, float(value), '')
+    except (TypeError, ValueError):
+        return (1, 0.0, str(value))
+
+
+def instance_partials(table, level):
+    # Each instance row as a partial aggregate of one instance
+    keys = LEVELS[level]
+    minmax = [name for name in columns(AGGREGATE_MINMAX) if name in table.column_names]
+    distinct = [name for name in LEVEL_DISTINCT[level] + columns(AGGREGATE_DISTINCT) if name in table.column_names]
+    values = {name: table.column(name).to_pylist() for name in set(keys + minmax + distinct)}
+    now = datetime.datetime.utcnow()
+    for index in range(table.num_rows):
+        partial = {name: values[name][index] for name in keys}
+        partial['instance_count'] = 1
+        partial['updated_at'] = now
+        for name in minmax + distinct:
+            value = values[name][index]
+            # Multi-valued tags are not rolled up
+            if isinstance(value, (list, dict)):
+                continue
+            if name in minmax:
+                partial[f'min_{name}'] = partial[f'max_{name}'] = value
+            if name in distinct:
+                partial[f'distinct_{name}'] = [str(value)] if value is not None else []
+        yield partial
+
+
+def merge(partials, level):
+    merged = {}
+    for partial in partials:
+        key = tuple(partial.get(name) for name in LEVELS[level])
+        # Rows without a study or series UID can not be rolled up
+        if any(value is None for value in key):
+            continue
+        row = merged.get(key)
+        if row is None:
+            merged[key] = row = {name: value for name, value in zip(LEVELS[level], key)}
+            row['instance_count'] = 0
+            row['updated_at'] = None
+        row['instance_count'] += partial.get('instance_count') or 0
+        for name, value in partial.items():
+            if name.startswith('min_') and value is not None:
+                if row.get(name) is None or order(value) < order(row[name]):
+                    row[name] = value
+            elif name.startswith('max_') and value is not None:
+                if row.get(name) is None or order(value) > order(row[name]):
+                    row[name] = value
+            elif name.startswith('distinct_'):
+                row.setdefault(name, set()).update(value or [])
+            elif name == 'updated_at' and value is not None:
+                row[name] = value if row[name] is None else max(row[name], value)
+    return list(merged.values())
+
+
+def to_table(rows, schema=None):
+    # Declared types of the instance or partial table, so every file of a level has the same types
+    import pyarrow as pa
+    names = []
+    for row in rows:
+        names.extend(name for name in row if name not in names)
+    arrays = []
+    for name in names:
+        values = [row.get(name) for row in rows]
+        if name.startswith('distinct_'):
+            arrays.append(pa.array([sorted(value) if value is not None else [] for value in values],
+                                   type=pa.list_(pa.string())))
+        elif name == 'instance_count':
+            arrays.append(pa.array(values, type=pa.int64()))
+        elif name == 'updated_at':
+            arrays.append(pa.array(values, type=pa.timestamp('ms')))
+        else:
+            source = name.split('_', 1)[1] if name.startswith(('min_', 'max_')) else name
+            if schema is not None and schema.get_field_index(source) >= 0:
+                declared = schema.field(source).type
+            elif schema is not None and schema.get_field_index(name) >= 0:
+                declared = schema.field(name).type
+            else:
+                declared = pa.string()
+            arrays.append(pa.array(values, type=declared))
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def summarize(table, level):
+    return to_table(merge(instance_partials(table, level), level), schema=table.schema)
+
+
+def combine(table, level):
+    # Merge partial aggregates, e.g. all files of a level at compaction
+    values = table.to_pydict()
+    partials = (dict(zip(values, row)) for row in zip(*values.values()))
+    return to_table(merge(partials, level), schema=table.schema)
+
+
+def get_client():
+    return aws.get_client('s3', S3_OUTPUT_BUCKET_REGION)
+
+
+def extreme(function, name):
+    # Numbers stored as strings, e.g. instance_number, compare as numbers like order does
+    import utils.partitioning as partitioning
+    column = f'{function}_{name}'
+    if partitioning.sort_type(name) is not None:
+        return f'coalesce({function}_by({column}, TRY_CAST({column} AS double)), {function}({column})) AS {column}'
+    return f'{function}({column}) AS {column}'
+
+
+def view_sql(level, table=None, view=None):
+    # One row per study or series over the partial rows of every write, same merge as combine
+    table = table or AGGREGATE_TABLES[level]
+    view = view or f'{table}_merged'
+    keys = LEVELS[level]
+    selected = keys + ['sum(instance_count) AS instance_count', 'max(updated_at) AS updated_at']
+    for name in columns(AGGREGATE_MINMAX):
+        selected += [extreme('min', name), extreme('max', name)]
+    for name in LEVEL_DISTINCT[level] + columns(AGGREGATE_DISTINCT):
+        selected.append(f'array_sort(array_distinct(flatten(array_agg(distinct_{name})))) AS distinct_{name}')
+    select = ',\n       '.join(selected)
+    return (f'CREATE OR REPLACE VIEW {view} AS\n'
+            f'SELECT {select}\n'
+            f'FROM {table}\n'
+            f'GROUP BY {", ".join(keys)}')
+
+
+def write(table):
+    # One partial aggregate file per level and write, the instance rows are already deduplicated
+    import utils.arrow as arrow
+    paths = []
+    if not AGGREGATES or 'study_instance_uid' not in table.column_names:
+        return paths
+    for level, keys in LEVELS.items():
+        if not all(key in table.column_names for key in keys):
+            continue
+        summary = summarize(table, level)
+        if summary.num_rows == 0:
+            continue
+        key = f'{AGGREGATE_PREFIX}{level}/{uuid.uuid4().hex}.snappy.parquet'
+        get_client().put_object(Bucket=S3_OUTPUT_BUCKET, Key=key, Body=arrow.to_parquet(summary), **aws.put_args())
+        log.info(f'Saved {summary.num_rows} {level} aggregates to s3://{S3_OUTPUT_BUCKET}/{key}')
+        paths.append(f's3://{S3_OUTPUT_BUCKET}/{key}')
+    return paths
+
+
+# Print the CREATE VIEW statements of the study and series views
+if __name__ == '__main__':
+    for level in LEVELS:
+        print(f'{view_sql(level)};\n')
@@ -1,112 +1,288 @@
 import logging
-import pydicom
-import boto3
 import json
-from utils.utils import getname
+import io
+import time
+from utils.utils import getname, str2bool
+from utils.parallel import ordered_map
 import os
 from logger import get_logger
-from s3wrapper import s3file
+from s3wrapper import s3file, ARCHIVE_FILE_EXT
 from dicomwrapper import dcmfile
-import awswrangler as wr
-import pandas as pd
+import dedup
+import aggregates
+import metrics
+import manifest
+import router
+import utils.aws as aws
+import utils.partitioning as partitioning
+import utils.fastparse as fastparse
 import re
-from urllib import parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 S3_BUCKET = os.environ.get('S3_BUCKET', None)
 S3_KEY = os.environ.get('S3_KEY', None)
 S3_REGION = os.environ.get('S3_REGION', None)
 OBJ_SIZE = os.environ.get('OBJ_SIZE', None)
+OBJ_ETAG = os.environ.get('OBJ_ETAG', None)
+# Set on Batch jobs that continue the extraction of a Lambda run
+CHECKPOINT = os.environ.get('CHECKPOINT', None)
 LOCAL_LOCATION = os.environ.get('LOCAL_LOCATION', '/tmp')
 S3_OUTPUT_BUCKET = os.environ.get('S3_OUTPUT_BUCKET', None)
 S3_OUTPUT_BUCKET_REGION = os.environ.get(
     'S3_OUTPUT_BUCKET_REGION', 'us-east-1')
 GLUE_DATABASE_NAME = os.environ.get('GLUE_DATABASE_NAME', 'dicom')
 GLUE_TABLE_NAME = os.environ.get('GLUE_TABLE_NAME', 'dicom_metadata')
-MAX_LAMBDA_SIZE = os.environ.get('MAX_LAMBDA_SIZE', 500)
 AWS_BATCH_QUEUE = os.environ.get('AWS_BATCH_QUEUE', 'dicom-queue')
 AWS_BATCH_DEFINITION = os.environ.get('AWS_BATCH_DEFINITION', 'dicom-parser')
-PARTITION_COL = os.environ.get('PARTITION_COL', 'study_date')
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', 4))
+# Use PARSE_EXECUTOR=process on AWS Batch, Lambda does not provide /dev/shm for process pools
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', 1))
+PARSE_MAX_INFLIGHT = int(os.environ.get('PARSE_MAX_INFLIGHT', PARSE_WORKERS * 2))
+PARSE_EXECUTOR = os.environ.get('PARSE_EXECUTOR', 'thread')
+INCREMENTAL = str2bool(os.environ.get('INCREMENTAL', False))
+# Settings that change the extracted rows or the output layout, forwarded as set to AWS Batch jobs
+# so archives parsed on Batch are extracted like those parsed on Lambda
+EXTRACTION_SETTINGS = [
+    'TAG_PROFILE', 'TAG_KEYWORDS', 'DEFER_SIZE', 'FAST_PARSE', 'FAST_PARSE_READ_SIZE',
+    'IGNORE_OB', 'LARGE_VALUE_SIZE', 'LARGE_VALUE_POLICY', 'LARGE_VALUE_PREFIX',
+    'SQ_MAX_DEPTH', 'SQ_MAX_ITEMS', 'TEMPORAL_CACHE_SIZE', 'TAG_PLAN_CACHE_SIZE', 'FLUSH_ROWS',
+    'PARTITION_COL', 'PARTITION_COLS', 'SORT_KEYS', 'DATE_FALLBACK',
+    'INCREMENTAL', 'MANIFEST_PREFIX', 'TOMBSTONE_PREFIX',
+    'AGGREGATES', 'AGGREGATE_PREFIX', 'AGGREGATE_MINMAX', 'AGGREGATE_DISTINCT',
+    'METRICS', 'METRICS_NAMESPACE',
+]
 log = get_logger(__name__)
 
 
-def transform(name, img, dcm):
+def members(ds, skip=0, workers=PARSE_WORKERS):
+    # file_list is a generator for streamed archives, members are parsed as they arrive
+    for index, img in enumerate(metrics.iterate('enumerate', ds.file_list)):
+        name = getname(img)
+        if index < skip:
+            # Extracted before the handoff from Lambda
+            img.close()
+            continue
+        log.info(f'Processing {ds} - {name}')
+        if PARSE_EXECUTOR == 'process':
+            # Open file handles can not be sent to worker processes
+            data = io.BytesIO(img.read())
+            if hasattr(img, 'close'):
+                img.close()
+            img = data
+        elif workers > 1 and getattr(img, 'sequential', False):
+            # Streamed tar members are only readable until the archive advances
+            img.fill()
+        yield name, img
+
+
+def transform(dcm, member):
+    import utils.selection as selection
+    name, img = member
+    with metrics.span('dcmread', members=1) as s:
+        image = fastparse.dcmread(img) if fastparse.FAST_PARSE else None
+        if image is None:
+            image = selection.dcmread(img)
+        selection.remove_private_tags(image)
+        s.add(bytes=img.tell())
+    if hasattr(img, 'close'):
+        img.close()
     log.info(f'Flatten {name} structure')
-    dcm.append(name, img)
+    with metrics.span('transform', members=1):
+        return dcm.transform(name, image)
 
 
 def output(dcm):
-    log.debug(f'Convert data structure to dataframe')
-    df = pd.DataFrame.from_dict(dcm.img_list)
-    # Drop columns with all NONE Values
-    df.dropna(axis=1, how='all', inplace=True)
-    session = boto3.session.Session(region_name=S3_OUTPUT_BUCKET_REGION)
+    import utils.arrow as arrow
+    log.debug(f'Convert data structure to arrow table')
+    with metrics.span('table', rows=dcm.pending):
+        table = dedup.drop_seen(dcm.table())
+    if table.num_rows == 0:
+        log.info(f'All instances of {dcm} already extracted')
+        return {
+            "paths": [],
+            "partitions_values": {}
+        }
+    s3 = aws.get_client('s3', S3_OUTPUT_BUCKET_REGION)
+    # Truncate long string for tags
+    put_args = aws.put_args(aws.source_tagging(dcm.source_s3_bucket, dcm.source_s3_key))
+    filename = uuid.uuid4().hex
+    paths = []
+    partitions_values = {}
     try:
-        parquet = wr.s3.to_parquet(
-            df=df,
-            boto3_session=session,
-            path=f's3://{S3_OUTPUT_BUCKET}/',
-            compression='snappy',
-            dataset=True,
-            sanitize_columns=True,
-            s3_additional_kwargs={
-                'ServerSideEncryption': 'AES256',
-                # Truncate long string for tags
-                'Tagging': parse.urlencode({"S3_BUCKET": dcm.source_s3_bucket[-128:], "S3_KEY": dcm.source_s3_key[-256:]})
-            },
-            partition_cols={
-                PARTITION_COL,
-            },
-        )
+        table = arrow.sort(table, partitioning.sort_keys())
+        for prefix, values, part in arrow.partition(table, partitioning.fields()):
+            key = f'{prefix}/{filename}.snappy.parquet'
+            with metrics.span('output', rows=part.num_rows, requests=1) as s:
+                body = arrow.to_parquet(part)
+                s.add(bytes=len(body))
+                s3.put_object(Bucket=S3_OUTPUT_BUCKET, Key=key, Body=body, **put_args)
+            paths.append(f's3://{S3_OUTPUT_BUCKET}/{key}')
+            partitions_values[f's3://{S3_OUTPUT_BUCKET}/{prefix}/'] = values
+            dedup.record_instances(part, paths[-1])
+            for previous in dcm.manifests.values():
+                previous.record(part, paths[-1])
+        with metrics.span('aggregate', rows=table.num_rows):
+            aggregates.write(table)
+        parquet = {
+            "paths": paths,
+            "partitions_values": partitions_values
+        }
         log.info(f'Completed output, {parquet}')
         return parquet
     except Exception as e:
-        log.error(f'Unable to convert df to parquet')
+        log.error(f'Unable to convert table to parquet')
         log.error(e)
         raise
 
 
-def inspect(dcm, ds):
-    ds.get()
-    if len(ds.file_list) > 0:
-        try:
-            for img in ds.file_list:
-                name = getname(img)
-                log.info(f'Processing {ds} - {name}')
-                image = pydicom.dcmread(fp=img, stop_before_pixels=True)
-                image.remove_private_tags()
-                if hasattr(img, 'close'):
-                    img.close()
-                transform(name, image, dcm)
-            log.info(f'Completed Dicom Parsing {dcm}, found {dcm.size} files')
-            return output(dcm)
-        except pydicom.errors.InvalidDicomError as i:
-            log.error(f'Invalid Dicom file')
-            log.error(i)
-            raise
-        except Exception as e:
-            log.error(e)
-            raise
+def extract(dcm, ds, workers=PARSE_WORKERS, deadline=None, skip_members=0):
+    # Past the deadline (time.monotonic) the members parsed so far are kept in dcm.handoff
+    import pydicom
+    skip = None
+    if INCREMENTAL and ds.file_ext in ARCHIVE_FILE_EXT:
+        # Only members that are new or changed since the previous extraction are parsed
+        previous = manifest.load(dcm.source_s3_bucket, dcm.source_s3_key)
+        dcm.manifests[dcm.source_s3_key] = previous
+        skip = previous.unchanged
+    ds.get(skip=skip)
+    try:
+        # Rows are returned in member order regardless of the number of workers
+        parsed = skip_members
+        for flat in ordered_map(partial(transform, dcm.clone()), members(ds, skip_members, workers),
+                                workers=workers, max_inflight=max(PARSE_MAX_INFLIGHT, workers * 2),
+                                executor=PARSE_EXECUTOR):
+            dcm.add(flat)
+            parsed += 1
+            if deadline is not None and time.monotonic() > deadline:
+                log.info(f'Stop {dcm} after {parsed} members, hand off the remaining members to AWS Batch')
+                dcm.handoff = parsed
+                break
+    except pydicom.errors.InvalidDicomError as i:
+        log.error(f'Invalid Dicom file')
+        log.error(i)
+        raise
+    except Exception as e:
+        log.error(e)
+        raise
+    if dcm.size > 0:
+        log.info(f'Completed Dicom Parsing {dcm}, found {dcm.size} files')
+    else:
+        log.info(f'No file found in {ds}, file ext: {ds.file_ext}')
+    return dcm
+
+
+def inspect(dcm, ds, checkpoint=None):
+    skip_members = 0
+    if checkpoint is not None:
+        skip_members = checkpoint['members']
+        dcm.paths.extend(checkpoint['paths'])
+    extract(dcm, ds, skip_members=skip_members)
+    dcm.flush()
+    if checkpoint is not None:
+        router.resume(dcm, checkpoint)
+    dcm.commit()
+    if dcm.size > 0 or dcm.paths:
+        return {
+            "paths": dcm.paths
+        }
     else:
         return{
             "paths": f'No file found, file ext: {ds.file_ext}'
         }
 
-# Start AWS Lambda Function
 
+def submit_batch(dcm, checkpoint=None):
+    job_name = re.sub(r'\W+', '', dcm.source_s3_key[:128])
+    log.info(
+        f'Submit {dcm} to AWS BATCH Queue: {AWS_BATCH_QUEUE} JobName: {job_name}')
+    try:
+        batch = aws.get_client('batch')
+        environment = [{'name': name, 'value': os.environ[name]} for name in EXTRACTION_SETTINGS if name in os.environ]
+        if checkpoint:
+            environment.append({'name': 'CHECKPOINT', 'value': checkpoint})
+        result = batch.submit_job(
+            jobName=job_name,
+            jobQueue=AWS_BATCH_QUEUE,
+            jobDefinition=AWS_BATCH_DEFINITION,
+            containerOverrides={
+                'environment': [
+                    {
+                        'name': 'S3_BUCKET',
+                        'value': dcm.source_s3_bucket
+                    },
+                    {
+                        'name': 'S3_KEY',
+                        'value': dcm.source_s3_key
+                    },
+                    {
+                        'name': 'OBJ_SIZE',
+                        'value': str(dcm.source_s3_size)
+                    },
+                    {
+                        'name': 'OBJ_ETAG',
+                        'value': dcm.source_s3_etag or ''
+                    },
+                    {
+                        'name': 'S3_REGION',
+                        'value': dcm.source_s3_bucket_region
+                    },
+                    {
+                        'name': 'GLUE_TABLE_NAME',
+                        'value': GLUE_TABLE_NAME
+                    },
+                    {
+                        'name': 'GLUE_DATABASE_NAME',
+                        'value': GLUE_DATABASE_NAME
+                    },
+                    {
+                        'name': 'S3_OUTPUT_BUCKET',
+                        'value': S3_OUTPUT_BUCKET
+                    },
+                    {
+                        'name': 'S3_OUTPUT_BUCKET_REGION',
+                        'value': S3_OUTPUT_BUCKET_REGION
+                    },
 
-def lambda_handler(event, context):
+                    {
+                        'name': 'LOGLEVEL',
+                        'value': logging.getLevelName(log.level)
+                    },
 
-    log.debug('Running in Lambda Function')
-    log.debug(json.dumps(event))
-    S3_BUCKET = event['Records'][0]['s3']['bucket']['name']
-    S3_KEY = event['Records'][0]['s3']['object']['key']
-    S3_REGION = event['Records'][0]['awsRegion']
-    OBJ_SIZE = event['Records'][0]['s3']['object']['size']
-    dcm = dcmfile(source_s3_bucket=S3_BUCKET, source_s3_bucket_region=S3_REGION,
-                  source_s3_key=S3_KEY, source_s3_size=OBJ_SIZE)
-    ds = s3file(s3bucket=dcm.source_s3_bucket, s3key=dcm.source_s3_key,
-                s3region=dcm.source_s3_bucket_region, size=dcm.source_s3_size)
-    ds.eval_ext()
+                ] + environment
+            }
+
+        )
+        log.info(
+            f'Forwarded request to AWS Batch {dcm}, JOB_ARN: {result["jobArn"]}')
+        return result["jobArn"]
+    except Exception as e:
+        log.error(e)
+        raise
+
+
+def get_records(event):
+    # S3 notifications arrive directly or wrapped in the body of SQS messages
+    records = []
+    for record in event['Records']:
+        if record.get('eventSource') == 'aws:sqs':
+            body = json.loads(record['body'])
+            # s3:TestEvent messages do not carry any Records
+            for s3_record in body.get('Records', []):
+                s3_record['messageId'] = record['messageId']
+                records.append(s3_record)
+        else:
+            records.append(record)
+    return records
+
+
+def process_record(record, deadline=None):
+    S3_BUCKET = record['s3']['bucket']['name']
+    S3_KEY = record['s3']['object']['key']
+    S3_REGION = record['awsRegion']
+    OBJ_SIZE = record['s3']['object']['size']
+    OBJ_ETAG = record['s3']['object'].get('eTag')
     if (S3_BUCKET is None or S3_KEY is None or S3_REGION is None or OBJ_SIZE is None):
         log.error(f'Empty S3 input values; S3_BUCKET={S3_BUCKET}, \
             S3_KEY={S3_KEY}, S3_REGION={S3_REGION}')
@@ -114,78 +290,96 @@ def lambda_handler(event, context):
     else:
         log.info(
             f'S3 input values; S3_BUCKET={S3_BUCKET}, S3_KEY={S3_KEY}, S3_REGION={S3_REGION} FileSize={OBJ_SIZE}')
-    # DCM files can be processed on Lambda by downloading the first 10 MB to process only
-    if OBJ_SIZE > (MAX_LAMBDA_SIZE * 1024 * 1024) and ds.file_ext != '.dcm':
-        job_name = re.sub(r'\W+', '', S3_KEY[:128])
-        log.info(
-            f'Filesize greater than {MAX_LAMBDA_SIZE}MB, submit to AWS BATCH Queue: {AWS_BATCH_QUEUE} JobName: {job_name}')
+    dcm = dcmfile(source_s3_bucket=S3_BUCKET, source_s3_bucket_region=S3_REGION,
+                  source_s3_key=S3_KEY, source_s3_size=OBJ_SIZE, sink=output, source_s3_etag=OBJ_ETAG)
+    if dedup.is_processed(S3_BUCKET, S3_KEY, OBJ_ETAG):
+        log.info(f'Skip {dcm}, ETag {OBJ_ETAG} already extracted')
+        return dcm
+    ds = s3file(s3bucket=dcm.source_s3_bucket, s3key=dcm.source_s3_key,
+                s3region=dcm.source_s3_bucket_region, size=dcm.source_s3_size)
+    ds.eval_ext()
+    # DCM files are always processed on Lambda, only the header is fetched
+    if ds.file_ext not in ARCHIVE_FILE_EXT:
+        return extract(dcm, ds)
+    budget = deadline - time.monotonic() if deadline is not None else router.LAMBDA_TIMEOUT
+    target, workers = router.plan(ds, budget, workers=PARSE_WORKERS)
+    if target == 'batch':
+        return submit_batch(dcm)
+    extract(dcm, ds, workers=workers, deadline=deadline)
+    if dcm.handoff is not None:
+        # Rows of the parsed members are written now, the Batch job starts after them
+        dcm.flush()
+        return submit_batch(dcm, checkpoint=router.save_checkpoint(dcm, dcm.handoff))
+    return dcm
+
+
+def combine(dcm_list):
+    # Single dataset write for all records, tagged with the shared bucket and key prefix
+    buckets = {dcm.source_s3_bucket for dcm in dcm_list}
+    combined = dcmfile(source_s3_bucket=buckets.pop() if len(buckets) == 1 else '',
+                       source_s3_bucket_region=dcm_list[0].source_s3_bucket_region,
+                       source_s3_key=os.path.commonprefix([dcm.source_s3_key for dcm in dcm_list]), sink=output)
+    for dcm in dcm_list:
+        combined.extend(dcm)
+    return combined
+
+# Start AWS Lambda Function
+
+
+def lambda_handler(event, context):
+
+    log.debug('Running in Lambda Function')
+    log.debug(json.dumps(event))
+    records = get_records(event)
+    log.info(f'Received {len(records)} records')
+    deadline = router.deadline(context)
+    with ThreadPoolExecutor(max_workers=max(1, min(BATCH_MAX_WORKERS, len(records)))) as executor:
+        futures = [executor.submit(process_record, record, deadline) for record in records]
+    extracted = []
+    forwarded = []
+    failed = []
+    for record, future in zip(records, futures):
         try:
-            batch = boto3.client('batch')
-            result = batch.submit_job(
-                jobName=job_name,
-                jobQueue=AWS_BATCH_QUEUE,
-                jobDefinition=AWS_BATCH_DEFINITION,
-                containerOverrides={
-                    'environment': [
-                        {
-                            'name': 'S3_BUCKET',
-                            'value': S3_BUCKET
-                        },
-                        {
-                            'name': 'S3_KEY',
-                            'value': S3_KEY
-                        },
-                        {
-                            'name': 'OBJ_SIZE',
-                            'value': str(OBJ_SIZE)
-                        },
-                        {
-                            'name': 'S3_REGION',
-                            'value': S3_REGION
-                        },
-                        {
-                            'name': 'GLUE_TABLE_NAME',
-                            'value': GLUE_TABLE_NAME
-                        },
-                        {
-                            'name': 'GLUE_DATABASE_NAME',
-                            'value': GLUE_DATABASE_NAME
-                        },
-                        {
-                            'name': 'S3_OUTPUT_BUCKET',
-                            'value': S3_OUTPUT_BUCKET
-                        },
-                        {
-                            'name': 'S3_OUTPUT_BUCKET_REGION',
-                            'value': S3_OUTPUT_BUCKET_REGION
-                        },
-
-                        {
-                            'name': 'LOGLEVEL',
-                            'value': logging.getLevelName(log.level)
-                        },
-                        {
-                            'name': 'PARTITION_COL',
-                            'value': PARTITION_COL
-                        },
-
-                    ]
-                }
-
-            )
-            log.info(
-                f'Forwarded request to AWS Batch {dcm}, JOB_ARN: {result["jobArn"]}')
-            return {
-                'code': 200,
-                'message': f'Forwarded request to AWS Batch {dcm}, JOB_ARN: {result["jobArn"]}'
-            }
+            result = future.result()
         except Exception as e:
+            log.error(f'Unable to process record {record["s3"]["object"]["key"]}')
             log.error(e)
-            raise
-    output_location = inspect(dcm, ds)
+            failed.append(record)
+            continue
+        if isinstance(result, dcmfile):
+            extracted.append((record, result))
+        else:
+            forwarded.append(result)
+    dcm_list = [dcm for _, dcm in extracted if dcm.size > 0]
+    output_location = {"paths": []}
+    if len(dcm_list) > 0:
+        try:
+            combined = combine(dcm_list)
+            combined.flush()
+            output_location = {"paths": combined.paths}
+        except Exception:
+            log.exception(f'Unable to write the rows of {len(extracted)} records')
+            failed.extend(record for record, _ in extracted)
+            extracted = []
+    for _, dcm in extracted:
+        dcm.commit()
+        if dcm.size > 0:
+            dedup.mark_processed(dcm.source_s3_bucket, dcm.source_s3_key,
+                                 dcm.source_s3_etag, output_location["paths"])
+    # Partial batch response, only the failed SQS messages are retried
+    failures = []
+    for record in failed:
+        if 'messageId' not in record:
+            raise Exception(f'Failed to process {len(failed)} of {len(records)} records')
+        if {'itemIdentifier': record['messageId']} not in failures:
+            failures.append({'itemIdentifier': record['messageId']})
+    log.info(
+        f'Completed {len(extracted)} records, forwarded {len(forwarded)} records to AWS Batch, failed {len(failed)} records')
+    router.observe(metrics.flush(Records=len(records), Failed=len(failed)))
     return {
         'code': 200,
-        'message': f'Completed job INPUT {dcm}, OUTPUT {output_location["paths"]}'
+        'message': f'Completed job INPUT {[str(dcm) for _, dcm in extracted]}, OUTPUT {output_location["paths"]}, JOB_ARN: {forwarded}',
+        'batchItemFailures': failures
     }
 
 
@@ -203,10 +397,19 @@ if __name__ == '__main__':
         log.info(
             f'S3 input values; S3_BUCKET={S3_BUCKET}, S3_KEY={S3_KEY}, S3_REGION={S3_REGION} OBJ_SIZE={OBJ_SIZE}')
     dcm = dcmfile(source_s3_bucket=S3_BUCKET, source_s3_bucket_region=S3_REGION,
-                  source_s3_key=S3_KEY, source_s3_size=OBJ_SIZE)
-    ds = s3file(s3bucket=dcm.source_s3_bucket, s3key=dcm.source_s3_key,
-                s3region=dcm.source_s3_bucket_region, size=dcm.source_s3_size)
-    ds.eval_ext()
-    output_location = inspect(dcm, ds)
+                  source_s3_key=S3_KEY, source_s3_size=OBJ_SIZE, sink=output, source_s3_etag=OBJ_ETAG)
+    if dedup.is_processed(S3_BUCKET, S3_KEY, OBJ_ETAG):
+        log.info(f'Skip {dcm}, ETag {OBJ_ETAG} already extracted')
+        output_location = {"paths": []}
+    else:
+        ds = s3file(s3bucket=dcm.source_s3_bucket, s3key=dcm.source_s3_key,
+                    s3region=dcm.source_s3_bucket_region, size=dcm.source_s3_size)
+        ds.eval_ext()
+        checkpoint = router.load_checkpoint(CHECKPOINT) if CHECKPOINT else None
+        output_location = inspect(dcm, ds, checkpoint=checkpoint)
+        dedup.mark_processed(S3_BUCKET, S3_KEY, OBJ_ETAG, output_location["paths"])
+        if CHECKPOINT:
+            router.delete_checkpoint(CHECKPOINT)
     log.info(
         f'Completed job INPUT s3://{S3_REGION}/{S3_BUCKET}/{S3_KEY}, OUTPUT {output_location["paths"]}')
+    metrics.flush(S3Key=S3_KEY)
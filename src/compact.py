@@ -0,0 +1,269 @@
+import io
+import os
+import json
+import uuid
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import fs
+from utils.arrow import sort
+import aggregates
+import dedup
+import manifest
+import utils.aws as aws
+from utils.partitioning import sort_keys as default_sort_keys
+from utils.utils import str2bool
+from logger import get_logger
+
+S3_OUTPUT_BUCKET = os.environ.get('S3_OUTPUT_BUCKET', None)
+# Dataset root, s3://bucket/ or a local directory
+COMPACT_PATH = os.environ.get('COMPACT_PATH', f's3://{S3_OUTPUT_BUCKET}/')
+# Comma separated partition paths relative to the root e.g. study_date=2021-11-03, all partitions if empty
+COMPACT_PARTITIONS = os.environ.get('COMPACT_PARTITIONS', '')
+TARGET_FILE_SIZE = int(os.environ.get('TARGET_FILE_SIZE', 256)) * 1024 * 1024
+ROW_GROUP_SIZE = int(os.environ.get('ROW_GROUP_SIZE', 100000))
+TOMBSTONE_PREFIX = os.environ.get('TOMBSTONE_PREFIX', '_tombstones/')
+# Manifests of incremental extraction are moved to the merged files
+INCREMENTAL = str2bool(os.environ.get('INCREMENTAL', False))
+log = get_logger(__name__)
+
+
+def is_data_file(info):
+    # Hive and Athena ignore files starting with _ or .
+    return info.type == fs.FileType.File and info.base_name.endswith('.parquet') and info.base_name[0] not in '_.'
+
+
+def partitions(filesystem, root):
+    # Directories holding data files at any partition depth, relative to root
+    found = set()
+    for info in filesystem.get_file_info(fs.FileSelector(root, recursive=True)):
+        if is_data_file(info):
+            partition = os.path.dirname(info.path)[len(root):].strip('/')
+            # _tombstones/ and other hidden directories are not partitions
+            if not any(part[:1] in ('_', '.') for part in partition.split('/')):
+                found.add(partition)
+    return sorted(found)
+
+
+def plan(files, target_size, rewrite=()):
+    # Bin pack small files in name order, files already at the target size are left alone unless they must be rewritten
+    groups = []
+    group = []
+    group_size = 0
+    for info in sorted(files, key=lambda info: info.path):
+        if info.size >= target_size and info.path not in rewrite:
+            continue
+        if group and group_size + info.size > target_size:
+            groups.append(group)
+            group = []
+            group_size = 0
+        group.append(info)
+        group_size += info.size
+    if group:
+        groups.append(group)
+    return [group for group in groups if len(group) > 1 or group[0].path in rewrite]
+
+
+def load_tombstones(filesystem, path):
+    # Rows of replaced archive members by output file, written by incremental extraction
+    tombstones = {}
+    if filesystem.get_file_info(path).type != fs.FileType.Directory:
+        return tombstones
+    for info in filesystem.get_file_info(fs.FileSelector(path)):
+        if info.type != fs.FileType.File or not info.base_name.endswith('.parquet'):
+            continue
+        table = pq.read_table(info.path, filesystem=filesystem,
+                              columns=['output_path', 'source_s3_key', 'source_s3_archive_path'])
+        for output_path, key, name in zip(*(column.to_pylist() for column in table.columns)):
+            # Output paths are URIs, the filesystem uses paths without scheme
+            tombstones.setdefault(output_path.split('://', 1)[-1], set()).add((key, name))
+    return tombstones
+
+
+def drop_tombstoned(table, tombstoned):
+    if not tombstoned or 'source_s3_key' not in table.column_names or 'source_s3_archive_path' not in table.column_names:
+        return table
+    keys = table.column('source_s3_key').to_pylist()
+    names = table.column('source_s3_archive_path').to_pylist()
+    keep = [(key, name) not in tombstoned for key, name in zip(keys, names)]
+    log.info(f'Drop {keep.count(False)} tombstoned rows')
+    return table.filter(pa.array(keep))
+
+
+def read(filesystem, info, tombstones):
+    return drop_tombstoned(pq.read_table(info.path, filesystem=filesystem), tombstones.get(info.path))
+
+
+def unify(tables):
+    # Files of one partition may hold different tag columns, missing columns are null
+    schema = pa.unify_schemas([table.schema for table in tables])
+    unified = []
+    for table in tables:
+        for field in schema:
+            if field.name not in table.column_names:
+                table = table.append_column(field, pa.nulls(len(table), type=field.type))
+        unified.append(table.select(schema.names).cast(schema))
+    return pa.concat_tables(unified)
+
+
+def source_tagging(table):
+    # app.output tags each file with its archive, compacted files with the common source of their rows
+    if 'source_s3_bucket' not in table.column_names or 'source_s3_key' not in table.column_names:
+        return None
+    buckets = [bucket for bucket in table.column('source_s3_bucket').unique().to_pylist() if bucket]
+    keys = [key for key in table.column('source_s3_key').unique().to_pylist() if key]
+    return aws.source_tagging(os.path.commonprefix(buckets), os.path.commonprefix(keys))
+
+
+def split(path):
+    bucket, key = path.split('/', 1)
+    return bucket, key
+
+
+def write_file(filesystem, path, body, tagging=None):
+    # The pyarrow S3 filesystem can not set encryption or tags, S3 objects are put like app.output does
+    if filesystem.type_name == 's3':
+        bucket, key = split(path)
+        aws.get_client('s3', filesystem.region).put_object(Bucket=bucket, Key=key, Body=body,
+                                                           **aws.put_args(tagging))
+        return
+    with filesystem.open_output_stream(path) as f:
+        f.write(body)
+
+
+def write_table(filesystem, path, table):
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='snappy', row_group_size=ROW_GROUP_SIZE)
+    write_file(filesystem, path, buffer.getvalue(), source_tagging(table))
+
+
+def move(filesystem, source, destination):
+    # Copies keep the tags of the staged object and are encrypted like it
+    if filesystem.type_name == 's3':
+        bucket, key = split(source)
+        destination_bucket, destination_key = split(destination)
+        s3 = aws.get_client('s3', filesystem.region)
+        s3.copy_object(Bucket=destination_bucket, Key=destination_key, CopySource={'Bucket': bucket, 'Key': key},
+                       ServerSideEncryption='AES256', TaggingDirective='COPY')
+        s3.delete_object(Bucket=bucket, Key=key)
+        return
+    filesystem.move(source, destination)
+
+
+def write_journal(filesystem, path, journal):
+    write_file(filesystem, path, json.dumps(journal).encode('utf-8'))
+
+
+def relocate(filesystem, journal):
+    # Manifests and the dedup index name the output file of each member, point them to the merged file
+    if filesystem.type_name != 's3':
+        return
+    columns = ['source_s3_bucket', 'source_s3_key']
+    schema = pq.read_schema(journal['output'], filesystem=filesystem)
+    if not all(column in schema.names for column in columns):
+        return
+    if dedup.INSTANCE_COLUMN in schema.names:
+        columns.append(dedup.INSTANCE_COLUMN)
+    table = pq.read_table(journal['output'], filesystem=filesystem, columns=columns)
+    moved = {path: f's3://{journal["output"]}' for path in journal['inputs']}
+    if INCREMENTAL:
+        sources = set(zip(table.column('source_s3_bucket').to_pylist(), table.column('source_s3_key').to_pylist()))
+        for bucket, key in sorted(sources):
+            manifest.relocate(bucket, key, moved)
+    if dedup.INSTANCE_COLUMN in columns:
+        dedup.relocate_instances([uid for uid in table.column(dedup.INSTANCE_COLUMN).unique().to_pylist() if uid],
+                                 moved)
+
+
+def publish(filesystem, journal_path):
+    # Idempotent swap: move the staged file in place, then remove the inputs and the journal
+    with filesystem.open_input_stream(journal_path) as f:
+        journal = json.loads(f.read())
+    if filesystem.get_file_info(journal['staged']).type == fs.FileType.File:
+        move(filesystem, journal['staged'], journal['output'])
+    relocate(filesystem, journal)
+    for path in journal['inputs']:
+        if filesystem.get_file_info(path).type == fs.FileType.File:
+            filesystem.delete_file(path)
+    filesystem.delete_file(journal_path)
+    log.info(f'Published {journal["output"]}, removed {len(journal["inputs"])} files')
+
+
+def recover(filesystem, partition_path):
+    # Complete swaps of a previous run interrupted after staging
+    for info in filesystem.get_file_info(fs.FileSelector(partition_path)):
+        if info.base_name.startswith('_compaction-') and info.base_name.endswith('.json'):
+            log.info(f'Recover interrupted compaction {info.path}')
+            publish(filesystem, info.path)
+
+
+def compact_partition(filesystem, partition_path, target_size=TARGET_FILE_SIZE, sort_keys=None, tombstones=None):
+    sort_keys = sort_keys if sort_keys is not None else default_sort_keys()
+    tombstones = tombstones or {}
+    recover(filesystem, partition_path)
+    files = [info for info in filesystem.get_file_info(fs.FileSelector(partition_path)) if is_data_file(info)]
+    outputs = []
+    for group in plan(files, target_size, rewrite=tombstones):
+        name = uuid.uuid4().hex
+        table = sort(unify([read(filesystem, info, tombstones) for info in group]), sort_keys)
+        journal = {
+            'inputs': [info.path for info in group],
+            'staged': f'{partition_path}/_staged-{name}.snappy.parquet',
+            'output': f'{partition_path}/{name}.snappy.parquet',
+        }
+        log.info(f'Compact {len(group)} files with {table.num_rows} rows to {journal["output"]}')
+        write_table(filesystem, journal['staged'], table)
+        journal_path = f'{partition_path}/_compaction-{name}.json'
+        write_journal(filesystem, journal_path, journal)
+        publish(filesystem, journal_path)
+        outputs.append(journal['output'])
+    return outputs
+
+
+def compact_aggregates(filesystem, root):
+    # Partial aggregates of every write are merged to one row per study and series
+    outputs = []
+    for level in aggregates.LEVELS:
+        path = f'{root}/{aggregates.AGGREGATE_PREFIX}{level}'
+        if filesystem.get_file_info(path).type != fs.FileType.Directory:
+            continue
+        recover(filesystem, path)
+        files = [info for info in filesystem.get_file_info(fs.FileSelector(path)) if is_data_file(info)]
+        if len(files) < 2:
+            continue
+        name = uuid.uuid4().hex
+        table = aggregates.combine(unify([pq.read_table(info.path, filesystem=filesystem) for info in files]), level)
+        table = sort(table, aggregates.LEVELS[level])
+        journal = {
+            'inputs': [info.path for info in files],
+            'staged': f'{path}/_staged-{name}.snappy.parquet',
+            'output': f'{path}/{name}.snappy.parquet',
+        }
+        log.info(f'Merge {len(files)} {level} aggregate files to {table.num_rows} rows in {journal["output"]}')
+        write_table(filesystem, journal['staged'], table)
+        journal_path = f'{path}/_compaction-{name}.json'
+        write_journal(filesystem, journal_path, journal)
+        publish(filesystem, journal_path)
+        outputs.append(journal['output'])
+    return outputs
+
+
+def compact(uri=COMPACT_PATH, partition_list=None):
+    filesystem, root = fs.FileSystem.from_uri(uri)
+    root = root.rstrip('/')
+    partition_list = partition_list if partition_list is not None else [
+        partition for partition in COMPACT_PARTITIONS.split(',') if partition]
+    if not partition_list:
+        partition_list = partitions(filesystem, root)
+    tombstones = load_tombstones(filesystem, f'{root}/{TOMBSTONE_PREFIX}'.rstrip('/'))
+    outputs = []
+    for partition in partition_list:
+        log.info(f'Compact partition {partition} of {uri}')
+        outputs.extend(compact_partition(filesystem, f'{root}/{partition}', tombstones=tombstones))
+    outputs.extend(compact_aggregates(filesystem, root))
+    return outputs
+
+
+# Start AWS Batch
+if __name__ == '__main__':
+    outputs = compact()
+    log.info(f'Completed compaction of {COMPACT_PATH}, OUTPUT {outputs}')
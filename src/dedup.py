@@ -0,0 +1,214 @@
+import os
+import json
+import sqlite3
+import threading
+import functools
+import utils.aws as aws
+from logger import get_logger
+
+# none, sqlite or dynamodb
+DEDUP_BACKEND = os.environ.get('DEDUP_BACKEND', 'none').lower()
+DEDUP_SQLITE_PATH = os.environ.get('DEDUP_SQLITE_PATH', '/tmp/dicom-dedup.sqlite')
+DEDUP_TABLE = os.environ.get('DEDUP_TABLE', 'dicom-dedup')
+DEDUP_REGION = os.environ.get('DEDUP_REGION', None)
+
+# Sanitized name of SOPInstanceUID in the output tables
+INSTANCE_COLUMN = 'sopinstance_uid'
+
+log = get_logger(__name__)
+
+
+def object_key(bucket, key, etag):
+    return f'OBJECT#{bucket}/{key}#{etag}'
+
+
+def instance_key(uid):
+    return f'INSTANCE#{uid}'
+
+
+class sqliteindex():
+    def __init__(self, path=DEDUP_SQLITE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS dedup (pk TEXT PRIMARY KEY, location TEXT)')
+
+    def __repr__(self):
+        return f'sqlite://{self.path}'
+
+    def get(self, keys):
+        found = {}
+        with self.lock:
+            # Stay below the sqlite limit of host parameters per statement
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self.connection.execute(
+                    f'SELECT pk, location FROM dedup WHERE pk IN ({",".join("?" * len(chunk))})', chunk)
+                found.update(rows)
+        return found
+
+    def put(self, items):
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO dedup VALUES (?, ?)', items.items())
+
+    def delete(self, keys):
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM dedup WHERE pk = ?', [(key,) for key in keys])
+
+
+class dynamodbindex():
+    def __init__(self, table=DEDUP_TABLE, region=DEDUP_REGION):
+        self.table = table
+        self.client = aws.get_client('dynamodb', region)
+
+    def __repr__(self):
+        return f'dynamodb://{self.table}'
+
+    def get(self, keys):
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        # BatchGetItem accepts at most 100 keys per request
+        for i in range(0, len(keys), 100):
+            request = {self.table: {'Keys': [{'pk': {'S': key}} for key in keys[i:i + 100]]}}
+            while request:
+                response = self.client.batch_get_item(RequestItems=request)
+                for item in response['Responses'].get(self.table, []):
+                    found[item['pk']['S']] = item['location']['S']
+                request = response.get('UnprocessedKeys')
+        return found
+
+    def write(self, requests):
+        # BatchWriteItem accepts at most 25 requests
+        for i in range(0, len(requests), 25):
+            request = {self.table: requests[i:i + 25]}
+            while request:
+                request = self.client.batch_write_item(RequestItems=request).get('UnprocessedItems')
+
+    def put(self, items):
+        self.write([{'PutRequest': {'Item': {'pk': {'S': key}, 'location': {'S': location}}}}
+                    for key, location in items.items()])
+
+    def delete(self, keys):
+        self.write([{'DeleteRequest': {'Key': {'pk': {'S': key}}}} for key in dict.fromkeys(keys)])
+
+
+@functools.lru_cache(maxsize=None)
+def get_index():
+    if DEDUP_BACKEND == 'sqlite':
+        index = sqliteindex()
+    elif DEDUP_BACKEND == 'dynamodb':
+        index = dynamodbindex()
+    elif DEDUP_BACKEND in ('', 'none'):
+        return None
+    else:
+        raise Exception(f'{DEDUP_BACKEND} dedup backend not supported')
+    log.info(f'Using dedup index {index}')
+    return index
+
+
+def is_processed(bucket, key, etag):
+    index = get_index()
+    if index is None or not etag:
+        return False
+    return object_key(bucket, key, etag) in index.get([object_key(bucket, key, etag)])
+
+
+def mark_processed(bucket, key, etag, paths):
+    index = get_index()
+    if index is not None and etag:
+        index.put({object_key(bucket, key, etag): json.dumps(paths)})
+
+
+def instance_entry(location):
+    # Entries written before the source object was recorded only hold the output file
+    if location.startswith('{'):
+        return json.loads(location)
+    return {'path': location, 'source': None}
+
+
+def sources(table):
+    # Source object of every row as bucket/key
+    if 'source_s3_bucket' not in table.column_names or 'source_s3_key' not in table.column_names:
+        return [None] * table.num_rows
+    return [f'{bucket}/{key}' for bucket, key in zip(table.column('source_s3_bucket').to_pylist(),
+                                                     table.column('source_s3_key').to_pylist())]
+
+
+def seen_instances(uids):
+    # SOPInstanceUIDs already written, mapped to their output file and source object
+    index = get_index()
+    if index is None or not uids:
+        return {}
+    found = index.get([instance_key(uid) for uid in uids])
+    return {key[len('INSTANCE#'):]: instance_entry(location) for key, location in found.items()}
+
+
+def record_instances(table, path, column=INSTANCE_COLUMN):
+    # Rows the same source object wrote before, e.g. under a previous ETag, are replaced by the rows in path
+    index = get_index()
+    if index is None or column not in table.column_names:
+        return
+    uids = table.column(column).to_pylist()
+    if 'source_s3_archive_path' in table.column_names:
+        names = table.column('source_s3_archive_path').to_pylist()
+    else:
+        names = [None] * table.num_rows
+    previous = seen_instances([uid for uid in set(uids) if uid])
+    entries = {}
+    replaced = {}
+    for uid, source, name in zip(uids, sources(table), names):
+        if not uid:
+            continue
+        entry = previous.get(uid)
+        if entry is not None and entry['source'] == source and entry['path'] != path:
+            replaced.setdefault(source, {})[name] = {'path': entry['path'], 'uid': uid}
+        entries[uid] = {'path': path, 'source': source}
+    index.put({instance_key(uid): json.dumps(entry) for uid, entry in entries.items()})
+    if replaced:
+        import manifest
+        for source, stale in replaced.items():
+            bucket, key = source.split('/', 1)
+            manifest.write_tombstones(manifest.manifest(bucket, key), stale)
+
+
+def relocate_instances(uids, moved):
+    # Instances merged by compaction are now in the merged file
+    relocated = {}
+    for uid, entry in seen_instances(uids).items():
+        if entry['path'].split('://', 1)[-1] in moved:
+            relocated[uid] = dict(entry, path=moved[entry['path'].split('://', 1)[-1]])
+    index = get_index()
+    if index is not None and relocated:
+        index.put({instance_key(uid): json.dumps(entry) for uid, entry in relocated.items()})
+
+
+def forget_instances(uids):
+    # Instances of replaced archive members must be written again
+    index = get_index()
+    if index is not None and uids:
+        index.delete([instance_key(uid) for uid in uids])
+
+
+def drop_seen(table, column=INSTANCE_COLUMN):
+    # Skip instances already written by another object or earlier in the same table,
+    # rows of the object that wrote them are extracted again and replace them
+    if get_index() is None or column not in table.column_names:
+        return table
+    uids = table.column(column).to_pylist()
+    seen = seen_instances([uid for uid in set(uids) if uid])
+    written = set()
+    keep = []
+    for uid, source in zip(uids, sources(table)):
+        if not uid:
+            keep.append(True)
+        elif uid in written or (uid in seen and (seen[uid]['source'] is None or seen[uid]['source'] != source)):
+            keep.append(False)
+        else:
+            keep.append(True)
+            written.add(uid)
+    if all(keep):
+        return table
+    import pyarrow as pa
+    log.info(f'Skip {keep.count(False)} instances already extracted')
+    return table.filter(pa.array(keep))
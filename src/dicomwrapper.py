@@ -1,25 +1,35 @@
 from logger import get_logger
 import os
-import datetime
-import utils.utils as utils
-import utils.tags as tags
+import logging
+import utils.partitioning as partitioning
 
-PARTITION_COL = os.environ.get('PARTITION_COL', 'study_date')
+FLUSH_ROWS = int(os.environ.get('FLUSH_ROWS', 1000))
 
 log = get_logger(__name__)
 
 
 class dcmfile():
-    def __init__(self, source_s3_bucket=None, source_s3_bucket_region=None, source_s3_key=None, source_s3_size=0):
-        self.img_list = []
+    def __init__(self, source_s3_bucket=None, source_s3_bucket_region=None, source_s3_key=None, source_s3_size=0, sink=None,
+                 source_s3_etag=None):
+        # Columns of the rows not yet written, flushed to sink every FLUSH_ROWS rows to keep memory bounded
+        self.columns = {}
+        self.pending = 0
+        self.count = 0
+        self.paths = []
+        self.sink = sink
+        # Archive manifests by source key, updated with the output file of every written member
+        self.manifests = {}
+        # Members parsed when a Lambda run stopped to hand the rest off to AWS Batch
+        self.handoff = None
         self.source_s3_bucket = source_s3_bucket
         self.source_s3_bucket_region = source_s3_bucket_region
         self.source_s3_key = source_s3_key
         self.source_s3_size = source_s3_size
+        self.source_s3_etag = source_s3_etag
 
     @property
     def size(self):
-        return len(self.img_list)
+        return self.count
 
     def __repr__(self):
         return f's3://{self.source_s3_bucket_region}/{self.source_s3_bucket}/{self.source_s3_key}'
@@ -29,42 +39,123 @@ class dcmfile():
         self.source_s3_bucket_region = source_s3_bucket_region
         self.source_s3_key = source_s3_key
 
+    def clone(self):
+        # Same source without rows, cheap to send to worker processes
+        return dcmfile(source_s3_bucket=self.source_s3_bucket, source_s3_bucket_region=self.source_s3_bucket_region,
+                       source_s3_key=self.source_s3_key, source_s3_size=self.source_s3_size,
+                       source_s3_etag=self.source_s3_etag)
+
+    def add(self, flat):
+        for key, value in flat.items():
+            column = self.columns.get(key)
+            if column is None:
+                column = self.columns[key] = [None] * self.pending
+            column.append(value)
+        self.pending += 1
+        self.count += 1
+        self.pad()
+        if self.sink is not None and self.pending >= FLUSH_ROWS:
+            self.flush()
+
+    def pad(self):
+        # Tags missing from a row are null
+        for column in self.columns.values():
+            if len(column) < self.pending:
+                column.extend([None] * (self.pending - len(column)))
+
+    def table(self):
+        import utils.arrow as arrow
+        return arrow.to_table(self.columns)
+
+    def flush(self):
+        if self.sink is not None and self.pending > 0:
+            log.debug(f'Flush {self.pending} rows of {self}')
+            result = self.sink(self)
+            self.paths.extend(result['paths'])
+            self.columns = {}
+            self.pending = 0
+
+    def commit(self):
+        # Called once all rows are written
+        for previous in self.manifests.values():
+            previous.commit()
+
     def append(self, name, img):
         flat = self.transform(name, img)
-        self.img_list.append(flat)
+        self.add(flat)
+
+    def extend(self, other):
+        # Takes the pending rows of other, rows already flushed are only referenced by path
+        for key, values in other.columns.items():
+            column = self.columns.get(key)
+            if column is None:
+                column = self.columns[key] = [None] * self.pending
+            column.extend(values)
+        self.pending += other.pending
+        self.count += other.pending
+        self.paths.extend(other.paths)
+        self.manifests.update(other.manifests)
+        self.pad()
 
     def transform(self, name, img):
         # Full list of keywords https://github.com/pydicom/pydicom/blob/master/pydicom/_dicom_dict.py
-        log.debug(f'Flattening {name} to dataset')
+        # Per tag lines are only formatted at DEBUG, other levels get one summary line per file
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug(f'Flattening {name} to dataset')
+        import utils.selection as selection
+        import utils.tags as tags
+        selected = selection.selected_set()
         element = {}
-        for elem in img:
+        empty = 0
+        unknown = 0
+        deferred = 0
+        for tag in sorted(img.keys()):
+            # SpecificCharacterSet is always read, only flatten it when selected
+            if selected is not None and tag not in selected:
+                continue
+            # Large values left in the file by DEFER_SIZE, reading them would reopen the closed member
+            raw = selection.deferred(img, tag) if selection.DEFER_SIZE else None
+            if raw is not None:
+                keyword = tags.deferred_keyword(tag, raw)
+                if keyword:
+                    element[keyword] = tags.large_value(length=raw.length)
+                else:
+                    deferred += 1
+                    if debug:
+                        log.debug(f'Skip deferred Tag: {tag}')
+                continue
+            elem = img[tag]
             try:
                 if elem.keyword and not elem.is_empty:
                     elem_val = self.eval_vr_value(elem)
                     element[elem.keyword] = elem_val
-                    log.debug(f'Adding tag {elem.keyword}: "{elem_val}" VR: {elem.VR}')
+                    if debug:
+                        log.debug(f'Adding tag {elem.keyword}: "{elem_val}" VR: {elem.VR}')
                 else:
-                    log.info(f'Ignore Tag: {elem.tag} VR: {elem.VR}')
+                    if elem.keyword:
+                        empty += 1
+                    else:
+                        unknown += 1
+                    if debug:
+                        log.debug(f'Ignore Tag: {elem.tag} VR: {elem.VR}')
             except Exception as e:
                 log.error(f'Unable to process {name}, invalid tag keyword')
                 log.error(f'Dump Invalid Elem tag: "{elem.tag}" VR: "{elem.VR}" name: "{elem.name}" keyword: "{elem.keyword}" value: {elem.repval}')
                 log.error(e)
                 raise
+        if empty or unknown or deferred:
+            log.info(f'Ignored {empty} empty tags, {unknown} tags without keyword and {deferred} large values in {name}')
         element['SOURCE_S3_BUCKET'] = self.source_s3_bucket
         element['SOURCE_S3_REGION'] = self.source_s3_bucket_region
         element['SOURCE_S3_KEY'] = self.source_s3_key
         element['SOURCE_S3_ARCHIVE_PATH'] = name
-        # Convert snake_case to CamelCase before checking
-        cc_PARITION_COL = self.convert_cc(PARTITION_COL)
-
-        if cc_PARITION_COL not in element:
-            log.info(f'Missing {PARTITION_COL} adding value')
-            element[cc_PARITION_COL] = datetime.datetime.fromisoformat('1979-01-01').date()
-
-        return element
+        # Spread files without a partition date over other dates instead of a single default partition
+        return partitioning.fill_dates(element, name)
 
     def eval_vr_value(self, elem):
-        return tags.vr_select(elem)(elem)
+        import utils.tags as tags
+        return tags.lookup(elem.tag, elem.VR)(elem)
 
     def convert_cc(self, name):
         cc_convert = ''
@@ -0,0 +1,141 @@
+import os
+import json
+import uuid
+import hashlib
+import datetime
+import utils.aws as aws
+import dedup
+from logger import get_logger
+
+S3_OUTPUT_BUCKET = os.environ.get('S3_OUTPUT_BUCKET', None)
+S3_OUTPUT_BUCKET_REGION = os.environ.get(
+    'S3_OUTPUT_BUCKET_REGION', 'us-east-1')
+# Prefixes starting with _ are ignored by Athena and the Glue crawler
+MANIFEST_PREFIX = os.environ.get('MANIFEST_PREFIX', '_manifests/')
+TOMBSTONE_PREFIX = os.environ.get('TOMBSTONE_PREFIX', '_tombstones/')
+
+log = get_logger(__name__)
+
+
+def get_client():
+    return aws.get_client('s3', S3_OUTPUT_BUCKET_REGION)
+
+
+class manifest():
+    def __init__(self, source_s3_bucket, source_s3_key, members=None):
+        self.source_s3_bucket = source_s3_bucket
+        self.source_s3_key = source_s3_key
+        # Members of the previous extraction and of the current one, by archive path
+        self.members = members or {}
+        self.current = {}
+        self.changed = []
+
+    def __repr__(self):
+        return f's3://{S3_OUTPUT_BUCKET}/{self.location}'
+
+    @property
+    def location(self):
+        digest = hashlib.sha256(f'{self.source_s3_bucket}/{self.source_s3_key}'.encode('utf-8')).hexdigest()
+        return f'{MANIFEST_PREFIX}{digest}.json'
+
+    def unchanged(self, name, fingerprint):
+        previous = self.members.get(name)
+        if previous is not None and previous['fingerprint'] == fingerprint:
+            self.current[name] = previous
+            return True
+        if previous is not None:
+            log.info(f'Archive member {name} of {self.source_s3_key} changed')
+            self.changed.append(name)
+            # Let the dedup index accept the new rows of the same instance
+            if previous.get('uid'):
+                dedup.forget_instances([previous['uid']])
+        self.current[name] = {'fingerprint': fingerprint, 'path': None, 'uid': None}
+        return False
+
+    def record(self, table, path):
+        import utils.arrow as arrow
+        # Output file of the members written in table
+        columns = [arrow.sanitize_column_name(name) for name in ('SOURCE_S3_KEY', 'SOURCE_S3_ARCHIVE_PATH')]
+        if not all(column in table.column_names for column in columns):
+            return
+        keys, names = (table.column(column).to_pylist() for column in columns)
+        if dedup.INSTANCE_COLUMN in table.column_names:
+            uids = table.column(dedup.INSTANCE_COLUMN).to_pylist()
+        else:
+            uids = [None] * table.num_rows
+        for key, name, uid in zip(keys, names, uids):
+            if key == self.source_s3_key and name in self.current:
+                self.current[name]['path'] = path
+                self.current[name]['uid'] = uid
+
+    def stale(self):
+        # Members replaced in this extraction or removed from the archive
+        return {name: entry for name, entry in self.members.items()
+                if name in self.changed or name not in self.current}
+
+    def commit(self):
+        stale = self.stale()
+        if stale:
+            write_tombstones(self, stale)
+        if not stale and self.current == self.members:
+            log.info(f'Manifest {self} unchanged')
+            return
+        self.save(self.current)
+        log.info(f'Saved manifest {self} with {len(self.current)} members, {len(stale)} stale')
+
+    def save(self, members):
+        body = json.dumps({
+            'source': f's3://{self.source_s3_bucket}/{self.source_s3_key}',
+            'members': members,
+        })
+        get_client().put_object(Bucket=S3_OUTPUT_BUCKET, Key=self.location, Body=body.encode('utf-8'),
+                                ServerSideEncryption='AES256')
+
+
+def load(source_s3_bucket, source_s3_key):
+    empty = manifest(source_s3_bucket, source_s3_key)
+    s3 = get_client()
+    try:
+        body = s3.get_object(Bucket=S3_OUTPUT_BUCKET, Key=empty.location)['Body'].read()
+    except s3.exceptions.NoSuchKey:
+        log.info(f'No manifest found for s3://{source_s3_bucket}/{source_s3_key}')
+        return empty
+    members = json.loads(body)['members']
+    log.info(f'Loaded manifest {empty} with {len(members)} members')
+    return manifest(source_s3_bucket, source_s3_key, members=members)
+
+
+def relocate(source_s3_bucket, source_s3_key, moved):
+    # Compaction merged the output files of the members, later tombstones must name the merged file
+    previous = load(source_s3_bucket, source_s3_key)
+    relocated = 0
+    for entry in previous.members.values():
+        path = entry.get('path')
+        if path and path.split('://', 1)[-1] in moved:
+            entry['path'] = moved[path.split('://', 1)[-1]]
+            relocated += 1
+    if relocated:
+        previous.save(previous.members)
+        log.info(f'Moved {relocated} members of manifest {previous}')
+
+
+def write_tombstones(previous, stale):
+    # Rows of stale members stay in their files until compaction, queries can exclude them by path
+    entries = [entry for entry in stale.values() if entry.get('path')]
+    if not entries:
+        return
+    import pyarrow as pa
+    import utils.arrow as arrow
+    names = [name for name, entry in stale.items() if entry.get('path')]
+    table = pa.table({
+        'source_s3_bucket': [previous.source_s3_bucket] * len(entries),
+        'source_s3_key': [previous.source_s3_key] * len(entries),
+        'source_s3_archive_path': names,
+        dedup.INSTANCE_COLUMN: [entry.get('uid') for entry in entries],
+        'output_path': [entry['path'] for entry in entries],
+        'tombstoned_at': pa.array([datetime.datetime.utcnow()] * len(entries), type=pa.timestamp('ms')),
+    })
+    key = f'{TOMBSTONE_PREFIX}{uuid.uuid4().hex}.snappy.parquet'
+    get_client().put_object(Bucket=S3_OUTPUT_BUCKET, Key=key, Body=arrow.to_parquet(table),
+                            ServerSideEncryption='AES256')
+    log.info(f'Tombstoned {len(entries)} members of {previous.source_s3_key} in s3://{S3_OUTPUT_BUCKET}/{key}')
@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+import resource
+import threading
+from structlog import processors
+from logger import get_logger, AWS_BATCH_JOB_ID, AWS_LAMBDA_NAME
+
+if AWS_LAMBDA_NAME:
+    RUNTIME = 'Lambda'
+elif AWS_BATCH_JOB_ID:
+    RUNTIME = 'Batch'
+else:
+    RUNTIME = 'Local'
+# emf writes CloudWatch Embedded Metric Format lines, summary prints a table, none only keeps the totals
+METRICS = os.environ.get('METRICS', 'emf' if RUNTIME != 'Local' else 'none').lower()
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'DicomParser')
+# Metric name and CloudWatch unit of the counts a span can carry
+UNITS = {
+    'bytes': ('Bytes', 'Bytes'),
+    'elements': ('Elements', 'Count'),
+    'members': ('Members', 'Count'),
+    'rows': ('Rows', 'Count'),
+    'values': ('Values', 'Count'),
+    'requests': ('Requests', 'Count'),
+}
+
+log = get_logger(__name__)
+render = processors.JSONRenderer()
+
+# Totals by stage since the last flush, shared by the parser threads. Spans in worker
+# processes of PARSE_EXECUTOR=process are not collected.
+totals = {}
+lock = threading.Lock()
+
+
+def max_rss():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def record(stage, seconds, **counts):
+    with lock:
+        total = totals.get(stage)
+        if total is None:
+            total = totals[stage] = {'calls': 0, 'seconds': 0.0}
+        total['calls'] += 1
+        total['seconds'] += seconds
+        for name, value in counts.items():
+            total[name] = total.get(name, 0) + value
+
+
+def iterate(stage, iterable):
+    # Time spent producing each item, e.g. reading and decompressing the next archive member
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            record(stage, time.perf_counter() - start)
+            return
+        record(stage, time.perf_counter() - start, members=1)
+        yield item
+
+
+class span():
+    # with span('dcmread', bytes=size) as s: ... s.add(members=1)
+    def __init__(self, stage, **counts):
+        self.stage = stage
+        self.counts = counts
+
+    def add(self, **counts):
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.stage, time.perf_counter() - self.start, **self.counts)
+
+
+def emf(stage, total, rss, properties):
+    names = [(UNITS[name][0], UNITS[name][1], value) for name, value in total.items() if name in UNITS]
+    line = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Runtime', 'Stage']],
+                'Metrics': [{'Name': 'Duration', 'Unit': 'Milliseconds'}, {'Name': 'Calls', 'Unit': 'Count'},
+                            {'Name': 'MaxRSS', 'Unit': 'Bytes'}] + [{'Name': name, 'Unit': unit} for name, unit, _ in names],
+            }],
+        },
+        'Runtime': RUNTIME,
+        'Stage': stage,
+        'Duration': round(total['seconds'] * 1000, 3),
+        'Calls': total['calls'],
+        'MaxRSS': rss,
+    }
+    line.update({name: value for name, _, value in names})
+    line.update(properties)
+    return render(None, None, line)
+
+
+def summary(stages, rss):
+    lines = [f'{"stage":12} {"calls":>7} {"total s":>9} {"mean ms":>9} {"MB":>9} {"members":>8} {"rows":>8}']
+    for stage, total in stages.items():
+        lines.append(f'{stage:12} {total["calls"]:7} {total["seconds"]:9.3f} '
+                     f'{total["seconds"] * 1000 / total["calls"]:9.2f} {total.get("bytes", 0) / 1e6:9.2f} '
+                     f'{total.get("members", 0):8} {total.get("rows", 0):8}')
+    lines.append(f'max RSS {rss / 1e6:.1f} MB')
+    return '\n'.join(lines)
+
+
+def flush(**properties):
+    # Emit the totals of the invocation and start over, warm Lambda containers keep this module
+    with lock:
+        stages = dict(totals)
+        totals.clear()
+    if not stages or METRICS == 'none':
+        return stages
+    rss = max_rss()
+    if METRICS == 'emf':
+        # EMF lines must be bare JSON on stdout, log handlers of the runtime add a prefix
+        for stage, total in stages.items():
+            sys.stdout.write(emf(stage, total, rss, properties) + '\n')
+        sys.stdout.flush()
+    elif METRICS == 'summary':
+        print(summary(stages, rss))
+    else:
+        log.warning(f'Unknown METRICS={METRICS}, expected emf, summary or none')
+    return stages
@@ -0,0 +1,193 @@
+import io
+import os
+import json
+import time
+import uuid
+import tarfile
+import threading
+import utils.aws as aws
+from logger import get_logger
+
+S3_OUTPUT_BUCKET = os.environ.get('S3_OUTPUT_BUCKET', None)
+S3_OUTPUT_BUCKET_REGION = os.environ.get(
+    'S3_OUTPUT_BUCKET_REGION', 'us-east-1')
+# Only used when the archive index can not be read, in MB
+MAX_LAMBDA_SIZE = int(os.environ.get('MAX_LAMBDA_SIZE', 500))
+# Configured timeout of the function, also the time available without a Lambda context
+LAMBDA_TIMEOUT = float(os.environ.get('LAMBDA_TIMEOUT', 600))
+LAMBDA_MEMORY = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 256))
+# Share of the remaining time an estimate may use, the estimate is rough
+ROUTE_HEADROOM = float(os.environ.get('ROUTE_HEADROOM', 0.5))
+# Share of LAMBDA_TIMEOUT kept before the timeout to write the parsed rows and hand the remaining
+# members off to AWS Batch, at least HANDOFF_MIN_SECONDS and at most half of the remaining time
+HANDOFF_FRACTION = float(os.environ.get('HANDOFF_FRACTION', 0.1))
+HANDOFF_MIN_SECONDS = float(os.environ.get('HANDOFF_MIN_SECONDS', 10))
+# Parser threads of a Lambda run when one thread is too slow
+LAMBDA_PARALLEL_WORKERS = int(os.environ.get('LAMBDA_PARALLEL_WORKERS', 4))
+# dcmread and transform of one member, in seconds
+MEMBER_SECONDS = float(os.environ.get('MEMBER_SECONDS', 0.03))
+# Members measured in this container before their cost replaces MEMBER_SECONDS
+MIN_MEASURED_MEMBERS = int(os.environ.get('MIN_MEASURED_MEMBERS', 100))
+# Decompression of the uncompressed archive bytes, MB/s. benchmarks/throughput.py rates
+# divided by 6 for the 256 MB default LambdaMemory, about a sixth of a vCPU.
+STREAM_MBPS = {'.tar': 100, '.gz': 25, '.bz2': 1.2, '.xz': 3.5, '.zip': 10}
+# Bytes of a zip member read to parse its header
+ZIP_HEADER_BYTES = int(os.environ.get('ZIP_HEADER_BYTES', 64 * 1024))
+# Compressed prefix of a tar archive whose member headers are counted
+TAR_SAMPLE_SIZE = int(os.environ.get('TAR_SAMPLE_SIZE', 4 * 1024 * 1024))
+CHECKPOINT_PREFIX = os.environ.get('CHECKPOINT_PREFIX', '_checkpoints/')
+
+log = get_logger(__name__)
+
+# dcmread and transform totals of the invocations served by this container
+measured = {'seconds': 0.0, 'members': 0}
+lock = threading.Lock()
+
+
+def get_client():
+    return aws.get_client('s3', S3_OUTPUT_BUCKET_REGION)
+
+
+def remaining_seconds(context):
+    if context is not None:
+        return context.get_remaining_time_in_millis() / 1000
+    return LAMBDA_TIMEOUT
+
+
+def handoff_seconds(remaining):
+    return min(max(HANDOFF_FRACTION * LAMBDA_TIMEOUT, HANDOFF_MIN_SECONDS), remaining / 2)
+
+
+def deadline(context):
+    # Monotonic time at which parsing stops, e.g. 60 s before the timeout of a 600 s function
+    remaining = remaining_seconds(context)
+    return time.monotonic() + remaining - handoff_seconds(remaining)
+
+
+def member_seconds():
+    with lock:
+        if measured['members'] >= MIN_MEASURED_MEMBERS:
+            return measured['seconds'] / measured['members']
+    return MEMBER_SECONDS
+
+
+def observe(stages):
+    # Stage totals returned by metrics.flush
+    parsed = stages.get('dcmread', {}).get('members', 0)
+    if parsed == 0:
+        return
+    seconds = sum(stages.get(stage, {}).get('seconds', 0.0) for stage in ('dcmread', 'transform'))
+    with lock:
+        measured['seconds'] += seconds
+        measured['members'] += parsed
+
+
+def estimate_zip(ds):
+    # The central directory lists every member, only their headers are decompressed
+    files = [file for file in ds.open_zip().infolist() if not file.is_dir()]
+    return {
+        'members': len(files),
+        'bytes': sum(min(file.file_size, ZIP_HEADER_BYTES) for file in files),
+        'exact': True,
+    }
+
+
+def estimate_tar(ds):
+    # Stream mode decompresses the whole archive, count the members of a prefix and extrapolate
+    data = ds.read_prefix(TAR_SAMPLE_SIZE)
+    stream = io.BytesIO(data)
+    members = 0
+    consumed = 0
+    uncompressed = 0
+    try:
+        archive = tarfile.open(fileobj=stream, mode='r|*')
+        for member in archive:
+            if member.isfile():
+                members += 1
+            consumed = stream.tell()
+            uncompressed = archive.offset
+    except (tarfile.TarError, EOFError, OSError, ValueError):
+        # The sample ends in the middle of a member
+        pass
+    if len(data) >= ds.size:
+        return {'members': members, 'bytes': uncompressed, 'exact': True}
+    if consumed == 0:
+        raise Exception(f'No tar member header in the first {len(data)} bytes of {ds}')
+    return {
+        'members': int(members * ds.size / consumed),
+        'bytes': int(uncompressed * ds.size / consumed),
+        'exact': False,
+    }
+
+
+def estimate(ds):
+    if ds.file_ext == '.zip':
+        return estimate_zip(ds)
+    return estimate_tar(ds)
+
+
+def speedup(workers):
+    # Lambda has one vCPU per 1769 MB, threads beyond that wait for the GIL
+    return min(workers, max(1.0, LAMBDA_MEMORY / 1769))
+
+
+def seconds(cost, ext, workers=1):
+    return cost['members'] * member_seconds() / speedup(workers) + cost['bytes'] / 1e6 / STREAM_MBPS.get(ext, 1)
+
+
+def plan(ds, budget, workers=1):
+    # Returns the target, lambda or batch, and the parser workers of a Lambda run
+    try:
+        cost = estimate(ds)
+    except Exception as e:
+        log.warning(f'Unable to estimate the cost of {ds}, fall back to MAX_LAMBDA_SIZE')
+        log.warning(e)
+        if ds.size > MAX_LAMBDA_SIZE * 1024 * 1024:
+            return 'batch', workers
+        return 'lambda', workers
+    budget = budget * ROUTE_HEADROOM
+    for option in sorted({workers, max(workers, LAMBDA_PARALLEL_WORKERS)}):
+        estimated = seconds(cost, ds.file_ext, option)
+        log.info(f'Estimated {estimated:.1f}s for {cost["members"]} members, {cost["bytes"] / 1e6:.1f} MB '
+                 f'of {ds} with {option} workers, budget {budget:.1f}s')
+        if estimated <= budget:
+            return 'lambda', option
+    return 'batch', workers
+
+
+def save_checkpoint(dcm, members):
+    # Members already written by Lambda, the Batch job skips them
+    body = json.dumps({
+        'source': f's3://{dcm.source_s3_bucket}/{dcm.source_s3_key}',
+        'members': members,
+        'paths': dcm.paths,
+        'manifests': {key: {name: entry for name, entry in previous.current.items() if entry.get('path')}
+                      for key, previous in dcm.manifests.items()},
+    })
+    key = f'{CHECKPOINT_PREFIX}{uuid.uuid4().hex}.json'
+    get_client().put_object(Bucket=S3_OUTPUT_BUCKET, Key=key, Body=body.encode('utf-8'),
+                            ServerSideEncryption='AES256')
+    log.info(f'Saved checkpoint s3://{S3_OUTPUT_BUCKET}/{key} after {members} members of {dcm}')
+    return key
+
+
+def load_checkpoint(key):
+    body = get_client().get_object(Bucket=S3_OUTPUT_BUCKET, Key=key)['Body'].read()
+    checkpoint = json.loads(body)
+    log.info(f'Loaded checkpoint s3://{S3_OUTPUT_BUCKET}/{key}, resume after {checkpoint["members"]} members')
+    return checkpoint
+
+
+def resume(dcm, checkpoint):
+    # Output files of the members extracted before the handoff, for the manifest
+    for key, entries in checkpoint['manifests'].items():
+        previous = dcm.manifests.get(key)
+        if previous is None:
+            continue
+        for name, entry in entries.items():
+            if name in previous.current:
+                previous.current[name].update(path=entry['path'], uid=entry['uid'])
+
+
+def delete_checkpoint(key):
+    get_client().delete_object(Bucket=S3_OUTPUT_BUCKET, Key=key)
@@ -1,10 +1,23 @@
 import os
-import boto3
+import io
 import tarfile
+from collections import deque
+from functools import partial
 from logger import get_logger
 import zipfile
 import utils.utils as utils
+import utils.aws as aws
+import metrics
 IGNORE_FILE_EXT = ['.json', '.txt', '.csv']
+TAR_FILE_EXT = ['.tar', '.gz', '.bz2', '.xz']
+ARCHIVE_FILE_EXT = ['.zip'] + TAR_FILE_EXT
+STREAM_BLOCK_SIZE = int(os.environ.get('STREAM_BLOCK_SIZE', 1024 * 1024))
+DCM_INITIAL_RANGE = int(os.environ.get('DCM_INITIAL_RANGE', 64 * 1024))
+DCM_MAX_RANGE = int(os.environ.get('DCM_MAX_RANGE', 8 * 1024 * 1024))
+# Zip members fetched ahead of the parser with concurrent range GETs, 0 disables
+PREFETCH_MEMBERS = int(os.environ.get('PREFETCH_MEMBERS', 8))
+# Local file headers may carry more extra fields than the central directory
+ZIP_HEADER_SLACK = 1024
 
 log = get_logger(__name__)
 
@@ -15,10 +28,11 @@ class s3file():
         self.s3_key = s3key
         self.s3_region = s3region
         self.size = self.set_size(size)
-        self.local_dir = '/tmp'
         self.s3_client = self.generate_s3_client()
         self.file_ext = '.dcm'
         self.file_location = ''
+        self.zip_archive = None
+        # Iterable of member file objects, generators for archives so members are opened lazily
         self.file_list = []
 
     def __repr__(self):
@@ -32,8 +46,7 @@ class s3file():
             raise
 
     def generate_s3_client(self):
-        s3 = boto3.client('s3', region_name=self.s3_region)
-        return s3
+        return aws.get_client('s3', self.s3_region)
 
     def eval_ext(self):
         _, ext = os.path.splitext(self.s3_key)
@@ -43,36 +56,48 @@ class s3file():
 
         self.set_file_ext(ext)
 
-    def download_file(self):
-        try:
-            folderpath, _ = os.path.split(self.s3_key)
-            os.makedirs(f'{self.local_dir}/{folderpath}', exist_ok=True)
-            log.debug(f'Created folder {self.local_dir}/{folderpath}')
-            _, ext = os.path.splitext(f'{self.local_dir}/{self.s3_key}')
-            log.info(f'Downloading file {self}')
-            if self.file_ext == '.dcm':
-                log.debug(f'Found dcm file type download first 10 MBs of file')
-                # Hard coded get only first 10MB of data or less
-                start = 0
-                end = 10000000
-                resp = self.s3_client.get_object(
-                    Bucket=self.s3_bucket, Key=self.s3_key, Range=f'bytes={start}-{end}')['Body'].read()
-                with open(f'{self.local_dir}/{self.s3_key}', 'wb+') as f:
-                    f.write(resp)
-                log.debug(
-                    f'Completed bytes written {end} bytes to local location')
-            else:
-                self.s3_client.download_file(
-                    self.s3_bucket, self.s3_key, f'{self.local_dir}/{self.s3_key}')
-            log.info(f'Completed download {self}')
-            self.file_location = f'{self.local_dir}/{self.s3_key}'
+    def open_header(self):
+        # Only the DICOM header is parsed, start with a small range and grow it while the parser reads on
+        log.info(f'Open header reader {self} initial range {DCM_INITIAL_RANGE}')
+        reader = s3prefixfile(self.s3_client, self.s3_bucket, self.s3_key, self.size,
+                              initial_range=DCM_INITIAL_RANGE, max_range=DCM_MAX_RANGE)
+        reader.name = os.path.split(self.s3_key)[1]
+        return reader
 
+    def open_stream(self):
+        # Sequential read of the whole object, used by the streaming tar reader
+        try:
+            log.info(f'Streaming file {self}')
+            with metrics.span('s3_get', requests=1):
+                body = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.s3_key)['Body']
+            return s3streamfile(body)
         except Exception as e:
             log.error(
-                f'Unable to download file s3://{self.s3_bucket}/{self.s3_key} in region {self.s3_region}')
+                f'Unable to stream file s3://{self.s3_bucket}/{self.s3_key} in region {self.s3_region}')
             log.error(e)
             raise
 
+    def open_range(self):
+        # Seekable reader issuing range GETs, zipfile only fetches the central directory and opened members
+        log.info(f'Open ranged reader {self} block size {STREAM_BLOCK_SIZE}')
+        return io.BufferedReader(s3rangefile(self.s3_client, self.s3_bucket, self.s3_key, self.size),
+                                 buffer_size=STREAM_BLOCK_SIZE)
+
+    def open_zip(self):
+        # Central directory, read once for the routing estimate and the extraction
+        if self.zip_archive is None:
+            reader = self.open_range()
+            if not zipfile.is_zipfile(reader):
+                log.error(f'Invalid ZipFile {self} at s3://{self.s3_bucket}/{self.s3_key}')
+                raise Exception(f'Invalid ZipFile {self}')
+            self.zip_archive = zipfile.ZipFile(reader, 'r')
+        return self.zip_archive
+
+    def read_prefix(self, size):
+        if self.size == 0:
+            return b''
+        return s3rangefile(self.s3_client, self.s3_bucket, self.s3_key, self.size).get_range(0, min(size, self.size) - 1)
+
     def set_file_ext(self, ext):
         if (ext != '' and len(ext) < 10):
             self.file_ext = ext.lower()
@@ -83,45 +108,215 @@ class s3file():
                 f'Unable to evaluate file ext:{ext}, continue assuming {default_ext}')
             self.file_ext = default_ext
 
-    def get(self):
+    def prefetch_members(self, reader, files):
+        # Members are read in central directory order, fetch the start of the next ones concurrently
+        if PREFETCH_MEMBERS <= 0:
+            return
+        ranges = []
+        for file in files:
+            span = 30 + len(file.orig_filename.encode('utf-8')) + len(file.extra) + file.compress_size + ZIP_HEADER_SLACK
+            start = file.header_offset
+            end = min(start + min(span, STREAM_BLOCK_SIZE), self.size) - 1
+            # Small neighbouring members share one GET of up to STREAM_BLOCK_SIZE
+            if ranges and ranges[-1][0] <= start <= ranges[-1][1] + 1 and end - ranges[-1][0] < STREAM_BLOCK_SIZE:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+            else:
+                ranges.append((start, end))
+        reader.prefetch(ranges)
+
+    def get(self, skip=None):
+        # skip(name, fingerprint) returns True for archive members that do not need parsing
         log.debug(f'Selected file ext {self.file_ext}')
         if (self.file_ext in IGNORE_FILE_EXT):
             log.info(f'File ext: {self.file_ext} is IGNORED')
         elif (self.file_ext == '.dcm'):
+            self.file_location = f's3://{self.s3_bucket}/{self.s3_key}'
             log.debug(
                 f'Select .dcm file type for processing, return file location: {self.file_location}')
-            self.download_file()
-            self.file_list.append(self.file_location)
+            self.file_list.append(self.open_header())
         elif (self.file_ext == '.zip'):
-            self.download_file()
-            if (zipfile.is_zipfile(self.file_location)):
-                archive = zipfile.ZipFile(self.file_location, 'r')
-                self.file_list = utils.unzip(archive)
-            else:
-                log.error(
-                    f'Invalid ZipFile {self} downloaded to {self.file_location}')
-                raise
-        elif (self.file_ext == '.bz2'):
-            log.info(f'Select .bz2 file extension, continue assuming tar.bz2')
-            self.download_file()
-            archive = tarfile.open(self.file_location, 'r')
-            self.file_list = utils.tar(archive)
-        elif (self.file_ext == '.tar'):
+            self.file_location = f's3://{self.s3_bucket}/{self.s3_key}'
+            archive = self.open_zip()
+            self.file_list = utils.unzip(archive, skip=skip, prefetch=partial(self.prefetch_members, archive.fp.raw))
+        elif (self.file_ext in TAR_FILE_EXT):
+            if self.file_ext != '.tar':
+                log.info(f'Select {self.file_ext} file extension, continue assuming tar{self.file_ext}')
+            self.file_location = f's3://{self.s3_bucket}/{self.s3_key}'
             log.info(
-                f'Select .tar file type for processing {self.file_location}')
-            self.download_file()
-            archive = tarfile.open(self.file_location, 'r')
-            self.file_list = utils.tar(archive)
-        elif (self.file_ext == '.gz'):
-            log.info(f'Select .gz file extension, continue assuming tar.gz')
-            self.download_file()
-            archive = tarfile.open(self.file_location, 'r')
-            self.file_list = utils.tar(archive)
-        elif (self.file_ext == '.xz'):
-            log.info(f'Select .xz file extension, continue assuming tar.xz')
-            self.download_file()
-            archive = tarfile.open(self.file_location, 'r')
-            self.file_list = utils.tar(archive)
+                f'Select {self.file_ext} file type for processing {self.file_location}')
+            # Stream mode detects the compression and yields members as they are decompressed
+            archive = tarfile.open(fileobj=self.open_stream(), mode='r|*')
+            self.file_list = utils.tar_stream(archive, skip=skip)
         else:
             log.error(f'Unexpected file extension {self.file_ext}')
             raise Exception(f'{self.file_ext} file extension not supported')
+
+
+class s3rangefile(io.RawIOBase):
+    def __init__(self, s3_client, s3bucket, s3key, size):
+        self.s3_client = s3_client
+        self.s3_bucket = s3bucket
+        self.s3_key = s3key
+        self.size = size
+        self.position = 0
+        # Ranges still to fetch and (start, end, future) of the GETs in flight, in read order
+        self.queued = deque()
+        self.blocks = deque()
+
+    def __repr__(self):
+        return f's3://{self.s3_bucket}/{self.s3_key}'
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+        self.position = position
+        return self.position
+
+    def get_range(self, start, end):
+        log.debug(f'Range GET {self} bytes={start}-{end}')
+        with metrics.span('s3_get', requests=1) as s:
+            data = self.s3_client.get_object(
+                Bucket=self.s3_bucket, Key=self.s3_key, Range=f'bytes={start}-{end}')['Body'].read()
+            s.add(bytes=len(data))
+        return data
+
+    def prefetch(self, ranges):
+        self.queued.extend(ranges)
+        self.submit()
+
+    def submit(self):
+        while self.queued and len(self.blocks) < PREFETCH_MEMBERS:
+            start, end = self.queued.popleft()
+            self.blocks.append((start, end, aws.get_executor().submit(self.get_range, start, end)))
+
+    def prefetched(self):
+        # Blocks behind the read position are not read again
+        while self.blocks and self.blocks[0][1] < self.position:
+            self.blocks.popleft()
+        self.submit()
+        for start, end, future in self.blocks:
+            if start <= self.position <= end:
+                return start, future.result()
+        return None, None
+
+    def readinto(self, b):
+        if self.position >= self.size or len(b) == 0:
+            return 0
+        start, data = self.prefetched()
+        if data is not None:
+            data = data[self.position - start:self.position - start + len(b)]
+        else:
+            end = min(self.position + len(b), self.size) - 1
+            data = self.get_range(self.position, end)
+        size = len(data)
+        b[:size] = data
+        self.position += size
+        return size
+
+    def close(self):
+        for _, _, future in self.blocks:
+            future.cancel()
+        self.queued.clear()
+        self.blocks.clear()
+        super().close()
+
+
+class s3prefixfile(io.RawIOBase):
+    def __init__(self, s3_client, s3bucket, s3key, size, initial_range, max_range):
+        self.s3_client = s3_client
+        self.s3_bucket = s3bucket
+        self.s3_key = s3key
+        self.size = size
+        self.range = initial_range
+        self.max_range = max_range
+        self.buffer = bytearray()
+        self.position = 0
+
+    def __repr__(self):
+        return f's3://{self.s3_bucket}/{self.s3_key}'
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+        self.position = position
+        return self.position
+
+    def fetch(self, end):
+        # Extend the in memory prefix up to end, doubling the range of each GET
+        end = min(end, self.size)
+        while len(self.buffer) < end:
+            start = len(self.buffer)
+            stop = min(start + max(self.range, end - start), self.size) - 1
+            log.debug(f'Range GET {self} bytes={start}-{stop}')
+            with metrics.span('s3_get', requests=1) as s:
+                data = self.s3_client.get_object(
+                    Bucket=self.s3_bucket, Key=self.s3_key, Range=f'bytes={start}-{stop}')['Body'].read()
+                s.add(bytes=len(data))
+            if len(data) == 0:
+                break
+            self.buffer += data
+            self.range = min(self.range * 2, self.max_range)
+
+    def readinto(self, b):
+        if self.position >= self.size or len(b) == 0:
+            return 0
+        self.fetch(self.position + len(b))
+        data = self.buffer[self.position:self.position + len(b)]
+        size = len(data)
+        b[:size] = data
+        self.position += size
+        return size
+
+    def close(self):
+        log.debug(f'Fetched {len(self.buffer)} of {self.size} bytes from {self}')
+        self.buffer = bytearray()
+        super().close()
+
+
+class s3streamfile():
+    # GetObject body of a streamed read, counts the time spent waiting for S3
+    def __init__(self, body):
+        self.body = body
+
+    def read(self, size=-1):
+        with metrics.span('s3_get') as s:
+            data = self.body.read(size if size >= 0 else None)
+            s.add(bytes=len(data))
+        return data
+
+    def close(self):
+        self.body.close()
@@ -0,0 +1,123 @@
+import io
+import json
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import utils.schema as schema
+import utils.partitioning as partitioning
+from utils.utils import sanitize_column_name
+from logger import get_logger
+import metrics
+
+log = get_logger(__name__)
+
+
+def serialize(value):
+    if value is None:
+        return None
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def to_declared(name, values, declared):
+    # Values that do not convert are stored as null, so the column keeps its declared type in every file
+    converted = []
+    invalid = 0
+    for value in values:
+        try:
+            pa.array([value], type=declared)
+            converted.append(value)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            converted.append(None)
+            invalid += 1
+    metrics.record('invalid_value', 0.0, values=invalid)
+    log.warning(f'Stored {invalid} values of column {name} not matching declared type {declared} as null')
+    return pa.array(converted, type=declared)
+
+
+def to_array(name, values):
+    declared = schema.column_type(name)
+    if declared is not None:
+        try:
+            return pa.array(values, type=declared)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            return to_declared(name, values, declared)
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        # Mixed value types within a column, fall back to string values
+        log.info(f'Unable to infer type of column {name}, store as string: {e}')
+        return pa.array([serialize(value) for value in values], type=pa.string())
+
+
+def to_table(columns):
+    names = []
+    arrays = []
+    for name, values in columns.items():
+        array = to_array(name, values)
+        # Drop columns with all NONE Values, unless they have a declared type
+        if array.null_count == len(array) and schema.column_type(name) is None:
+            continue
+        names.append(sanitize_column_name(name))
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def to_number(value, numeric):
+    try:
+        return int(value) if pa.types.is_integer(numeric) else float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def sort_column(column, numeric):
+    if numeric is None or not pa.types.is_string(column.type):
+        return column
+    try:
+        return pc.cast(column, numeric)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        # Values that are not numbers sort last
+        return pa.array([to_number(value, numeric) for value in column.to_pylist()], type=numeric)
+
+
+def sort(table, sort_keys):
+    keys = [key for key in sort_keys if key in table.column_names]
+    if not keys:
+        return table
+    columns = [sort_column(table.column(key), partitioning.sort_type(key)) for key in keys]
+    names = [str(index) for index in range(len(keys))]
+    order = pa.Table.from_arrays(columns, names=names)
+    return table.take(pc.sort_indices(order, sort_keys=[(name, 'ascending') for name in names]))
+
+
+def partition_values(table, source):
+    # Values of source, the fallback partition date of rows without one
+    values = table.column(source).to_pylist() if source in table.column_names else [None] * table.num_rows
+    fallback = partitioning.fallback_column(source)
+    if fallback in table.column_names:
+        values = [date if value is None else value for value, date in zip(values, table.column(fallback).to_pylist())]
+    return values
+
+
+def partition(table, fields):
+    # Split rows by hive partition values, columns partitioned as is are only stored in the path
+    keys = []
+    for field in fields:
+        keys.append([field.value(value) for value in partition_values(table, field.source)])
+    groups = {}
+    for index, key in enumerate(zip(*keys)):
+        groups.setdefault(key, []).append(index)
+    dropped = {field.source for field in fields if field.transform is None}
+    dropped |= {partitioning.fallback_column(field.source) for field in fields}
+    columns = [name for name in table.column_names if name not in dropped]
+    # Indices are ascending, each partition keeps the sort order of table
+    for key, indices in groups.items():
+        prefix = '/'.join(f'{field.name}={partitioning.escape(value)}' for field, value in zip(fields, key))
+        yield prefix, [str(value) for value in key], table.take(pa.array(indices)).select(columns)
+
+
+def to_parquet(table, compression='snappy'):
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression=compression)
+    return buffer.getvalue()
@@ -0,0 +1,57 @@
+import os
+import threading
+import functools
+import boto3
+from urllib import parse
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from logger import get_logger
+
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 50))
+AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', 5))
+# Threads issuing concurrent range GETs, shared by all readers of the process
+S3_FETCH_WORKERS = int(os.environ.get('S3_FETCH_WORKERS', 16))
+
+log = get_logger(__name__)
+
+# Clients live at module level so warm Lambda invocations reuse their connection pools
+clients = {}
+lock = threading.Lock()
+
+
+def get_client(service, region=None):
+    # Clients are thread safe once created, creating them from one session is not
+    client = clients.get((service, region))
+    if client is None:
+        with lock:
+            client = clients.get((service, region))
+            if client is None:
+                log.debug(f'Create {service} client in region {region}')
+                config = Config(max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+                                retries={'max_attempts': AWS_MAX_ATTEMPTS, 'mode': 'standard'})
+                client = clients[(service, region)] = get_session().client(
+                    service, region_name=region, config=config)
+    return client
+
+
+def source_tagging(bucket, key):
+    # Tags naming the source of an output object, truncated to the length S3 allows
+    return parse.urlencode({"S3_BUCKET": bucket[-128:], "S3_KEY": key[-256:]})
+
+
+def put_args(tagging=None):
+    # Encryption and tags of the objects written to the output bucket
+    args = {'ServerSideEncryption': 'AES256'}
+    if tagging:
+        args['Tagging'] = tagging
+    return args
+
+
+@functools.lru_cache(maxsize=None)
+def get_session():
+    return boto3.session.Session()
+
+
+@functools.lru_cache(maxsize=None)
+def get_executor():
+    return ThreadPoolExecutor(max_workers=S3_FETCH_WORKERS, thread_name_prefix='s3-fetch')
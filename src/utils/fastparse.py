@@ -0,0 +1,197 @@
+# Header reader for little endian transfer syntaxes: one pass over the bytes of the member, private
+# and unselected elements are skipped by their length without building pydicom elements
+import io
+import os
+import struct
+from utils.utils import str2bool
+from logger import get_logger
+
+# Read headers with fastparse.dcmread, files it does not handle are read by pydicom
+FAST_PARSE = str2bool(os.environ.get('FAST_PARSE', False))
+# Bytes requested from the member at a time
+READ_SIZE = int(os.environ.get('FAST_PARSE_READ_SIZE', 64 * 1024))
+UNDEFINED_LENGTH = 0xFFFFFFFF
+ITEM = 0xFFFEE000
+ITEM_DELIMITER = 0xFFFEE00D
+SEQUENCE_DELIMITER = 0xFFFEE0DD
+SPECIFIC_CHARACTER_SET = 0x00080005
+TRANSFER_SYNTAX_UID = 0x00020010
+EXPLICIT = struct.Struct('<HH2sH')
+IMPLICIT = struct.Struct('<HHL')
+LENGTH = struct.Struct('<L')
+
+log = get_logger(__name__)
+
+
+class reader():
+    # Bytes of fp from offset base on, values skipped past the loaded bytes are seeked over
+    def __init__(self, fp, extra_length_VRs):
+        self.fp = fp
+        self.start = fp.tell()
+        self.base = 0
+        self.data = b''
+        self.extra_length_VRs = extra_length_VRs
+
+    def available(self, end):
+        missing = end - self.base - len(self.data)
+        while missing > 0:
+            chunk = self.fp.read(max(missing, READ_SIZE))
+            if not chunk:
+                return False
+            self.data += chunk
+            missing -= len(chunk)
+        return True
+
+    def read(self, start, end):
+        if not self.available(end):
+            raise Exception(f'Truncated value at {start}')
+        return self.data[start - self.base:end - self.base]
+
+    def unpack(self, fmt, offset):
+        if not self.available(offset + fmt.size):
+            raise Exception(f'Truncated element at {offset}')
+        return fmt.unpack_from(self.data, offset - self.base)
+
+    def skip(self, end):
+        if end > self.base + len(self.data):
+            self.fp.seek(self.start + end)
+            self.base = end
+            self.data = b''
+
+    def tag(self, offset):
+        group, elem, _ = self.unpack(IMPLICIT, offset)
+        return group << 16 | elem
+
+    def explicit(self, offset):
+        # Same test as pydicom, two upper case letters after the tag
+        VR = self.read(offset + 4, offset + 6)
+        return 0x40 < VR[0] < 0x5B and 0x40 < VR[1] < 0x5B
+
+    def header(self, offset, implicit):
+        # Tag, VR, length and offset of the value of the element at offset, item tags have no VR
+        group, elem, length = self.unpack(IMPLICIT, offset)
+        if implicit or group == 0xFFFE:
+            return group << 16 | elem, None, length, offset + 8
+        group, elem, VR, length = self.unpack(EXPLICIT, offset)
+        if not b'AA' <= VR <= b'ZZ':
+            raise Exception(f'Implicit VR element in explicit VR data at {offset}')
+        VR = VR.decode('ascii')
+        if VR in self.extra_length_VRs:
+            return group << 16 | elem, VR, self.unpack(LENGTH, offset + 8)[0], offset + 12
+        return group << 16 | elem, VR, length, offset + 8
+
+    def sequence_end(self, offset, implicit):
+        # Offset after the delimiter of an undefined length sequence or encapsulated value
+        while True:
+            tag, _, length, offset = self.header(offset, True)
+            if tag == SEQUENCE_DELIMITER:
+                return offset
+            if tag != ITEM:
+                raise Exception(f'Unexpected tag {tag:08X} in sequence')
+            offset = offset + length if length != UNDEFINED_LENGTH else self.item_end(offset, implicit)
+
+    def item_end(self, offset, implicit):
+        # pydicom switches to explicit VR per item, those files are left to it
+        if implicit and self.tag(offset) != ITEM_DELIMITER and self.explicit(offset):
+            raise Exception(f'Explicit VR item in implicit VR data at {offset}')
+        while True:
+            tag, _, length, offset = self.header(offset, implicit)
+            if tag == ITEM_DELIMITER:
+                return offset
+            offset = offset + length if length != UNDEFINED_LENGTH else self.sequence_end(offset, implicit)
+
+
+def read(fp):
+    import pydicom.uid
+    from pydicom.charset import convert_encodings, default_encoding
+    from pydicom.datadict import dictionary_VR
+    from pydicom.dataelem import DataElement, DataElement_from_raw, RawDataElement, empty_value_for_VR
+    from pydicom.dataset import Dataset
+    from pydicom.filereader import read_sequence
+    from pydicom.misc import size_in_bytes
+    from pydicom.tag import Tag
+    from pydicom.values import convert_string
+    from pydicom.valuerep import extra_length_VRs
+    import utils.selection as selection
+
+    r = reader(fp, extra_length_VRs)
+    if r.read(128, 132) != b'DICM':
+        raise Exception('No DICM prefix')
+    # File meta information, explicit VR little endian whatever the transfer syntax
+    offset = 132
+    syntax = None
+    while r.available(offset + 8) and r.tag(offset) >> 16 == 2:
+        tag, VR, length, value = r.header(offset, False)
+        if length == UNDEFINED_LENGTH:
+            raise Exception(f'Undefined length meta element {tag:08X}')
+        if tag == TRANSFER_SYNTAX_UID:
+            syntax = DataElement_from_raw(RawDataElement(
+                Tag(tag), VR, length, r.read(value, value + length), value, False, True)).value
+        offset = value + length
+    # Big endian and deflated data, or a missing transfer syntax pydicom guesses
+    if syntax is None or syntax in (pydicom.uid.ExplicitVRBigEndian, pydicom.uid.DeflatedExplicitVRLittleEndian):
+        raise Exception(f'Transfer syntax {syntax}')
+    implicit = syntax == pydicom.uid.ImplicitVRLittleEndian
+    if not r.available(offset + 8) or r.explicit(offset) == implicit:
+        raise Exception(f'Dataset does not match transfer syntax {syntax}')
+
+    selected = selection.selected_set()
+    last = selection.selected_tags()[-1] if selected is not None else None
+    defer_size = size_in_bytes(selection.DEFER_SIZE)
+    encoding = default_encoding
+    elements = {}
+    while r.available(offset + 8):
+        tag, VR, length, value = r.header(offset, implicit)
+        if tag in selection.PIXEL_DATA_TAGS or last is not None and tag > last:
+            break
+        # Command set elements and delimiters at the top level are handled by pydicom
+        if tag >> 16 in (0x0000, 0xFFFE):
+            raise Exception(f'Unexpected tag {tag:08X}')
+        # Private tags are removed from the pydicom dataset before it is flattened
+        wanted = not tag >> 16 & 1 and (selected is None or tag in selected or tag == SPECIFIC_CHARACTER_SET)
+        if length == UNDEFINED_LENGTH:
+            end = r.sequence_end(value, implicit)
+            if wanted:
+                if VR == 'UN':
+                    VR = 'SQ'
+                if VR is None:
+                    try:
+                        VR = dictionary_VR(tag)
+                    except KeyError:
+                        VR = 'SQ' if r.tag(value) == ITEM else None
+                if VR != 'SQ':
+                    raise Exception(f'Undefined length value {tag:08X}')
+                sequence = read_sequence(io.BytesIO(r.read(value, end)), implicit, True, length, encoding)
+                elements[Tag(tag)] = DataElement(Tag(tag), VR, sequence, value, is_undefined_length=True)
+        else:
+            end = value + length
+            if wanted:
+                # Sequences are flattened whatever their size, pydicom reads them too
+                if (defer_size is not None and length > defer_size and tag != SPECIFIC_CHARACTER_SET
+                        and not selection.is_sequence(tag, VR)):
+                    data = None
+                elif length > 0:
+                    data = r.read(value, end)
+                else:
+                    data = empty_value_for_VR(VR, raw=True)
+                if tag == SPECIFIC_CHARACTER_SET:
+                    encoding = convert_encodings(convert_string(data or b'', True))
+                elements[Tag(tag)] = RawDataElement(Tag(tag), VR, length, data, value, implicit, True)
+        r.skip(end)
+        offset = end
+    ds = Dataset(elements)
+    ds.is_implicit_VR = implicit
+    ds.is_little_endian = True
+    ds.set_original_encoding(implicit, True, ds._character_set)
+    return ds
+
+
+def dcmread(fp):
+    # Same dataset as selection.dcmread without the private tags, None when the file needs pydicom
+    start = fp.tell()
+    try:
+        return read(fp)
+    except Exception as e:
+        log.debug(f'Read {getattr(fp, "name", "member")} with pydicom, {e}')
+        fp.seek(start)
+        return None
@@ -0,0 +1,29 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from logger import get_logger
+
+log = get_logger(__name__)
+
+
+def ordered_map(func, iterable, workers=1, max_inflight=None, executor='thread'):
+    # Yield func(item) in input order, with at most max_inflight items submitted to the pool
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+    if executor == 'process':
+        pool_class = ProcessPoolExecutor
+    elif executor == 'thread':
+        pool_class = ThreadPoolExecutor
+    else:
+        raise ValueError(f'Invalid executor {executor}')
+    max_inflight = max(max_inflight or workers * 2, 1)
+    log.debug(f'Start {executor} pool with {workers} workers, {max_inflight} in-flight items')
+    pending = deque()
+    with pool_class(max_workers=workers) as pool:
+        for item in iterable:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= max_inflight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
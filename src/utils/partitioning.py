@@ -0,0 +1,165 @@
+# Hive partitioning and sort order of the output files
+import os
+import re
+import zlib
+import datetime
+import functools
+from utils.utils import sanitize_column_name
+import utils.temporal as temporal
+from logger import get_logger
+
+PARTITION_COL = os.environ.get('PARTITION_COL', 'study_date')
+# Comma separated columns or transforms of a column, one directory level each, e.g.
+# year(study_date),month(study_date),modality or bucket(patient_id,16)
+PARTITION_COLS = os.environ.get('PARTITION_COLS', PARTITION_COL)
+# Rows of every file are sorted by these columns, the row group statistics let Athena skip the others
+SORT_KEYS = os.environ.get('SORT_KEYS', 'study_instance_uid,series_instance_uid,instance_number')
+# Used in order when a partition date is missing, rows without any are in the default partition
+DATE_FALLBACK = os.environ.get('DATE_FALLBACK', 'SeriesDate,AcquisitionDate,ContentDate,InstanceCreationDate')
+TRANSFORMS = ['year', 'month', 'day', 'bucket']
+FIELD = re.compile(r'^(\w+)\(\s*(\w+)\s*(?:,\s*(\d+)\s*)?\)$')
+DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+# Characters Hive escapes in partition directory names
+ESCAPED = set('"#%\'*/:=?\\{[]^') | {chr(c) for c in range(0x20)} | {'\x7f'}
+
+log = get_logger(__name__)
+
+
+class field():
+    def __init__(self, source, transform=None, buckets=None):
+        self.source = source
+        self.transform = transform
+        self.buckets = buckets
+        self.name = source if transform is None else f'{source}_{transform}'
+
+    def __repr__(self):
+        if self.transform is None:
+            return self.source
+        if self.buckets is not None:
+            return f'{self.transform}({self.source},{self.buckets})'
+        return f'{self.transform}({self.source})'
+
+    def value(self, value):
+        if value is None or self.transform is None:
+            return value
+        if self.transform == 'bucket':
+            # Same as crc32(to_utf8(value)) % buckets in Athena
+            return zlib.crc32(str(value).encode('utf-8')) % self.buckets
+        date = as_date(value)
+        if date is None:
+            return None
+        return getattr(date, self.transform)
+
+
+def as_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return temporal.parse_DA(str(value).replace('-', '')[:8])
+    except ValueError:
+        return None
+
+
+def parse(spec):
+    fields = []
+    # Commas inside bucket(column,N) do not separate entries
+    for entry in re.split(r',(?![^(]*\))', spec):
+        entry = entry.strip()
+        if not entry:
+            continue
+        match = FIELD.match(entry)
+        if match is None:
+            fields.append(field(sanitize_column_name(entry)))
+            continue
+        transform, source, buckets = match.groups()
+        if transform not in TRANSFORMS:
+            raise Exception(f'Unknown partition transform {transform} in {entry}, expected one of {TRANSFORMS}')
+        if (transform == 'bucket') != (buckets is not None) or buckets == '0':
+            raise Exception(f'Invalid partition {entry}, only bucket takes a number of buckets')
+        fields.append(field(sanitize_column_name(source), transform, int(buckets) if buckets else None))
+    return fields
+
+
+@functools.lru_cache(maxsize=None)
+def fields():
+    return parse(PARTITION_COLS)
+
+
+def sort_keys():
+    return [sanitize_column_name(key.strip()) for key in SORT_KEYS.split(',') if key.strip()]
+
+
+@functools.lru_cache(maxsize=None)
+def sort_type(column):
+    # Integer and decimal string columns sort by their value, e.g. instance_number 2 before 10
+    import pyarrow as pa
+    from pydicom.datadict import dictionary_VM, dictionary_VR, tag_for_keyword
+    name = keyword(column)
+    if name is None or dictionary_VM(tag_for_keyword(name)) != '1':
+        return None
+    return {'IS': pa.int64(), 'DS': pa.float64()}.get(dictionary_VR(tag_for_keyword(name)))
+
+
+def fallback_column(column):
+    # Partition date of the rows missing column, e.g. study_date_partition, only stored in the path
+    return f'{column}_partition'
+
+
+@functools.lru_cache(maxsize=None)
+def keyword(column):
+    # DICOM keyword of a column name, e.g. StudyInstanceUID for study_instance_uid
+    from pydicom.datadict import keyword_dict
+    for name in keyword_dict:
+        if sanitize_column_name(name) == column:
+            return name
+    return None
+
+
+def source_keywords():
+    # Tags read for the partitioning, whatever the tag selection
+    return [keyword(f.source) for f in fields() if keyword(f.source)]
+
+
+@functools.lru_cache(maxsize=None)
+def date_keywords():
+    # Partition sources that get a fallback date when missing
+    from pydicom.datadict import dictionary_VR, tag_for_keyword
+    keywords = []
+    for f in fields():
+        name = keyword(f.source)
+        if name is None or f.transform == 'bucket' or name in keywords:
+            continue
+        if f.transform is not None or dictionary_VR(tag_for_keyword(name)) == 'DA':
+            keywords.append(name)
+    return keywords
+
+
+def fallback_date(element):
+    # First date of DATE_FALLBACK found in element
+    for name in DATE_FALLBACK.split(','):
+        name = name.strip()
+        if element.get(name) is not None and as_date(element[name]) is not None:
+            return as_date(element[name]), name
+    return None, None
+
+
+def fill_dates(element, name):
+    # The date itself stays empty, the fallback is kept in <Keyword>Partition and its keyword in <Keyword>Source
+    for date_keyword in date_keywords():
+        if element.get(date_keyword) is None:
+            date, source = fallback_date(element)
+            if date is None:
+                log.info(f'Missing {date_keyword} in {name}, no fallback date, default partition')
+                continue
+            element[f'{date_keyword}Partition'] = date
+            element[f'{date_keyword}Source'] = source
+            log.info(f'Missing {date_keyword} in {name}, partition by {source} {date}')
+    return element
+
+
+def escape(value):
+    if value is None or value == '':
+        return DEFAULT_PARTITION
+    return ''.join(f'%{ord(c):02X}' if c in ESCAPED else c for c in str(value))
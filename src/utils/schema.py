@@ -0,0 +1,94 @@
+# Declared Arrow type per keyword, so every writer produces the same column types
+# regardless of which tags are present in a file
+import functools
+import pyarrow as pa
+from pydicom._dicom_dict import DicomDictionary, RepeatersDictionary
+import utils.tags as tags
+from logger import get_logger
+
+log = get_logger(__name__)
+
+PN_TYPE = pa.struct([
+    ('FamilyName', pa.string()),
+    ('GivenName', pa.string()),
+    ('Ideographic', pa.string()),
+    ('MiddleName', pa.string()),
+    ('NamePrefix', pa.string()),
+    ('NameSuffix', pa.string()),
+    ('Phonetic', pa.string()),
+])
+
+# One entry per element of the items of a sequence, Path locates it, e.g. [0].PlanePositionSequence[0].ImagePositionPatient
+SQ_TYPE = pa.list_(pa.struct([
+    ('Path', pa.string()),
+    ('Keyword', pa.string()),
+    ('VR', pa.string()),
+    ('Value', pa.list_(pa.string())),
+]))
+
+# Type of the items of multi-valued elements, single values are returned as string by rep_string
+ITEM_TYPES = {
+    'DS': pa.float64(),
+    'FD': pa.float64(),
+    'FL': pa.float64(),
+    'OD': pa.float64(),
+    'OF': pa.float64(),
+    'IS': pa.int64(),
+    'AT': pa.int64(),
+    'SL': pa.int64(),
+    'SS': pa.int64(),
+    'SV': pa.int64(),
+    'UL': pa.int64(),
+    'US': pa.int64(),
+    'UV': pa.int64(),
+}
+
+SOURCE_COLUMNS = {
+    'SOURCE_S3_BUCKET': pa.string(),
+    'SOURCE_S3_REGION': pa.string(),
+    'SOURCE_S3_KEY': pa.string(),
+    'SOURCE_S3_ARCHIVE_PATH': pa.string(),
+}
+
+
+def value_type(VR, vm):
+    converter = tags.VR_CONVERTERS.get(VR)
+    if converter is tags.convert_SQ:
+        return SQ_TYPE
+    if converter is tags.convert_DA:
+        item = pa.date32()
+    elif converter is tags.convert_DT:
+        # Athena reads timestamps in milliseconds
+        item = pa.timestamp('ms')
+    elif converter is tags.convert_PN:
+        item = PN_TYPE
+    elif tags.parse_vm(vm) > 1:
+        item = ITEM_TYPES.get(VR, pa.string())
+    else:
+        return pa.string()
+    if tags.parse_vm(vm) > 1:
+        return pa.list_(item)
+    return item
+
+
+def element_type(VR, vm):
+    # Ambiguous dictionary VRs ("US or SS") keep a type only if all options agree
+    types = {value_type(option, vm) for option in VR.split(' or ')}
+    if len(types) == 1:
+        return types.pop()
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def registry():
+    columns = dict(SOURCE_COLUMNS)
+    for dictionary in (DicomDictionary, RepeatersDictionary):
+        for VR, vm, _, _, keyword in dictionary.values():
+            if keyword and keyword not in columns:
+                columns[keyword] = element_type(VR, vm)
+    log.debug(f'Built schema registry of {len(columns)} keywords')
+    return columns
+
+
+def column_type(keyword):
+    return registry().get(keyword)
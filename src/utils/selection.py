@@ -0,0 +1,130 @@
+# Tag selection profile: only the listed tags are read from the header and flattened
+import os
+import re
+import functools
+from logger import get_logger
+
+# File with one entry per line, # starts a comment
+TAG_PROFILE = os.environ.get('TAG_PROFILE', '')
+# Comma separated entries, added to the profile
+TAG_KEYWORDS = os.environ.get('TAG_KEYWORDS', '')
+# Values larger than DEFER_SIZE are skipped instead of read into memory, e.g. 64 KB
+DEFER_SIZE = os.environ.get('DEFER_SIZE', '') or None
+# Used by the dedup index, always extracted with the partition sources and fallback dates
+REQUIRED_KEYWORDS = ['SOPInstanceUID']
+PIXEL_DATA_TAGS = {0x7fe00010, 0x7fe00009, 0x7fe00008}
+# Keyword, (gggg,eeee) or ggggeeee, and (gggg,xxxx) or ggggxxxx for a whole group
+TAG = re.compile(r'^\(?([0-9a-fA-F]{4}),?([0-9a-fA-F]{4}|[xX]{4})\)?$')
+
+log = get_logger(__name__)
+
+
+def parse_entry(entry):
+    from pydicom.datadict import DicomDictionary, tag_for_keyword
+    match = TAG.match(entry)
+    if match:
+        group, element = match.groups()
+        if element.lower() == 'xxxx':
+            group = int(group, 16)
+            return [tag for tag in DicomDictionary if tag >> 16 == group]
+        return [int(group + element, 16)]
+    tag = tag_for_keyword(entry)
+    if tag is None:
+        raise Exception(f'Unknown tag {entry} in tag selection')
+    return [tag]
+
+
+def read_profile(path):
+    with open(path) as f:
+        return [line.split('#')[0].strip() for line in f]
+
+
+@functools.lru_cache(maxsize=None)
+def selected_tags():
+    # Sorted tags of the selection, None to extract every tag
+    from pydicom.tag import Tag
+    import utils.partitioning as partitioning
+    # Commas inside (gggg,eeee) do not separate entries
+    entries = [entry.strip() for entry in re.split(r',(?![^(]*\))', TAG_KEYWORDS)]
+    if TAG_PROFILE:
+        entries += read_profile(TAG_PROFILE)
+    entries = [entry for entry in entries if entry]
+    if not entries:
+        return None
+    tags = set()
+    required = REQUIRED_KEYWORDS + partitioning.source_keywords()
+    if partitioning.date_keywords():
+        required += [name.strip() for name in partitioning.DATE_FALLBACK.split(',') if name.strip()]
+    for entry in entries + required:
+        tags.update(Tag(tag) for tag in parse_entry(entry))
+    log.info(f'Extract {len(tags)} tags selected by {len(entries)} entries')
+    return sorted(tags)
+
+
+@functools.lru_cache(maxsize=None)
+def selected_set():
+    tags = selected_tags()
+    return frozenset(tags) if tags is not None else None
+
+
+def dcmread(fp):
+    # Header only, with a selection reading stops after the last selected tag
+    import pydicom
+    from pydicom.filereader import read_partial
+    from pydicom.misc import size_in_bytes
+    tags = selected_tags()
+    if tags is None:
+        return read_sequences(fp, pydicom.dcmread(fp=fp, stop_before_pixels=True, defer_size=DEFER_SIZE))
+    last = tags[-1]
+
+    def stop_when(tag, VR, length):
+        return tag > last or tag in PIXEL_DATA_TAGS
+
+    return read_sequences(fp, read_partial(fp, stop_when, defer_size=size_in_bytes(DEFER_SIZE), specific_tags=tags))
+
+
+def is_sequence(tag, VR):
+    # Implicit VR elements have no VR, the dictionary has it
+    if VR is None:
+        from pydicom.datadict import dictionary_has_tag, dictionary_VR
+        VR = dictionary_VR(tag) if dictionary_has_tag(tag) else None
+    return VR == 'SQ'
+
+
+def read_sequences(fp, ds):
+    # pydicom defers defined length sequences like other values, sequences are flattened whatever
+    # their size so their bytes are read while the member is open. Dataset.__getitem__ would close fp
+    # DicomDir reads its deferred record sequence with __getitem__ and closes fp
+    if DEFER_SIZE and not fp.closed:
+        position = fp.tell()
+        for tag in list(ds._dict):
+            raw = deferred(ds, tag)
+            if raw is not None and is_sequence(tag, raw.VR):
+                fp.seek(raw.value_tell)
+                ds._dict[tag] = raw._replace(value=fp.read(raw.length))
+        fp.seek(position)
+    return ds
+
+
+def deferred(ds, tag):
+    # Raw element whose value was left in the file because of DEFER_SIZE, None otherwise.
+    # Dataset.get_item and ds[tag] read deferred values, the dataset dict does not.
+    from pydicom.dataelem import RawDataElement
+    raw = ds._dict.get(tag)
+    # Converted elements with a None value are empty, e.g. an empty US tag
+    if isinstance(raw, RawDataElement) and raw.value is None and raw.length not in (0, 0xFFFFFFFF):
+        return raw
+    return None
+
+
+def remove_private_tags(ds):
+    # Dataset.remove_private_tags reads every value, deferred values can not be read once the member is closed
+    if not DEFER_SIZE:
+        ds.remove_private_tags()
+        return
+    for tag in list(ds.keys()):
+        if tag.is_private:
+            del ds[tag]
+        elif deferred(ds, tag) is None and ds[tag].VR == 'SQ':
+            for item in ds[tag].value:
+                remove_private_tags(item)
@@ -0,0 +1,131 @@
+# Sequences flattened to one {Path, Keyword, VR, Value} entry per element of their items, nested sequences
+# included, so every sequence column has the same list<struct> type whatever its items contain
+import os
+from pydicom.datadict import dictionary_has_tag, dictionary_VR, keyword_for_tag
+import utils.tags as tags
+import utils.temporal as temporal
+from logger import get_logger
+
+# Levels of nested sequences flattened, 1 only flattens the items of the top level sequence
+SQ_MAX_DEPTH = int(os.environ.get('SQ_MAX_DEPTH', 4))
+# Items flattened per sequence, e.g. the first frames of a per-frame functional group sequence
+SQ_MAX_ITEMS = int(os.environ.get('SQ_MAX_ITEMS', 100))
+
+log = get_logger(__name__)
+
+
+def strings(elem):
+    # Values as strings, dates and times in the same form as the top level columns
+    if elem.is_empty:
+        return []
+    if elem.VR in tags.BINARY_VRS or isinstance(elem.value, bytes):
+        return [tags.convert_binary(elem)]
+    values = elem.value if elem.VM > 1 else [elem.value]
+    if elem.VR == 'DA':
+        return [date(str(value)) for value in values]
+    if elem.VR == 'DT':
+        return [timestamp(str(value)) for value in values]
+    if elem.VR == 'TM':
+        return [temporal.format_TM(str(value)) for value in values]
+    return [str(value) for value in values]
+
+
+def date(value):
+    try:
+        return temporal.parse_DA(value).isoformat()
+    except ValueError:
+        return value
+
+
+def timestamp(value):
+    parsed = temporal.parse_DT(value)
+    return parsed.isoformat(sep=' ') if parsed is not None else value
+
+
+class flattener():
+    # Entries of one top level sequence. Items of functional group sequences repeat the same
+    # nested sequences and values, identical raw bytes are converted once per sequence
+    def __init__(self, selected=None):
+        self.selected = selected
+        self.sequences = {}
+        self.values = {}
+        self.skipped_items = 0
+        self.skipped_sequences = 0
+
+    def flatten(self, items, path='', depth=1):
+        entries = []
+        for index, item in enumerate(items):
+            if index >= SQ_MAX_ITEMS:
+                self.skipped_items += len(items) - index
+                break
+            prefix = f'{path}[{index}]'
+            for tag in sorted(item.keys()):
+                raw = item._dict[tag]
+                if self.is_sequence(item, tag, raw):
+                    # Deeper or unselected sequences are not parsed
+                    if depth >= SQ_MAX_DEPTH or self.selected is not None and tag not in self.selected:
+                        self.skipped_sequences += 1
+                        continue
+                    entries.extend(self.nested(item, tag, raw, prefix, depth + 1))
+                else:
+                    entry = self.entry(item, tag, raw, prefix)
+                    if entry is not None:
+                        entries.append(entry)
+        return entries
+
+    def is_sequence(self, item, tag, raw):
+        # Raw elements of implicit VR files have no VR, the dictionary has it without converting the value
+        VR = raw.VR
+        if VR is None and dictionary_has_tag(tag):
+            VR = dictionary_VR(tag)
+        if VR is None:
+            VR = item[tag].VR
+        return VR == 'SQ'
+
+    def key(self, raw):
+        # Values still in their raw form can be compared by their bytes
+        if getattr(raw, 'is_raw', False) and isinstance(raw.value, bytes):
+            return raw.tag, raw.VR, raw.is_implicit_VR, raw.value
+        return None
+
+    def nested(self, item, tag, raw, prefix, depth):
+        key = self.key(raw)
+        relative = self.sequences.get((key, depth)) if key is not None else None
+        if relative is None:
+            relative = self.flatten(item[tag].value, '', depth)
+            if key is not None:
+                self.sequences[(key, depth)] = relative
+        path = f'{prefix}.{name(tag, keyword(tag))}'
+        return [dict(entry, Path=path + entry['Path']) for entry in relative]
+
+    def entry(self, item, tag, raw, prefix):
+        key = self.key(raw)
+        value = self.values.get(key) if key is not None else None
+        if value is None:
+            elem = item[tag]
+            value = (elem.keyword or None, elem.VR, strings(elem))
+            if key is not None:
+                self.values[key] = value
+        element_keyword, VR, values = value
+        if not values:
+            return None
+        return {'Path': f'{prefix}.{name(tag, element_keyword)}', 'Keyword': element_keyword, 'VR': VR,
+                'Value': values}
+
+
+def keyword(tag):
+    return keyword_for_tag(tag) or None
+
+
+def name(tag, element_keyword):
+    return element_keyword or f'({tag >> 16:04X},{tag & 0xFFFF:04X})'
+
+
+def flatten(elem):
+    import utils.selection as selection
+    sequence = flattener(selection.selected_set())
+    entries = sequence.flatten(elem.value)
+    if sequence.skipped_items or sequence.skipped_sequences:
+        log.debug(f'Skipped {sequence.skipped_items} items and {sequence.skipped_sequences} nested sequences '
+                  f'of {elem.keyword}, SQ_MAX_ITEMS={SQ_MAX_ITEMS} SQ_MAX_DEPTH={SQ_MAX_DEPTH}')
+    return entries
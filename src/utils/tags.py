@@ -1,12 +1,29 @@
 # http://dicom.nema.org/dicom/2013/output/chtml/part05/sect_6.2.html
 import datetime
 from logger import get_logger
-import pydicom
+import pydicom.datadict
+import pydicom.multival
 import os
+import json
 import base64
+import hashlib
 import math
-
-IGNORE_OB = os.getenv('IGNORE_OB', True)
+import functools
+from utils.utils import str2bool
+import utils.temporal as temporal
+import metrics
+
+# Binary values below LARGE_VALUE_SIZE are replaced by IGNORED, otherwise stringified
+IGNORE_OB = str2bool(os.getenv('IGNORE_OB', False))
+# Binary values of at least LARGE_VALUE_SIZE bytes are replaced by a JSON summary:
+# length only, length and sha256, or also a copy in the output bucket (s3). keep writes the bytes
+LARGE_VALUE_SIZE = int(os.getenv('LARGE_VALUE_SIZE', 64 * 1024))
+LARGE_VALUE_POLICY = os.getenv('LARGE_VALUE_POLICY', 'hash').lower()
+LARGE_VALUE_PREFIX = os.getenv('LARGE_VALUE_PREFIX', '_values/')
+S3_OUTPUT_BUCKET = os.environ.get('S3_OUTPUT_BUCKET', None)
+S3_OUTPUT_BUCKET_REGION = os.environ.get('S3_OUTPUT_BUCKET_REGION', 'us-east-1')
+# Converter plans kept per (tag, VR), private tags are resolved on every call
+TAG_PLAN_CACHE_SIZE = int(os.environ.get('TAG_PLAN_CACHE_SIZE', 8192))
 
 log = get_logger(__name__)
 
@@ -19,16 +36,10 @@ def convert_DA(elem):
     # Convert DICOM DA to ISO format for datatype DATE compability
     try:
         if not elem.is_empty:
-            # Only return YYYY-MM-DD, exclude TIMESTAMP
-            # date = datetime.datetime.strptime(elem.value, '%Y%m%d').date()
             date = rep_string(elem)
             if isinstance(date, list):
-                date_list = []
-                for item in date:
-                    date_list.append(
-                        datetime.datetime.strptime(item, '%Y%m%d').date())
-                return date_list
-            return datetime.datetime.strptime(date, '%Y%m%d').date()
+                return [temporal.parse_DA(item) for item in date]
+            return temporal.parse_DA(date)
         return datetime.datetime.fromisoformat('1900-01-01').date()
     except Exception as e:
         log.error(e)
@@ -48,9 +59,59 @@ def convert_OB(elem):
         raise
 
 
+def convert_binary(elem):
+    # OB, OW, UN and other byte VRs, embedded images and documents can be megabytes
+    try:
+        if elem.is_empty or not isinstance(elem.value, bytes):
+            return rep_string(elem)
+        if len(elem.value) >= LARGE_VALUE_SIZE and LARGE_VALUE_POLICY != 'keep':
+            return large_value(elem.value)
+        if IGNORE_OB:
+            return 'IGNORED'
+        return rep_string(elem)
+    except Exception as e:
+        log.error(e)
+        raise
+
+
+def large_value(value=None, length=None):
+    # value is None for values deferred by pydicom, only their length is known
+    summary = {'Length': length if value is None else len(value)}
+    if value is not None and LARGE_VALUE_POLICY in ('hash', 's3'):
+        summary['Sha256'] = hashlib.sha256(value).hexdigest()
+        if LARGE_VALUE_POLICY == 's3':
+            summary['Location'] = store_value(summary['Sha256'], value)
+    return json.dumps(summary)
+
+
+def deferred_keyword(tag, raw):
+    # Keyword of a deferred binary element, other deferred values are not summarized
+    VR = raw.VR
+    if VR is None:
+        # Implicit VR files
+        if not pydicom.datadict.dictionary_has_tag(tag):
+            return None
+        VR = pydicom.datadict.dictionary_VR(tag)
+    if any(option in BINARY_VRS for option in VR.split(' or ')):
+        return pydicom.datadict.keyword_for_tag(tag) or None
+    return None
+
+
+def store_value(digest, value):
+    # Content addressed, the same value is stored once
+    import utils.aws as aws
+    key = f'{LARGE_VALUE_PREFIX}{digest}'
+    aws.get_client('s3', S3_OUTPUT_BUCKET_REGION).put_object(
+        Bucket=S3_OUTPUT_BUCKET, Key=key, Body=value, ServerSideEncryption='AES256')
+    return f's3://{S3_OUTPUT_BUCKET}/{key}'
+
+
 def convert_TM(elem):
-    # return string, athena does not support TIME data type ex HHMMSS.FFFFFF
-    return rep_string(elem)
+    # return string, athena does not support TIME data type. HH:MM:SS.FFFFFF compares as a time
+    time = rep_string(elem)
+    if isinstance(time, list):
+        return [temporal.format_TM(item) for item in time]
+    return temporal.format_TM(time)
 
 
 def generate_PN(elem):
@@ -112,22 +173,24 @@ def serialize_sets(obj):
         raise
 
 
+def parse_vm(vm):
+    # Maximum multiplicity of a dictionary VM ("1", "1-3", "2-2n")
+    split = vm.split('-')
+    if len(split) > 1:
+        max = split[1]
+        if 'n' in max:
+            return math.inf
+        return int(max)
+    return int(split[0])
+
+
 def validate_vm(obj):
     try:
-        log.debug(f'Validing Tag {obj.keyword} VM : {obj.VM} VR: {obj.VR}')
-        maxVM = pydicom._dicom_dict.DicomDictionary[obj.tag][1]
-        split = maxVM.split('-')
-        if len(split) > 1:
-            min = split[0]
-            max = split[1]
-            if 'n' in max:
-                max = math.inf
-            else:
-                max = int(max)
-        else:
-            min = int(split[0])
-            max = min
-        if max > 1:
+        max_vm = plan(obj.tag, obj.VR)[1]
+        # Tags missing from the dictionary keep the multiplicity of their value
+        if max_vm is None:
+            max_vm = obj.VM
+        if max_vm > 1:
             if isinstance(obj.value, pydicom.multival.MultiValue):
                 return obj.value._list
             elif isinstance(obj.value, list):
@@ -142,18 +205,10 @@ def validate_vm(obj):
 
 
 def convert_SQ(elem):
+    # list of {Path, Keyword, VR, Value} entries, one per element of every item and nested item
+    import utils.sequences as sequences
     try:
-        sq = {}
-        if (not elem.is_empty):
-            # sq[elem.keyword] = {}
-            for item in elem.value._list:
-                # Check for empty pydicom dataset
-                if item == pydicom.Dataset():
-                    return None
-                for i in item:
-                    sq[i.keyword] = vr_select(i)(i)
-            return sq
-        return rep_string(elem)
+        return sequences.flatten(elem)
     except Exception as e:
         log.error(e)
         raise
@@ -187,69 +242,93 @@ def return_float(elem):
 
 
 def convert_DT(elem):
+    # return Timestamp, None when a value is not a valid DT
     try:
         if not elem.is_empty:
-            # TODO properly evaluate timestamp format before applying datetime
-            # date = datetime.datetime.strptime(elem.value, '%Y%m%d').date()
             date = rep_string(elem)
             if isinstance(date, list):
-                date_list = []
-                for item in date:
-                    #date_list.append(datetime.datetime.strptime(item, '%Y%m%d%H%M%S.%f%z'))
-                    return elem.value
-                return date_list
-            # return datetime.datetime.strptime(elem.value, '%Y%m%d%H%M%S.%f%z')
-            return elem.value
-        # return datetime.datetime.strptime(elem.value, '%Y%m%d%H%M%S.%f%z')
-        return elem.value
+                return [temporal.parse_DT(item) for item in date]
+            return temporal.parse_DT(date)
+        return None
     except Exception as e:
         log.error(e)
         raise
 
 
+BINARY_VRS = {'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'UN'}
+
+# Duplicate keys of the original lookup resolved to rep_string for US and SS
+VR_CONVERTERS = {
+    'AE': rep_string,
+    'AS': rep_string,
+    'AT': return_integer,  # return integer
+    'CS': rep_string,  # return string
+    'DA': convert_DA,  # return datetime in YYYY-MM-DD format
+    'DS': rep_string,
+    'DT': convert_DT,  # return Timestamp
+    'FD': rep_string,  # return float
+    'FL': return_float,  # return float
+    'IS': rep_string,
+    'LO': rep_string,  # return string
+    'LT': rep_string,
+    'OB': convert_binary,
+    'OD': convert_binary,
+    'OF': convert_binary,
+    'OL': convert_binary,
+    'OW': convert_binary,
+    'OV': convert_binary,
+    'PN': convert_PN,  # return string if empty or return dict,
+    'SH': rep_string,  # return string
+    'SL': return_integer,
+    'SQ': convert_SQ,  # return list of struct
+    'SS': rep_string,
+    'ST': rep_string,
+    'SV': rep_string,
+    'TM': convert_TM,  # return string, TIME data type is not supported.
+    'UC': rep_string,
+    'UI': rep_string,  # return string
+    'UL': return_integer,  # return integer
+    'UN': convert_binary,
+    'UR': rep_string,
+    'US': rep_string,
+    'UT': rep_string,
+    'UV': rep_string,
+}
+
+
+def invalid_vr(elem):
+    # Unknown and unresolved ambiguous VRs ('US or SS') are kept as strings
+    metrics.record('invalid_vr', 0.0, elements=1)
+    return rep_string(elem)
+
+
+def resolve(tag, VR):
+    # Converter and maximum multiplicity of the dictionary VM of tag
+    converter = VR_CONVERTERS.get(VR)
+    if converter is None:
+        log.warning(f'Invalid VR {VR} of tag {tag:08X}, converted as a string')
+        converter = invalid_vr
+    max_vm = None
+    if pydicom.datadict.dictionary_has_tag(tag):
+        max_vm = parse_vm(pydicom.datadict.dictionary_VM(tag))
+    return converter, max_vm
+
+
+@functools.lru_cache(maxsize=TAG_PLAN_CACHE_SIZE)
+def cached_plan(tag, VR):
+    return resolve(tag, VR)
+
+
+def plan(tag, VR):
+    # (converter, max VM) of (tag, VR), resolved once and reused for every file
+    if tag >> 16 & 1:
+        return resolve(tag, VR)
+    return cached_plan(tag, VR)
+
+
 def vr_select(elem):
-    return {
-        'AE': rep_string,
-        'AS': rep_string,
-        'AT': return_integer,  # return integer
-        'CS': rep_string,  # return string
-        'DA': convert_DA,  # return datetime in YYYY-MM-DD format
-        'DS': rep_string,
-        'DT': convert_DT,  # return Timestamp
-        'FD': rep_string,  # return float
-        'FL': return_float,  # return float
-        'IS': rep_string,
-        'LO': rep_string,  # return string
-        'LT': rep_string,
-        'OB': rep_string,
-        'OD': rep_string,
-        'OF': rep_string,
-        'OL': rep_string,
-        'OW': rep_string,
-        'OV': rep_string,
-        'PN': convert_PN,  # return string if empty or return dict,
-        'SH': rep_string,  # return string
-        'SL': return_integer,
-        'SQ': convert_SQ,  # return struct
-        'SS': return_integer,
-        'ST': rep_string,
-        'SV': rep_string,
-        'TM': convert_TM,  # return string, TIME data type is not supported.
-        'UC': rep_string,
-        'UI': rep_string,  # return string
-        'UL': return_integer,  # return integer
-        'UN': rep_string,
-        'UR': rep_string,
-        'US': return_integer,  # return integer
-        'UT': rep_string,
-        'UV': rep_string,
-        'OB': rep_string,
-        'OW': rep_string,
-        'US': rep_string,
-        'SS': rep_string,
-        'US': rep_string,
-        'OW': rep_string,
-        'US': rep_string,
-        'SS': rep_string,
-        'OW': rep_string,
-    }.get(elem.VR, f'Invalid VR {elem.VR} tag')
+    return lookup(elem.tag, elem.VR)
+
+
+def lookup(tag, VR):
+    return plan(tag, VR)[0]
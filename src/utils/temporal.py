@@ -0,0 +1,67 @@
+# DICOM DA, DT and TM values as dates, timestamps and times of day, parsed once per distinct value
+# http://dicom.nema.org/medical/dicom/current/output/chtml/part05/sect_6.2.html
+import os
+import re
+import datetime
+import functools
+
+# Distinct values kept per VR, the dates and times of a study repeat on every instance
+TEMPORAL_CACHE_SIZE = int(os.environ.get('TEMPORAL_CACHE_SIZE', 4096))
+# HH, HHMM, HHMMSS, HHMMSS.F to HHMMSS.FFFFFF and the ACR-NEMA HH:MM:SS form
+TM = re.compile(r'^(\d{2})(?::?(\d{2})(?::?(\d{2})(?:\.(\d{1,6}))?)?)?$')
+# YYYY[MM[DD[HH[MM[SS[.F]]]]]][&ZZXX]
+DT = re.compile(r'^(\d{4})(\d{2})?(\d{2})?(\d{2})?(\d{2})?(\d{2})?(?:\.(\d{1,6}))?([+-]\d{4})?$')
+
+
+def microseconds(fraction):
+    return int(fraction.ljust(6, '0')) if fraction else 0
+
+
+@functools.lru_cache(maxsize=TEMPORAL_CACHE_SIZE)
+def parse_DA(value):
+    if len(value) == 8 and value.isascii() and value.isdigit():
+        return datetime.date(int(value[:4]), int(value[4:6]), int(value[6:]))
+    # Other forms are accepted or rejected as by strptime before
+    return datetime.datetime.strptime(value, '%Y%m%d').date()
+
+
+@functools.lru_cache(maxsize=TEMPORAL_CACHE_SIZE)
+def parse_TM(value):
+    # None when value is not a valid time
+    match = TM.match(value.strip())
+    if match is None:
+        return None
+    hour, minute, second, fraction = match.groups()
+    try:
+        # 60 is a leap second
+        return datetime.time(int(hour), int(minute or 0), min(int(second or 0), 59), microseconds(fraction))
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=TEMPORAL_CACHE_SIZE)
+def parse_DT(value):
+    # Missing components are the start of the period. Values with a UTC offset are converted to UTC,
+    # values without one are left in the local time of the modality. None when value is not valid
+    match = DT.match(value.strip())
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    try:
+        timestamp = datetime.datetime(int(year), int(month or 1), int(day or 1), int(hour or 0), int(minute or 0),
+                                      min(int(second or 0), 59), microseconds(fraction))
+    except ValueError:
+        return None
+    if offset:
+        sign = -1 if offset[0] == '-' else 1
+        timestamp -= sign * datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[3:]))
+    return timestamp
+
+
+@functools.lru_cache(maxsize=TEMPORAL_CACHE_SIZE)
+def format_TM(value):
+    # Fixed width HH:MM:SS.FFFFFF sorts and compares in time order, invalid values are kept as is
+    time = parse_TM(value)
+    if time is None:
+        return value
+    return time.isoformat(timespec='microseconds')
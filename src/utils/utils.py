@@ -1,51 +1,151 @@
 import os
+import io
+import re
+import unicodedata
 from logger import get_logger
 log = get_logger(__name__)
 
 
-def unzip(zip_archive):
+def zip_fingerprint(file):
+    return {'size': file.file_size, 'crc': file.CRC, 'mtime': list(file.date_time)}
+
+
+def tar_fingerprint(file):
+    return {'size': file.size, 'mtime': file.mtime}
+
+
+def unzip(zip_archive, skip=None, prefetch=None):
     log.debug(f'Prep to unzip {zip_archive.filename}')
-    list_files = []
+    files = []
     for file in zip_archive.infolist():
         # Skip Directories and DICOMDIR file
         if not file.is_dir() and (file.filename.upper().find('DICOMDIR') == -1):
-            # Check if DICOM header is present
-            f = zip_archive.open(file)
-            # f.read(128)
-            # magic = f.read(4)
-            # if magic != b'DICM':
-            #     log.info(f'Ignore File in ZipFile, Not Valid DCM file "{file.filename}"')
-            if check_dcm(f):
-                # Add File to list
-                list_files.append(zip_archive.open(file))
-                log.debug(f'Added "{file.filename}" to process queue')
-            else:
-                log.info(
-                    f'Ignore File in ZipFile, Not Valid DCM file "{file.filename}"')
-            f.close()
+            if skip is not None and skip(file.filename, zip_fingerprint(file)):
+                log.debug(f'Skip unchanged File in ZipFile "{file.filename}"')
+                continue
+            files.append(file)
         else:
             log.info(f'Ignore File in ZipFile, "{file.filename}"')
-    return list_files
+    # prefetch(files) is told upfront which members will be read
+    if prefetch is not None:
+        prefetch(files)
+    for file in files:
+        # Check if DICOM header is present, the sniffed bytes are kept for dcmread
+        f = memberfile(zip_archive.open(file), file.filename)
+        if check_dcm(f):
+            f.seek(0)
+            log.debug(f'Added "{file.filename}" to process queue')
+            yield f
+        else:
+            log.info(
+                f'Ignore File in ZipFile, Not Valid DCM file "{file.filename}"')
+            f.close()
 
 
-def tar(tar_archive):
+def tar(tar_archive, skip=None):
     log.debug(f'Prep to tar/bz2 {tar_archive.name}')
-    list_files = []
     for file in tar_archive.getmembers():
         if file.isfile() and (file.name.upper().find('DICOMDIR') == -1):
-            f = tar_archive.extractfile(file)
+            if skip is not None and skip(file.name, tar_fingerprint(file)):
+                log.debug(f'Skip unchanged File in TarFile "{file.name}"')
+                continue
+            f = memberfile(tar_archive.extractfile(file), file.name)
             if check_dcm(f):
-                tarfile = tar_archive.extractfile(file)
-                tarfile.tarname = file.name
-                list_files.append(tarfile)
+                f.seek(0)
+                f.tarname = file.name
                 log.debug(f'Added {file.name} to process queue')
+                yield f
             else:
                 log.info(
                     f'Ignore File in TarFile, Not Valid DCM files "{file.name}"')
-            f.close()
+                f.close()
+        else:
+            log.info(f'Ignore file-path in TarFile "{file.name}"')
+
+
+def tar_stream(tar_archive, skip=None):
+    log.debug(f'Prep to stream tar members {tar_archive.name}')
+    for file in tar_archive:
+        if file.isfile() and (file.name.upper().find('DICOMDIR') == -1):
+            if skip is not None and skip(file.name, tar_fingerprint(file)):
+                log.debug(f'Skip unchanged File in TarFile "{file.name}"')
+                continue
+            f = memberfile(tar_archive.extractfile(file), file.name)
+            # Stream mode only allows reading the current member until the archive advances
+            f.sequential = True
+            if check_dcm(f):
+                f.seek(0)
+                f.tarname = file.name
+                log.debug(f'Added {file.name} to process queue')
+                yield f
+            else:
+                log.info(
+                    f'Ignore File in TarFile, Not Valid DCM files "{file.name}"')
+                f.close()
         else:
             log.info(f'Ignore file-path in TarFile "{file.name}"')
-    return list_files
+
+
+class memberfile(io.RawIOBase):
+    # Single pass view of an archive member, the bytes read so far are kept so the
+    # preamble check and dcmread share one pass through the decompressor
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+        self.sequential = False
+        self.buffer = bytearray()
+        self.position = 0
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            self.fill()
+            position = len(self.buffer) + offset
+        else:
+            raise ValueError(f'Invalid whence {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+        self.position = position
+        return self.position
+
+    def fetch(self, end):
+        while not self.eof and len(self.buffer) < end:
+            data = self.stream.read(end - len(self.buffer))
+            if not data:
+                self.eof = True
+            self.buffer += data
+
+    def fill(self):
+        # Read the rest of the member, the handle no longer depends on the archive position
+        if not self.eof:
+            self.buffer += self.stream.read()
+            self.eof = True
+
+    def readinto(self, b):
+        self.fetch(self.position + len(b))
+        data = self.buffer[self.position:self.position + len(b)]
+        size = len(data)
+        b[:size] = data
+        self.position += size
+        return size
+
+    def close(self):
+        self.buffer = bytearray()
+        self.stream.close()
+        super().close()
 
 
 def check_dcm(file):
@@ -58,6 +158,18 @@ def check_dcm(file):
         return True
 
 
+def str2bool(value):
+    # Environment variables are strings, "false" must not be truthy
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def sanitize_column_name(name):
+    # Same column naming as awswrangler sanitize_columns, CamelCase to snake_case
+    name = ''.join(c for c in unicodedata.normalize('NFD', name) if unicodedata.category(c) != 'Mn')
+    name = re.sub('[^A-Za-z0-9_]+', '_', name)
+    return re.sub('([a-z0-9])([A-Z])', r'\1_\2', name).lower()
+
+
 def getname(name):
     if hasattr(name, 'tarname'):
         return name.tarname
@@ -0,0 +1,28 @@
+import os
+import sys
+import pytest
+from urllib import request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('LOGLEVEL', 'WARNING')
+
+
+@pytest.fixture
+def moto(monkeypatch):
+    # S3 served by moto on a local port, for boto3 clients and the pyarrow S3 filesystem
+    from moto.server import ThreadedMotoServer
+    import utils.aws as aws
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    for name, value in {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing',
+                        'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_ENDPOINT_URL': f'http://{host}:{port}'}.items():
+        monkeypatch.setenv(name, value)
+    aws.clients.clear()
+    aws.get_session.cache_clear()
+    yield f'{host}:{port}'
+    aws.clients.clear()
+    aws.get_session.cache_clear()
+    # Backends are shared by every server of the process
+    request.urlopen(request.Request(f'http://{host}:{port}/moto-api/reset', method='POST'))
+    server.stop()
@@ -0,0 +1,32 @@
+# Partial study and series rows of each write and the views merging them
+import re
+import pyarrow as pa
+import aggregates
+
+
+def write(uids, instance_numbers):
+    return pa.table({
+        'study_instance_uid': ['1.2'] * len(uids),
+        'series_instance_uid': uids,
+        'instance_number': instance_numbers,
+        'modality': ['CT'] * len(uids),
+    })
+
+
+def test_combine_merges_the_partial_rows_of_every_write():
+    partials = pa.concat_tables([aggregates.summarize(write(['1.2.1', '1.2.1'], ['9', '10']), 'study'),
+                                 aggregates.summarize(write(['1.2.2'], ['2']), 'study')])
+    assert partials.num_rows == 2
+    study = aggregates.combine(partials, 'study').to_pydict()
+    assert study['instance_count'] == [3]
+    assert study['min_instance_number'] == ['2'] and study['max_instance_number'] == ['10']
+    assert study['distinct_series_instance_uid'] == [['1.2.1', '1.2.2']]
+
+
+def test_views_select_every_column_of_the_partial_rows():
+    for level in aggregates.LEVELS:
+        sql = aggregates.view_sql(level)
+        selected = set(re.findall(r'AS (\w+)', sql)) | set(aggregates.LEVELS[level])
+        assert set(aggregates.summarize(write(['1.2.1'], ['1']), level).column_names) <= selected
+        assert sql.endswith(f'GROUP BY {", ".join(aggregates.LEVELS[level])}')
+        assert f'FROM {aggregates.AGGREGATE_TABLES[level]}' in sql
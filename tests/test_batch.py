@@ -0,0 +1,47 @@
+# Settings of the Lambda function are forwarded to the AWS Batch jobs it submits
+import app
+from dicomwrapper import dcmfile
+
+
+class batch():
+    def __init__(self):
+        self.jobs = []
+
+    def submit_job(self, **job):
+        self.jobs.append(job)
+        return {'jobArn': 'arn:aws:batch:us-east-1:123456789012:job/dicom'}
+
+
+def submit(monkeypatch, checkpoint=None):
+    client = batch()
+    monkeypatch.setattr(app.aws, 'get_client', lambda *args: client)
+    dcm = dcmfile(source_s3_bucket='dicom-input', source_s3_bucket_region='us-east-1', source_s3_key='study.zip')
+    app.submit_batch(dcm, checkpoint)
+    return {item['name']: item['value'] for item in client.jobs[0]['containerOverrides']['environment']}
+
+
+def test_submit_batch_forwards_extraction_settings(monkeypatch):
+    for name in app.EXTRACTION_SETTINGS:
+        monkeypatch.delenv(name, raising=False)
+    settings = {'TAG_PROFILE': 'minimal', 'LARGE_VALUE_POLICY': 's3', 'SQ_MAX_DEPTH': '2', 'DATE_FALLBACK': 'SeriesDate'}
+    for name, value in settings.items():
+        monkeypatch.setenv(name, value)
+    environment = submit(monkeypatch, 'checkpoints/study.json')
+    assert {name: environment[name] for name in settings} == settings
+    assert environment['CHECKPOINT'] == 'checkpoints/study.json'
+    assert environment['S3_KEY'] == 'study.zip'
+    # Unset settings keep the defaults of the job definition
+    assert not set(app.EXTRACTION_SETTINGS) - set(settings) & set(environment)
+
+
+def test_extraction_settings_cover_module_settings():
+    import utils.selection as selection
+    import utils.sequences as sequences
+    import utils.tags as tags
+    import utils.partitioning as partitioning
+    for name in ['TAG_PROFILE', 'TAG_KEYWORDS', 'DEFER_SIZE', 'SQ_MAX_DEPTH', 'SQ_MAX_ITEMS', 'IGNORE_OB',
+                 'LARGE_VALUE_SIZE', 'LARGE_VALUE_POLICY', 'LARGE_VALUE_PREFIX', 'DATE_FALLBACK', 'PARTITION_COLS',
+                 'SORT_KEYS', 'FAST_PARSE', 'INCREMENTAL']:
+        assert name in app.EXTRACTION_SETTINGS
+        assert any(hasattr(module, name) for module in (app, selection, sequences, tags, partitioning,
+                                                        app.fastparse))
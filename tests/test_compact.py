@@ -0,0 +1,219 @@
+# Compaction of a partition on a local directory and on S3 served by moto
+import io
+import json
+import pytest
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pyarrow import fs
+import compact
+import manifest
+import utils.aws as aws
+
+PARTITION = 'study_date=2021-11-03'
+BUCKET = 'dicom-output'
+
+
+def rows(start, count, extra=None):
+    columns = {
+        'sop_instance_uid': [f'1.2.3.{index}' for index in range(start, start + count)],
+        'instance_number': [str(index) for index in range(start, start + count)],
+        'source_s3_bucket': ['dicom-input'] * count,
+        'source_s3_key': [f'studies/archive-{start}.zip'] * count,
+        'source_s3_archive_path': [f'{index}.dcm' for index in range(start, start + count)],
+    }
+    if extra:
+        columns[extra] = ['value'] * count
+    return pa.table(columns)
+
+
+def parquet(table):
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    return buffer.getvalue()
+
+
+def listing(filesystem, path):
+    return sorted(info.base_name for info in filesystem.get_file_info(fs.FileSelector(path)))
+
+
+def read_partition(filesystem, path):
+    tables = [pq.read_table(info.path, filesystem=filesystem)
+              for info in filesystem.get_file_info(fs.FileSelector(path)) if compact.is_data_file(info)]
+    return sorted(compact.unify(tables).column('sop_instance_uid').to_pylist())
+
+
+def keys(client):
+    # Deleting the last file of a directory leaves a directory marker
+    return [item['Key'] for item in client.list_objects_v2(Bucket=BUCKET).get('Contents', [])
+            if not item['Key'].endswith('/')]
+
+
+def expected():
+    return sorted(f'1.2.3.{index}' for index in range(0, 30))
+
+
+def crash(monkeypatch):
+    # The first publish fails, as if the job stopped after writing the staged file and the journal
+    publish = compact.publish
+    calls = []
+
+    def interrupted(filesystem, journal_path):
+        calls.append(journal_path)
+        if len(calls) == 1:
+            raise RuntimeError('Interrupted')
+        return publish(filesystem, journal_path)
+    monkeypatch.setattr(compact, 'publish', interrupted)
+
+
+@pytest.fixture
+def local(tmp_path):
+    filesystem = fs.LocalFileSystem()
+    path = f'{tmp_path}/{PARTITION}'
+    filesystem.create_dir(path)
+    for index, extra in enumerate([None, 'series_description', 'body_part_examined']):
+        with filesystem.open_output_stream(f'{path}/file-{index}.snappy.parquet') as f:
+            f.write(parquet(rows(index * 10, 10, extra)))
+    return filesystem, str(tmp_path), path
+
+
+@pytest.fixture
+def s3(moto):
+    client = aws.get_client('s3', 'us-east-1')
+    client.create_bucket(Bucket=BUCKET)
+    for index, extra in enumerate([None, 'series_description', 'body_part_examined']):
+        client.put_object(Bucket=BUCKET, Key=f'{PARTITION}/file-{index}.snappy.parquet',
+                          Body=parquet(rows(index * 10, 10, extra)))
+    filesystem = fs.S3FileSystem(access_key='testing', secret_key='testing', region='us-east-1',
+                                 scheme='http', endpoint_override=moto)
+    return filesystem, client
+
+
+def test_plan_packs_small_files_up_to_target_size():
+    files = [fs.FileInfo(f'p/{name}.parquet', type=fs.FileType.File, size=size)
+             for name, size in [('a', 40), ('b', 40), ('c', 40), ('d', 100), ('e', 10)]]
+    groups = compact.plan(files, 100)
+    assert [[info.base_name for info in group] for group in groups] == [['a.parquet', 'b.parquet'],
+                                                                        ['c.parquet', 'e.parquet']]
+
+
+def test_plan_rewrites_tombstoned_files():
+    files = [fs.FileInfo('p/a.parquet', type=fs.FileType.File, size=100)]
+    assert compact.plan(files, 100) == []
+    assert [[info.path for info in group] for group in compact.plan(files, 100, rewrite={'p/a.parquet'})] == [
+        ['p/a.parquet']]
+
+
+def test_unify_adds_missing_columns_as_null():
+    table = compact.unify([rows(0, 2, 'series_description'), rows(2, 2, 'body_part_examined')])
+    assert table.num_rows == 4
+    assert table.column('series_description').to_pylist() == ['value', 'value', None, None]
+    assert table.column('body_part_examined').to_pylist() == [None, None, 'value', 'value']
+
+
+def test_compact_local(local):
+    filesystem, root, path = local
+    outputs = compact.compact(root, [PARTITION])
+    assert len(outputs) == 1
+    assert listing(filesystem, path) == [outputs[0].rsplit('/', 1)[1]]
+    assert read_partition(filesystem, path) == expected()
+
+
+def test_crash_between_staging_and_publish_local(local, monkeypatch):
+    filesystem, root, path = local
+    crash(monkeypatch)
+    with pytest.raises(RuntimeError):
+        compact.compact(root, [PARTITION])
+    # Staged files and journals are hidden from Athena, readers still see the inputs only
+    names = listing(filesystem, path)
+    assert sum(name.startswith('_staged-') for name in names) == 1
+    assert sum(name.startswith('_compaction-') for name in names) == 1
+    assert read_partition(filesystem, path) == expected()
+    # The next run publishes the staged file instead of compacting the inputs again
+    compact.compact(root, [PARTITION])
+    names = listing(filesystem, path)
+    assert len(names) == 1 and not names[0].startswith('_')
+    assert read_partition(filesystem, path) == expected()
+
+
+def test_recover_completes_a_published_move(local):
+    filesystem, root, path = local
+    # Stopped after the staged file was moved, before the inputs were removed
+    table = compact.unify([pq.read_table(f'{path}/file-{index}.snappy.parquet') for index in range(3)])
+    with filesystem.open_output_stream(f'{path}/merged.snappy.parquet') as f:
+        f.write(parquet(table))
+    journal = {
+        'inputs': [f'{path}/file-{index}.snappy.parquet' for index in range(3)],
+        'staged': f'{path}/_staged-merged.snappy.parquet',
+        'output': f'{path}/merged.snappy.parquet',
+    }
+    with filesystem.open_output_stream(f'{path}/_compaction-merged.json') as f:
+        f.write(json.dumps(journal).encode('utf-8'))
+    compact.recover(filesystem, path)
+    assert listing(filesystem, path) == ['merged.snappy.parquet']
+    assert read_partition(filesystem, path) == expected()
+
+
+def test_compact_s3_encrypts_and_tags_like_output(s3):
+    filesystem, client = s3
+    outputs = compact.compact_partition(filesystem, f'{BUCKET}/{PARTITION}')
+    assert len(outputs) == 1
+    key = outputs[0].split('/', 1)[1]
+    assert keys(client) == [key]
+    assert client.head_object(Bucket=BUCKET, Key=key)['ServerSideEncryption'] == 'AES256'
+    tags = {tag['Key']: tag['Value'] for tag in client.get_object_tagging(Bucket=BUCKET, Key=key)['TagSet']}
+    assert tags == {'S3_BUCKET': 'dicom-input', 'S3_KEY': 'studies/archive-'}
+    assert read_partition(filesystem, f'{BUCKET}/{PARTITION}') == expected()
+
+
+def test_crash_between_staging_and_publish_s3(s3, monkeypatch):
+    filesystem, client = s3
+    crash(monkeypatch)
+    with pytest.raises(RuntimeError):
+        compact.compact_partition(filesystem, f'{BUCKET}/{PARTITION}')
+    names = keys(client)
+    assert len(names) == 5
+    staged = [key for key in names if '/_staged-' in key]
+    assert client.head_object(Bucket=BUCKET, Key=staged[0])['ServerSideEncryption'] == 'AES256'
+    assert read_partition(filesystem, f'{BUCKET}/{PARTITION}') == expected()
+    outputs = compact.compact_partition(filesystem, f'{BUCKET}/{PARTITION}')
+    assert outputs == []
+    names = keys(client)
+    assert names == [staged[0].replace('/_staged-', '/')]
+    assert client.head_object(Bucket=BUCKET, Key=names[0])['ServerSideEncryption'] == 'AES256'
+    assert client.get_object_tagging(Bucket=BUCKET, Key=names[0])['TagSet']
+    assert read_partition(filesystem, f'{BUCKET}/{PARTITION}') == expected()
+
+
+def test_tombstones_after_compaction_name_the_merged_file(s3, monkeypatch):
+    filesystem, client = s3
+    monkeypatch.setattr(compact, 'INCREMENTAL', True)
+    monkeypatch.setattr(manifest, 'S3_OUTPUT_BUCKET', BUCKET)
+    path = f'{BUCKET}/{PARTITION}'
+    # The rows of studies/archive-0.zip were written to file-0 by an incremental extraction
+    first = manifest.manifest('dicom-input', 'studies/archive-0.zip')
+    for index in range(10):
+        first.unchanged(f'{index}.dcm', {'crc': index})
+    first.record(rows(0, 10), f's3://{path}/file-0.snappy.parquet')
+    first.commit()
+    merged = compact.compact_partition(filesystem, path)
+    members = manifest.load('dicom-input', 'studies/archive-0.zip').members
+    assert {entry['path'] for entry in members.values()} == {f's3://{merged[0]}'}
+    # Uploaded again with 3.dcm changed, its new row is written to a new file
+    second = manifest.load('dicom-input', 'studies/archive-0.zip')
+    for index in range(10):
+        second.unchanged(f'{index}.dcm', {'crc': 99 if index == 3 else index})
+    replacement = rows(0, 10, 'series_description').slice(3, 1)
+    client.put_object(Bucket=BUCKET, Key=f'{PARTITION}/file-3.snappy.parquet', Body=parquet(replacement))
+    second.record(replacement, f's3://{path}/file-3.snappy.parquet')
+    second.commit()
+    tombstones = compact.load_tombstones(filesystem, f'{BUCKET}/{compact.TOMBSTONE_PREFIX}'.rstrip('/'))
+    assert tombstones == {merged[0]: {('studies/archive-0.zip', '3.dcm')}}
+    outputs = compact.compact_partition(filesystem, path, tombstones=tombstones)
+    assert len(outputs) == 1
+    table = pq.read_table(outputs[0], filesystem=filesystem)
+    assert sorted(table.column('sop_instance_uid').to_pylist()) == expected()
+    replaced = table.filter(pc.equal(table.column('sop_instance_uid'), '1.2.3.3'))
+    assert replaced.column('series_description').to_pylist() == ['value']
+    members = manifest.load('dicom-input', 'studies/archive-0.zip').members
+    assert {entry['path'] for entry in members.values()} == {f's3://{outputs[0]}'}
@@ -0,0 +1,81 @@
+# Object and instance dedup on the sqlite index
+import json
+import pytest
+import pyarrow as pa
+import dedup
+import manifest
+
+
+def rows(key, uids):
+    return pa.table({
+        dedup.INSTANCE_COLUMN: uids,
+        'source_s3_bucket': ['dicom-input'] * len(uids),
+        'source_s3_key': [key] * len(uids),
+        'source_s3_archive_path': [f'{uid}.dcm' for uid in uids],
+    })
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    index = dedup.sqliteindex(f'{tmp_path}/dedup.sqlite')
+    monkeypatch.setattr(dedup, 'get_index', lambda: index)
+    return index
+
+
+@pytest.fixture
+def tombstones(monkeypatch):
+    written = []
+    monkeypatch.setattr(manifest, 'write_tombstones', lambda previous, stale: written.append(
+        (previous.source_s3_bucket, previous.source_s3_key, stale)))
+    return written
+
+
+def test_no_index(monkeypatch):
+    monkeypatch.setattr(dedup, 'get_index', lambda: None)
+    assert not dedup.is_processed('dicom-input', 'study.dcm', 'etag-1')
+    table = rows('study.dcm', ['1.2.3'])
+    assert dedup.drop_seen(table) is table
+
+
+def test_is_processed_per_etag(index):
+    assert not dedup.is_processed('dicom-input', 'study.dcm', 'etag-1')
+    dedup.mark_processed('dicom-input', 'study.dcm', 'etag-1', ['s3://dicom-output/a.snappy.parquet'])
+    assert dedup.is_processed('dicom-input', 'study.dcm', 'etag-1')
+    # A new upload of the same key is extracted again
+    assert not dedup.is_processed('dicom-input', 'study.dcm', 'etag-2')
+    assert not dedup.is_processed('dicom-input', 'other.dcm', 'etag-1')
+    assert not dedup.is_processed('dicom-input', 'study.dcm', None)
+
+
+def test_drop_seen_skips_instances_of_other_objects(index, tombstones):
+    dedup.record_instances(rows('first.zip', ['1.2.1', '1.2.2']), 's3://dicom-output/a.snappy.parquet')
+    table = dedup.drop_seen(rows('second.zip', ['1.2.2', '1.2.3', '1.2.3']))
+    assert table.column(dedup.INSTANCE_COLUMN).to_pylist() == ['1.2.3']
+    assert tombstones == []
+
+
+def test_reupload_replaces_instances_of_the_same_object(index, tombstones):
+    dedup.record_instances(rows('study.dcm', ['1.2.1']), 's3://dicom-output/a.snappy.parquet')
+    # The corrected file uploaded again under the same key with a new ETag
+    table = dedup.drop_seen(rows('study.dcm', ['1.2.1']))
+    assert table.column(dedup.INSTANCE_COLUMN).to_pylist() == ['1.2.1']
+    dedup.record_instances(table, 's3://dicom-output/b.snappy.parquet')
+    assert dedup.seen_instances(['1.2.1']) == {
+        '1.2.1': {'path': 's3://dicom-output/b.snappy.parquet', 'source': 'dicom-input/study.dcm'}}
+    assert tombstones == [('dicom-input', 'study.dcm',
+                           {'1.2.1.dcm': {'path': 's3://dicom-output/a.snappy.parquet', 'uid': '1.2.1'}})]
+    # Another object with the same instance is still skipped
+    assert dedup.drop_seen(rows('copy.dcm', ['1.2.1'])).num_rows == 0
+
+
+def test_entries_without_source_skip_every_object(index, tombstones):
+    index.put({dedup.instance_key('1.2.1'): 's3://dicom-output/a.snappy.parquet'})
+    assert dedup.seen_instances(['1.2.1']) == {'1.2.1': {'path': 's3://dicom-output/a.snappy.parquet', 'source': None}}
+    assert dedup.drop_seen(rows('study.dcm', ['1.2.1'])).num_rows == 0
+
+
+def test_relocate_instances_keeps_the_source(index):
+    dedup.record_instances(rows('study.dcm', ['1.2.1']), 's3://dicom-output/p/a.snappy.parquet')
+    dedup.relocate_instances(['1.2.1'], {'dicom-output/p/a.snappy.parquet': 's3://dicom-output/p/merged.snappy.parquet'})
+    entry = json.loads(index.get([dedup.instance_key('1.2.1')])[dedup.instance_key('1.2.1')])
+    assert entry == {'path': 's3://dicom-output/p/merged.snappy.parquet', 'source': 'dicom-input/study.dcm'}
@@ -0,0 +1,57 @@
+# fastparse.dcmread and pydicom extract the same rows from the sample files and the pydicom test files
+import os
+import sys
+import pytest
+import pydicom
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import differential  # noqa: E402
+import utils.selection as selection  # noqa: E402
+from dicomwrapper import dcmfile  # noqa: E402
+
+PATHS = [os.path.join(ROOT, 'sample_dcm'), os.path.join(os.path.dirname(pydicom.data.__file__), 'test_files')]
+# Default settings, large values left in the file, and a tag selection with sequences
+SETTINGS = {
+    'default': {},
+    'defer': {'DEFER_SIZE': '100'},
+    'selection': {'TAG_KEYWORDS': 'PatientID,Modality,StudyDescription,DirectoryRecordSequence,ReferencedImageSequence'},
+    'defer-selection': {'DEFER_SIZE': '100', 'TAG_KEYWORDS': 'PatientID,Modality,DirectoryRecordSequence'},
+}
+FILES = [(os.path.relpath(name, os.path.dirname(path)), name, data)
+         for path in PATHS for name, data in differential.members(path)]
+
+
+def test_files_are_read_by_fastparse():
+    assert len(FILES) > 50
+    assert sum(differential.fast_read(data) is not None for _, _, data in FILES) > 50
+
+
+@pytest.fixture(params=list(SETTINGS))
+def settings(request, monkeypatch):
+    for name, value in SETTINGS[request.param].items():
+        monkeypatch.setattr(selection, name, value)
+    selection.selected_tags.cache_clear()
+    selection.selected_set.cache_clear()
+    yield request.param
+    selection.selected_tags.cache_clear()
+    selection.selected_set.cache_clear()
+
+
+@pytest.mark.parametrize('name,data', [(name, data) for _, name, data in FILES], ids=[file[0] for file in FILES])
+def test_fastparse_matches_pydicom(settings, name, data):
+    dcm = dcmfile(source_s3_bucket='differential', source_s3_bucket_region='us-east-1', source_s3_key='differential')
+    try:
+        expected = dcm.transform(name, differential.pydicom_read(data))
+    except Exception as e:
+        # e.g. ExplVR_BigEnd.dcm, its DA value 1997.04.24 is not a DICOM date
+        pytest.skip(f'pydicom path can not extract {name}: {e!r}')
+    image = differential.fast_read(data)
+    if image is None:
+        # Read by pydicom in production too
+        return
+    actual = dcm.transform(name, image)
+    differences = {key: (expected.get(key, '<missing>'), actual.get(key, '<missing>'))
+                   for key in set(expected) | set(actual) if expected.get(key, '<missing>') != actual.get(key, '<missing>')}
+    assert differences == {}
@@ -0,0 +1,91 @@
+# Incremental extraction of an archive uploaded again under the same key
+import io
+import os
+import zipfile
+import pytest
+import pyarrow.parquet as pq
+import aggregates
+import app
+import dedup
+import manifest
+import utils.aws as aws
+
+SAMPLES = os.path.join(os.path.dirname(__file__), '..', 'sample_dcm')
+INPUT = 'dicom-input'
+OUTPUT = 'dicom-output'
+
+
+def archive(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as z:
+        for name, sample in members:
+            z.write(os.path.join(SAMPLES, sample), name)
+    return buffer.getvalue()
+
+
+def event(body, etag):
+    return {'Records': [{'awsRegion': 'us-east-1', 's3': {'bucket': {'name': INPUT},
+                                                          'object': {'key': 'study.zip', 'size': len(body), 'eTag': etag}}}]}
+
+
+def read(client, key):
+    return pq.read_table(io.BytesIO(client.get_object(Bucket=OUTPUT, Key=key)['Body'].read()))
+
+
+def keys(client, prefix=''):
+    return sorted(item['Key'] for item in client.list_objects_v2(Bucket=OUTPUT, Prefix=prefix).get('Contents', []))
+
+
+@pytest.fixture
+def extraction(moto, monkeypatch):
+    for module in (app, manifest, aggregates):
+        monkeypatch.setattr(module, 'S3_OUTPUT_BUCKET', OUTPUT)
+    monkeypatch.setattr(app, 'INCREMENTAL', True)
+    client = aws.get_client('s3', 'us-east-1')
+    client.create_bucket(Bucket=INPUT)
+    client.create_bucket(Bucket=OUTPUT)
+    parsed = []
+    forgotten = []
+    transform = app.transform
+    monkeypatch.setattr(app, 'transform', lambda dcm, member: parsed.append(member[0]) or transform(dcm, member))
+    monkeypatch.setattr(dedup, 'forget_instances', forgotten.extend)
+
+    def upload(members, etag):
+        del parsed[:]
+        body = archive(members)
+        client.put_object(Bucket=INPUT, Key='study.zip', Body=body)
+        before = set(keys(client))
+        app.lambda_handler(event(body, etag), None)
+        return [key for key in keys(client) if key not in before]
+    return client, upload, parsed, forgotten
+
+
+def test_reupload_parses_changed_members_and_tombstones_replaced_rows(extraction):
+    client, upload, parsed, forgotten = extraction
+    written = upload([('x.dcm', 'example-0'), ('y.dcm', 'example-6'), ('w.dcm', 'example-0')], 'etag-1')
+    assert parsed == ['x.dcm', 'y.dcm', 'w.dcm']
+    first = [key for key in written if not key.startswith('_')]
+    assert len(first) == 2 and not keys(client, manifest.TOMBSTONE_PREFIX)
+    uids = {row['source_s3_archive_path']: row[dedup.INSTANCE_COLUMN]
+            for key in first for row in read(client, key).to_pylist()}
+    paths = {row['source_s3_archive_path']: f's3://{OUTPUT}/{key}'
+             for key in first for row in read(client, key).to_pylist()}
+    # x.dcm changed, y.dcm is the same, w.dcm removed and z.dcm added
+    written = upload([('x.dcm', 'example-6'), ('y.dcm', 'example-6'), ('z.dcm', 'example-0')], 'etag-2')
+    assert parsed == ['x.dcm', 'z.dcm']
+    assert forgotten == [uids['x.dcm']]
+    rows = [row for key in written if not key.startswith('_') for row in read(client, key).to_pylist()]
+    assert sorted(row['source_s3_archive_path'] for row in rows) == ['x.dcm', 'z.dcm']
+    tombstones = keys(client, manifest.TOMBSTONE_PREFIX)
+    assert len(tombstones) == 1
+    table = read(client, tombstones[0])
+    assert sorted(table.drop(['tombstoned_at']).to_pylist(), key=lambda row: row['source_s3_archive_path']) == [
+        {'source_s3_bucket': INPUT, 'source_s3_key': 'study.zip', 'source_s3_archive_path': name,
+         dedup.INSTANCE_COLUMN: uids[name], 'output_path': paths[name]} for name in ('w.dcm', 'x.dcm')]
+    members = manifest.load(INPUT, 'study.zip').members
+    assert sorted(members) == ['x.dcm', 'y.dcm', 'z.dcm']
+    assert members['y.dcm']['path'] == paths['y.dcm']
+    # The same archive again parses nothing and tombstones nothing
+    upload([('x.dcm', 'example-6'), ('y.dcm', 'example-6'), ('z.dcm', 'example-0')], 'etag-3')
+    assert parsed == []
+    assert keys(client, manifest.TOMBSTONE_PREFIX) == tombstones
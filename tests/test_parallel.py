@@ -0,0 +1,95 @@
+# Rows parsed by a thread or process pool come out in the order of a serial run
+import os
+import time
+import zipfile
+import pytest
+from functools import partial
+import app
+from dicomwrapper import dcmfile
+from utils.parallel import ordered_map
+from utils.utils import unzip
+
+SAMPLES = os.path.join(os.path.dirname(__file__), '..', 'sample_dcm')
+EXECUTORS = ['thread', 'process']
+
+
+class archive():
+    def __init__(self, path):
+        self.file_list = unzip(zipfile.ZipFile(path))
+
+
+def slow(item):
+    # Early items finish last
+    time.sleep((10 - item) * 0.01)
+    return item * item
+
+
+def fail_at(failing, item):
+    if item == failing:
+        raise ValueError(f'Invalid item {item}')
+    return item
+
+
+def transform_or_fail(failing, dcm, member):
+    if member[0] == failing:
+        raise ValueError(f'Invalid member {member[0]}')
+    return app.transform(dcm, member)
+
+
+def collect(results):
+    # Items yielded before the error
+    items = []
+    with pytest.raises(ValueError) as error:
+        for item in results:
+            items.append(item)
+    return items, str(error.value)
+
+
+@pytest.fixture
+def zip_path(tmp_path):
+    path = f'{tmp_path}/study.zip'
+    with zipfile.ZipFile(path, 'w') as z:
+        for index in range(6):
+            z.write(os.path.join(SAMPLES, f'example-{0 if index % 2 else 6}'), f'series/{index}.dcm')
+    return path
+
+
+def extract(path, workers, executor, monkeypatch, func=app.transform):
+    monkeypatch.setattr(app, 'PARSE_EXECUTOR', executor)
+    dcm = dcmfile(source_s3_bucket='dicom-input', source_s3_bucket_region='us-east-1', source_s3_key='study.zip')
+    return ordered_map(partial(func, dcm), app.members(archive(path), workers=workers),
+                       workers=workers, max_inflight=workers * 2, executor=executor)
+
+
+@pytest.mark.parametrize('executor', EXECUTORS)
+def test_same_order_as_serial(executor):
+    assert list(ordered_map(slow, range(10), workers=3, max_inflight=4, executor=executor)) == [
+        item * item for item in range(10)]
+
+
+@pytest.mark.parametrize('executor', EXECUTORS)
+def test_error_after_the_items_before_it(executor):
+    serial = collect(ordered_map(partial(fail_at, 4), range(10)))
+    assert serial == ([0, 1, 2, 3], 'Invalid item 4')
+    assert collect(ordered_map(partial(fail_at, 4), range(10), workers=3, executor=executor)) == serial
+
+
+def test_invalid_executor():
+    with pytest.raises(ValueError):
+        list(ordered_map(slow, range(2), workers=2, executor='fork'))
+
+
+@pytest.mark.parametrize('executor', EXECUTORS)
+def test_archive_rows_match_serial(zip_path, executor, monkeypatch):
+    serial = list(extract(zip_path, 1, executor, monkeypatch))
+    assert [row['SOURCE_S3_ARCHIVE_PATH'] for row in serial] == [f'series/{index}.dcm' for index in range(6)]
+    assert list(extract(zip_path, 3, executor, monkeypatch)) == serial
+
+
+@pytest.mark.parametrize('executor', EXECUTORS)
+def test_archive_member_raising(zip_path, executor, monkeypatch):
+    func = partial(transform_or_fail, 'series/3.dcm')
+    rows, error = collect(extract(zip_path, 1, executor, monkeypatch, func))
+    assert [row['SOURCE_S3_ARCHIVE_PATH'] for row in rows] == ['series/0.dcm', 'series/1.dcm', 'series/2.dcm']
+    assert error == 'Invalid member series/3.dcm'
+    assert collect(extract(zip_path, 3, executor, monkeypatch, func)) == (rows, error)
@@ -0,0 +1,37 @@
+# Partition values and sort order of the output files
+import datetime
+import utils.arrow as arrow
+import utils.partitioning as partitioning
+
+
+def test_fallback_date_does_not_replace_the_study_date():
+    element = partitioning.fill_dates({'SeriesDate': datetime.date(2020, 2, 14)}, 'example')
+    assert element.get('StudyDate') is None
+    assert element['StudyDatePartition'] == datetime.date(2020, 2, 14)
+    assert element['StudyDateSource'] == 'SeriesDate'
+
+
+def test_rows_without_any_date_are_in_the_default_partition():
+    element = partitioning.fill_dates({'Modality': 'CT'}, 'example')
+    assert element == {'Modality': 'CT'}
+    table = arrow.to_table({'Modality': ['CT'], 'StudyDate': [None]})
+    assert [prefix for prefix, _, _ in arrow.partition(table, partitioning.parse('study_date'))] == [
+        f'study_date={partitioning.DEFAULT_PARTITION}']
+
+
+def test_fallback_date_is_only_stored_in_the_path():
+    elements = [partitioning.fill_dates(element, 'example') for element in [
+        {'StudyDate': datetime.date(2021, 1, 1)}, {'SeriesDate': datetime.date(2020, 2, 14)}]]
+    table = arrow.to_table({name: [element.get(name) for element in elements]
+                            for name in ['StudyDate', 'StudyDatePartition', 'StudyDateSource']})
+    parts = {prefix: part for prefix, _, part in arrow.partition(table, partitioning.parse('year(study_date)'))}
+    assert sorted(parts) == ['study_date_year=2020', 'study_date_year=2021']
+    part = parts['study_date_year=2020']
+    assert part.column_names == ['study_date', 'study_date_source']
+    assert part.column('study_date').to_pylist() == [None]
+    assert part.column('study_date_source').to_pylist() == ['SeriesDate']
+
+
+def test_instance_number_sorts_as_an_integer():
+    table = arrow.to_table({'StudyInstanceUID': ['1.2'] * 4, 'InstanceNumber': ['10', '2', None, '1']})
+    assert arrow.sort(table, partitioning.sort_keys()).column('instance_number').to_pylist() == ['1', '2', '10', None]
@@ -0,0 +1,30 @@
+# Time kept before the Lambda timeout to hand an archive off to AWS Batch
+import time
+import router
+
+
+class context():
+    def __init__(self, remaining):
+        self.remaining = remaining
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining * 1000
+
+
+def test_handoff_is_a_fraction_of_the_timeout(monkeypatch):
+    monkeypatch.setattr(router, 'LAMBDA_TIMEOUT', 900)
+    assert router.handoff_seconds(900) == 90
+    monkeypatch.setattr(router, 'LAMBDA_TIMEOUT', 60)
+    assert router.handoff_seconds(60) == router.HANDOFF_MIN_SECONDS
+
+
+def test_handoff_leaves_half_of_a_short_invocation(monkeypatch):
+    monkeypatch.setattr(router, 'LAMBDA_TIMEOUT', 600)
+    assert router.handoff_seconds(30) == 15
+
+
+def test_deadline_uses_the_remaining_time(monkeypatch):
+    monkeypatch.setattr(router, 'LAMBDA_TIMEOUT', 600)
+    start = time.monotonic()
+    deadline = router.deadline(context(300))
+    assert 240 <= deadline - start <= 241
@@ -0,0 +1,146 @@
+# Ranged, prefix and streamed reads of S3 objects served by moto
+import io
+import os
+import zipfile
+import pytest
+import s3wrapper
+import utils.aws as aws
+from s3wrapper import s3file, s3rangefile, s3prefixfile
+
+BUCKET = 'dicom-input'
+DATA = os.urandom(2000)
+
+
+class recording():
+    # S3 client recording the range of every GET
+    def __init__(self, client):
+        self.client = client
+        self.ranges = []
+
+    def get_object(self, **kwargs):
+        self.ranges.append(kwargs.get('Range'))
+        return self.client.get_object(**kwargs)
+
+
+@pytest.fixture
+def client(moto):
+    client = aws.get_client('s3', 'us-east-1')
+    client.create_bucket(Bucket=BUCKET)
+    client.put_object(Bucket=BUCKET, Key='data.bin', Body=DATA)
+    client.put_object(Bucket=BUCKET, Key='empty.dcm', Body=b'')
+    return recording(client)
+
+
+def read_at(reader, position, size):
+    reader.seek(position)
+    buffer = bytearray(size)
+    return bytes(buffer[:reader.readinto(buffer)])
+
+
+def test_range_reads_at_boundaries(client):
+    reader = s3rangefile(client, BUCKET, 'data.bin', len(DATA))
+    assert read_at(reader, 0, 1) == DATA[:1]
+    assert read_at(reader, 1995, 10) == DATA[1995:]
+    assert read_at(reader, 2000, 10) == b''
+    assert read_at(reader, 2500, 10) == b''
+    assert client.ranges == ['bytes=0-0', 'bytes=1995-1999']
+    assert reader.seek(-1, io.SEEK_END) == 1999
+    assert reader.seek(-9, io.SEEK_CUR) == 1990
+    with pytest.raises(ValueError):
+        reader.seek(-1)
+    with pytest.raises(ValueError):
+        reader.seek(0, 3)
+    # Buffered like s3file.open_range
+    buffered = io.BufferedReader(s3rangefile(client, BUCKET, 'data.bin', len(DATA)), buffer_size=512)
+    buffered.seek(1900)
+    assert buffered.read() == DATA[1900:]
+
+
+def test_range_reads_prefetched_blocks(client):
+    reader = s3rangefile(client, BUCKET, 'data.bin', len(DATA))
+    reader.prefetch([(0, 99), (100, 299)])
+    for _, _, future in list(reader.blocks):
+        future.result()
+    # A read starting in a block is served from it and stops at its end
+    assert read_at(reader, 150, 100) == DATA[150:250]
+    assert read_at(reader, 250, 100) == DATA[250:300]
+    assert sorted(client.ranges) == ['bytes=0-99', 'bytes=100-299']
+    # Blocks behind the read position are dropped, the next read is a GET of its own
+    assert read_at(reader, 300, 100) == DATA[300:400]
+    assert read_at(reader, 50, 10) == DATA[50:60]
+    assert client.ranges[2:] == ['bytes=300-399', 'bytes=50-59']
+    assert not reader.blocks
+    reader.close()
+
+
+def test_prefetch_members_coalesces_small_members(client, monkeypatch):
+    monkeypatch.setattr(s3wrapper, 'STREAM_BLOCK_SIZE', 4096)
+    monkeypatch.setattr(s3wrapper, 'ZIP_HEADER_SLACK', 0)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as z:
+        for name, size in [('a.dcm', 100), ('b.dcm', 100), ('c.dcm', 5000), ('d.dcm', 100)]:
+            z.writestr(name, DATA[:size] if size <= len(DATA) else DATA * 3)
+    body = buffer.getvalue()
+    client.client.put_object(Bucket=BUCKET, Key='study.zip', Body=body)
+    ds = s3file(BUCKET, 'study.zip', 'us-east-1', size=len(body))
+    ds.s3_client = client
+    archive = ds.open_zip()
+    files = archive.infolist()
+    recorded = []
+    ds.prefetch_members(type('reader', (), {'prefetch': lambda self, ranges: recorded.extend(ranges)})(), files)
+    a, b, c, d = files
+    # a and b share one GET, c is capped at the block size and d starts a new one
+    assert recorded == [(a.header_offset, b.header_offset + 30 + 5 + 100 - 1),
+                        (c.header_offset, c.header_offset + 4096 - 1),
+                        (d.header_offset, d.header_offset + 30 + 5 + 100 - 1)]
+    # Members read through the prefetched blocks are complete
+    del client.ranges[:]
+    ds.prefetch_members(archive.fp.raw, files)
+    assert [archive.open(file).read() for file in files] == [DATA[:100], DATA[:100], DATA * 3, DATA[:100]]
+    assert {f'bytes={start}-{end}' for start, end in recorded} <= set(client.ranges)
+
+
+def test_prefix_range_grows_up_to_max_range(client):
+    reader = s3prefixfile(client, BUCKET, 'data.bin', len(DATA), initial_range=100, max_range=400)
+    data = b''.join(iter(lambda: reader.read(50), b''))
+    assert data == DATA
+    assert client.ranges == ['bytes=0-99', 'bytes=100-299', 'bytes=300-699', 'bytes=700-1099',
+                             'bytes=1100-1499', 'bytes=1500-1899', 'bytes=1900-1999']
+    # Reads already fetched do not GET again, a large read is fetched at once
+    assert read_at(reader, 10, 20) == DATA[10:30]
+    assert len(client.ranges) == 7
+    large = s3prefixfile(client, BUCKET, 'data.bin', len(DATA), initial_range=100, max_range=400)
+    assert read_at(large, 0, 1500) == DATA[:1500]
+    assert client.ranges[7:] == ['bytes=0-1499']
+
+
+def test_header_of_dcm(client, monkeypatch):
+    monkeypatch.setattr(s3wrapper, 'DCM_INITIAL_RANGE', 100)
+    monkeypatch.setattr(s3wrapper, 'DCM_MAX_RANGE', 400)
+    ds = s3file(BUCKET, 'data.bin', 'us-east-1', size=len(DATA))
+    ds.s3_client = client
+    header = ds.open_header()
+    assert header.name == 'data.bin'
+    assert header.read(50) == DATA[:50]
+    assert header.read(100) == DATA[50:150]
+    assert client.ranges == ['bytes=0-99', 'bytes=100-299']
+
+
+def test_zero_byte_object(client):
+    ds = s3file(BUCKET, 'empty.dcm', 'us-east-1', size=0)
+    ds.s3_client = client
+    assert ds.read_prefix(132) == b''
+    assert ds.open_header().read() == b''
+    assert read_at(s3rangefile(client, BUCKET, 'empty.dcm', 0), 0, 10) == b''
+    assert client.ranges == []
+    assert ds.open_stream().read() == b''
+    assert client.ranges == [None]
+
+
+def test_stream_reads(client):
+    ds = s3file(BUCKET, 'data.bin', 'us-east-1', size=len(DATA))
+    stream = ds.open_stream()
+    assert stream.read(10) == DATA[:10]
+    assert stream.read(-1) == DATA[10:]
+    assert stream.read(10) == b''
+    stream.close()
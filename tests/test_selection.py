@@ -0,0 +1,35 @@
+# Tag selection and deferred values of large elements
+import io
+import os
+import sys
+import pytest
+import pydicom
+import utils.selection as selection
+from dicomwrapper import dcmfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import differential  # noqa: E402
+
+TEST_FILES = os.path.join(os.path.dirname(pydicom.data.__file__), 'test_files')
+FILES = [(os.path.relpath(name, ROOT), data) for name, data in differential.members(os.path.join(ROOT, 'sample_dcm'))]
+FILES += [(os.path.basename(name), data) for name, data in differential.members(TEST_FILES) if os.path.basename(name) in (
+    'MR_small.dcm', 'rtdose.dcm', 'waveform_ecg.dcm', 'reportsi_with_empty_number_tags.dcm')]
+
+
+@pytest.mark.parametrize('name,data', FILES, ids=[name for name, _ in FILES])
+def test_flatten_with_defer_size(monkeypatch, name, data):
+    monkeypatch.setattr(selection, 'DEFER_SIZE', '100')
+    dcm = dcmfile(source_s3_bucket='bucket', source_s3_bucket_region='us-east-1', source_s3_key='key')
+    image = selection.dcmread(io.BytesIO(data))
+    selection.remove_private_tags(image)
+    element = dcm.transform(name, image)
+    assert element['SOURCE_S3_ARCHIVE_PATH'] == name
+
+
+def test_empty_converted_elements_are_not_deferred(monkeypatch):
+    monkeypatch.setattr(selection, 'DEFER_SIZE', '100')
+    ds = pydicom.Dataset()
+    ds.add_new(0x00280010, 'US', None)
+    assert selection.deferred(ds, 0x00280010) is None
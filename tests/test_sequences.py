@@ -0,0 +1,122 @@
+# Sequences flattened to list<struct> entries, capped by SQ_MAX_ITEMS and SQ_MAX_DEPTH
+import pytest
+from pydicom.dataset import Dataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filereader import read_dataset
+from pydicom.filewriter import write_dataset
+import utils.arrow as arrow
+import utils.schema as schema
+import utils.sequences as sequences
+
+
+def image(count):
+    # ReferencedImageSequence of count items, each with a nested code sequence
+    items = []
+    for index in range(count):
+        code = Dataset()
+        code.CodeValue = '121311'
+        code.CodingSchemeDesignator = 'DCM'
+        item = Dataset()
+        item.ReferencedSOPInstanceUID = f'1.2.3.{index}'
+        item.ReferencedFrameNumber = str(index + 1)
+        item.PurposeOfReferenceCodeSequence = [code]
+        items.append(item)
+    ds = Dataset()
+    ds.ReferencedImageSequence = items
+    return ds
+
+
+def raw(ds):
+    # Written and read again, items hold raw elements without VR like implicit VR files
+    ds.is_little_endian = True
+    ds.is_implicit_VR = True
+    buffer = DicomBytesIO()
+    buffer.is_little_endian = True
+    buffer.is_implicit_VR = True
+    write_dataset(buffer, ds)
+    buffer.seek(0)
+    return read_dataset(buffer, is_implicit_VR=True, is_little_endian=True)
+
+
+@pytest.fixture(params=['dataset', 'raw'])
+def build(request):
+    return image if request.param == 'dataset' else lambda count: raw(image(count))
+
+
+def paths(entries):
+    return [entry['Path'] for entry in entries]
+
+
+def test_entries(build, monkeypatch):
+    monkeypatch.setattr(sequences, 'SQ_MAX_ITEMS', 100)
+    monkeypatch.setattr(sequences, 'SQ_MAX_DEPTH', 4)
+    entries = sequences.flatten(build(2)['ReferencedImageSequence'])
+    assert entries[:4] == [
+        {'Path': '[0].ReferencedSOPInstanceUID', 'Keyword': 'ReferencedSOPInstanceUID', 'VR': 'UI',
+         'Value': ['1.2.3.0']},
+        {'Path': '[0].ReferencedFrameNumber', 'Keyword': 'ReferencedFrameNumber', 'VR': 'IS', 'Value': ['1']},
+        {'Path': '[0].PurposeOfReferenceCodeSequence[0].CodeValue', 'Keyword': 'CodeValue', 'VR': 'SH',
+         'Value': ['121311']},
+        {'Path': '[0].PurposeOfReferenceCodeSequence[0].CodingSchemeDesignator', 'Keyword': 'CodingSchemeDesignator',
+         'VR': 'SH', 'Value': ['DCM']},
+    ]
+    assert len(entries) == 8
+    column = arrow.to_array('ReferencedImageSequence', [entries])
+    assert column.type == schema.SQ_TYPE == schema.column_type('ReferencedImageSequence')
+
+
+def test_max_items(build, monkeypatch):
+    monkeypatch.setattr(sequences, 'SQ_MAX_ITEMS', 3)
+    flattener = sequences.flattener()
+    entries = flattener.flatten(build(5)['ReferencedImageSequence'].value)
+    assert sorted({path.split('.')[0] for path in paths(entries)}) == ['[0]', '[1]', '[2]']
+    assert flattener.skipped_items == 2
+
+
+def test_max_items_of_nested_sequences(monkeypatch):
+    monkeypatch.setattr(sequences, 'SQ_MAX_ITEMS', 1)
+    ds = image(1)
+    code = Dataset()
+    code.CodeValue = '113100'
+    ds.ReferencedImageSequence[0].PurposeOfReferenceCodeSequence.append(code)
+    flattener = sequences.flattener()
+    entries = flattener.flatten(ds.ReferencedImageSequence)
+    assert '[0].PurposeOfReferenceCodeSequence[1].CodeValue' not in paths(entries)
+    assert '[0].PurposeOfReferenceCodeSequence[0].CodeValue' in paths(entries)
+    assert flattener.skipped_items == 1
+
+
+@pytest.mark.parametrize('depth, nested', [(1, False), (2, True)])
+def test_max_depth(build, monkeypatch, depth, nested):
+    monkeypatch.setattr(sequences, 'SQ_MAX_DEPTH', depth)
+    flattener = sequences.flattener()
+    entries = flattener.flatten(build(3)['ReferencedImageSequence'].value)
+    assert ('[2].PurposeOfReferenceCodeSequence[0].CodeValue' in paths(entries)) == nested
+    assert flattener.skipped_sequences == (0 if nested else 3)
+    assert '[2].ReferencedSOPInstanceUID' in paths(entries)
+
+
+def test_unselected_nested_sequences_are_skipped():
+    flattener = sequences.flattener(selected=set())
+    entries = flattener.flatten(image(2).ReferencedImageSequence)
+    assert not any('PurposeOfReferenceCodeSequence' in path for path in paths(entries))
+    assert flattener.skipped_sequences == 2
+
+
+def test_identical_nested_sequences_are_converted_once():
+    flattener = sequences.flattener()
+    entries = flattener.flatten(raw(image(4)).ReferencedImageSequence)
+    assert len(flattener.sequences) == 1
+    assert [entry['Value'] for entry in entries if entry['Keyword'] == 'CodeValue'] == [['121311']] * 4
+
+
+def test_dates_and_times_as_top_level_columns():
+    item = Dataset()
+    item.ContentDate = '20211103'
+    item.ContentTime = '1230'
+    item.AcquisitionDateTime = '20211103123045+0200'
+    ds = Dataset()
+    ds.ReferencedImageSequence = [item]
+    values = {entry['Keyword']: entry['Value'] for entry in sequences.flatten(ds['ReferencedImageSequence'])}
+    assert values == {'ContentDate': ['2021-11-03'], 'ContentTime': ['12:30:00.000000'],
+                      'AcquisitionDateTime': ['2021-11-03 10:30:45']}
@@ -0,0 +1,72 @@
+# DA, DT and TM values parsed to dates, UTC timestamps and fixed width times
+import datetime
+import pytest
+import pyarrow as pa
+from pydicom.dataelem import DataElement
+import utils.arrow as arrow
+import utils.schema as schema
+import utils.tags as tags
+import utils.temporal as temporal
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2021', datetime.datetime(2021, 1, 1)),
+    ('202111', datetime.datetime(2021, 11, 1)),
+    ('20211103', datetime.datetime(2021, 11, 3)),
+    ('2021110312', datetime.datetime(2021, 11, 3, 12)),
+    ('202111031230', datetime.datetime(2021, 11, 3, 12, 30)),
+    ('20211103123045', datetime.datetime(2021, 11, 3, 12, 30, 45)),
+    ('20211103123045.5', datetime.datetime(2021, 11, 3, 12, 30, 45, 500000)),
+    ('20211103123045.123456', datetime.datetime(2021, 11, 3, 12, 30, 45, 123456)),
+    ('20211103123045 ', datetime.datetime(2021, 11, 3, 12, 30, 45)),
+    # Leap second
+    ('20211231235960', datetime.datetime(2021, 12, 31, 23, 59, 59)),
+])
+def test_parse_DT_partial_precision(value, expected):
+    assert temporal.parse_DT(value) == expected
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('20211103123045+0200', datetime.datetime(2021, 11, 3, 10, 30, 45)),
+    ('20211103233000-0130', datetime.datetime(2021, 11, 4, 1, 0)),
+    ('20211103123045.25+0000', datetime.datetime(2021, 11, 3, 12, 30, 45, 250000)),
+    ('2021+0100', datetime.datetime(2020, 12, 31, 23, 0)),
+])
+def test_parse_DT_converts_offsets_to_utc(value, expected):
+    assert temporal.parse_DT(value) == expected
+
+
+@pytest.mark.parametrize('value', [
+    '', 'abc', '21', '2021-11-03', '20211332', '20211103250000', '20211103126000',
+    '20211103123045.1234567', '20211103+02', '20211103123045+02:00',
+])
+def test_parse_DT_invalid(value):
+    assert temporal.parse_DT(value) is None
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('12', '12:00:00.000000'),
+    ('1230', '12:30:00.000000'),
+    ('123045.5', '12:30:45.500000'),
+    ('12:30:45', '12:30:45.000000'),
+    ('2512', '2512'),
+    ('noon', 'noon'),
+])
+def test_format_TM(value, expected):
+    assert temporal.format_TM(value) == expected
+
+
+def test_parse_DA():
+    assert temporal.parse_DA('20211103') == datetime.date(2021, 11, 3)
+    with pytest.raises(ValueError):
+        temporal.parse_DA('2021.11.03')
+
+
+def test_DT_elements_are_timestamp_columns():
+    assert schema.column_type('AcquisitionDateTime') == pa.timestamp('ms')
+    values = [tags.convert_DT(DataElement(0x0008002A, 'DT', value))
+              for value in ['20211103123045+0200', '2021', 'invalid', '']]
+    assert values == [datetime.datetime(2021, 11, 3, 10, 30, 45), datetime.datetime(2021, 1, 1), None, None]
+    column = arrow.to_array('AcquisitionDateTime', values)
+    assert column.type == pa.timestamp('ms')
+    assert column.null_count == 2